@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -67,6 +68,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'memory.routers.read_replica_middleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -96,12 +98,74 @@ ASGI_APPLICATION = 'backend.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DATABASE_PROFILE picks the storage setup:
+#   sqlite-wal  (default) the SQLite file, with SQLITE_PRAGMAS applied to
+#               every new connection by memory.storage
+#   sqlite      the SQLite file with SQLite's own defaults (rollback journal)
+#   postgres    POSTGRES_* below; connections are kept for
+#               POSTGRES_CONN_MAX_AGE seconds and checked before reuse.
+#               Needs psycopg: pip install -r requirements-postgres.txt
+DATABASE_PROFILES = ('sqlite-wal', 'sqlite', 'postgres')
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite-wal')
+if DATABASE_PROFILE not in DATABASE_PROFILES:
+    raise ImproperlyConfigured(
+        f'Unknown DATABASE_PROFILE {DATABASE_PROFILE!r}; expected one of {", ".join(DATABASE_PROFILES)}'
+    )
+
+if DATABASE_PROFILE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'memory'),
+            'USER': os.environ.get('POSTGRES_USER', 'memory'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', '60')),
+            'CONN_HEALTH_CHECKS': True,
+        }
     }
-}
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DJANGO_SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        }
+    }
+
+# A read replica: DJANGO_SQLITE_REPLICA_PATH for the SQLite profiles, or
+# POSTGRES_REPLICA_HOST (and POSTGRES_REPLICA_PORT) for postgres, with the
+# primary's other settings. memory.routers sends the memory app's reads there
+# within a request or chat turn until it writes. Tests use the primary.
+_replica = None
+if DATABASE_PROFILE == 'postgres':
+    if os.environ.get('POSTGRES_REPLICA_HOST'):
+        _replica = {
+            'HOST': os.environ['POSTGRES_REPLICA_HOST'],
+            'PORT': os.environ.get('POSTGRES_REPLICA_PORT', DATABASES['default']['PORT']),
+        }
+elif os.environ.get('DJANGO_SQLITE_REPLICA_PATH'):
+    _replica = {'NAME': os.environ['DJANGO_SQLITE_REPLICA_PATH']}
+if _replica:
+    DATABASES['replica'] = {**DATABASES['default'], **_replica, 'TEST': {'MIRROR': 'default'}}
+READ_REPLICA_DATABASE = 'replica' if _replica else None
+DATABASE_ROUTERS = ['memory.routers.ReadReplicaRouter']
+
+# WAL lets readers run alongside the one writer, and with synchronous=NORMAL
+# a commit appends to the WAL without an fsync (a power loss can drop the
+# last commits, never corrupt the file). busy_timeout is in milliseconds,
+# a negative cache_size in KiB.
+SQLITE_PRAGMAS = (
+    {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'mmap_size': 256 * 1024 * 1024,
+        'busy_timeout': 5000,
+        'cache_size': -64 * 1024,
+    }
+    if DATABASE_PROFILE == 'sqlite-wal'
+    else {}
+)
 
 
 # Password validation
@@ -140,6 +204,59 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.environ.get('DJANGO_MEDIA_ROOT', BASE_DIR / 'media')
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', 'http://localhost:8000')
+
+# Background image rendering (memory.imaging). IMAGE_JOB_WORKERS = 0 leaves
+# jobs queued for a separate `manage.py run_image_jobs` process.
+IMAGE_RENDERER = os.environ.get('IMAGE_RENDERER', 'placeholder')
+IMAGE_JOB_WORKERS = int(os.environ.get('IMAGE_JOB_WORKERS', '4'))
+IMAGE_JOB_ATTEMPTS = 3
+
+# Admission control for LLM calls (memory.admission). RATE is turns per
+# second per user (0 disables the bucket); 'cache' shares the limits through
+# the ADMISSION_CACHE cache across processes.
+ADMISSION_STORE = os.environ.get('ADMISSION_STORE', 'local')
+ADMISSION_CACHE = 'default'
+ADMISSION_RATE = float(os.environ.get('ADMISSION_RATE', '0.5'))
+ADMISSION_BURST = int(os.environ.get('ADMISSION_BURST', '10'))
+ADMISSION_USER_CONCURRENCY = int(os.environ.get('ADMISSION_USER_CONCURRENCY', '2'))
+ADMISSION_GLOBAL_CONCURRENCY = int(os.environ.get('ADMISSION_GLOBAL_CONCURRENCY', '32'))
+if ADMISSION_USER_CONCURRENCY < 1 or ADMISSION_GLOBAL_CONCURRENCY < 1:
+    raise ImproperlyConfigured('ADMISSION_USER_CONCURRENCY and ADMISSION_GLOBAL_CONCURRENCY must be at least 1')
+ADMISSION_QUEUE_SIZE = 64
+ADMISSION_USER_QUEUE_SIZE = 4
+
+# Turns one chat socket may run at once; a user_message sent with
+# "supersede": true cancels the running ones instead of being refused.
+CHAT_TURNS_IN_FLIGHT = 1
+
+# Write-behind for websocket replies (memory.writebehind): the reply frame
+# is sent before its INSERT, which a background thread batches. When the
+# queue is full, replies are written inline again.
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', 'false').lower() == 'true'
+CHAT_WRITE_BEHIND_QUEUE = 1000
+CHAT_WRITE_BEHIND_BATCH = 100
+
+# Recent messages kept per project for sockets reconnecting with
+# ?last_message_id= (memory.replay); 0 always replays from the database.
+CHAT_REPLAY_BUFFER = 50
+CHAT_REPLAY_PROJECTS = 1000
+
+# Change events (memory.changes) are held this many seconds per user and
+# sent as one 'changes' frame; more than MAX_EVENTS in a window sends a reset.
+CHAT_CHANGE_WINDOW = 0.1
+CHAT_CHANGE_MAX_EVENTS = 200
+
+# Chat sockets get a 'ping' frame every HEARTBEAT_SECONDS (0 disables) and
+# are closed (4008) after HEARTBEAT_TIMEOUT seconds without any frame back.
+# Connecting beyond IDLE_CONNECTIONS_PER_USER sockets with no turn running
+# closes the user's least recently used ones (4009). Both are per process.
+CHAT_HEARTBEAT_SECONDS = 25
+CHAT_HEARTBEAT_TIMEOUT = 60
+CHAT_IDLE_CONNECTIONS_PER_USER = 5
+
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:5173',
 ]
@@ -160,8 +277,37 @@ REST_FRAMEWORK = {
     ],
 }
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+# CHANNEL_LAYER=database shares groups between ASGI worker processes through
+# the project database (memory.channel_layer); the in-memory layer only
+# reaches sockets in the same process.
+if os.environ.get('CHANNEL_LAYER', 'memory') == 'database':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'memory.channel_layer.DatabaseChannelLayer',
+            'CONFIG': {
+                'expiry': 60,
+                'capacity': 100,
+                'poll_interval': 0.05,
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
     }
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'memory': {
+            'handlers': ['console'],
+            'level': os.environ.get('MEMORY_LOG_LEVEL', 'INFO'),
+        },
+    },
 }
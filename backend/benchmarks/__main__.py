@@ -0,0 +1,152 @@
+"""Run the memory hot-path benchmarks.
+
+From backend/:
+
+    python -m benchmarks --scale small
+    python -m benchmarks --scale small --baseline benchmarks/baseline.json --check
+    python -m benchmarks --scale small --save-baseline benchmarks/baseline.json
+    DATABASE_PROFILE=sqlite python -m benchmarks --on-disk --case agent_chat_writers
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('--scale', default='small')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--case', action='append', dest='cases', help='Run only these cases.')
+    parser.add_argument('--output', help='Write results JSON here.')
+    parser.add_argument('--baseline', help='Compare against this results JSON.')
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help='Exit non-zero on a regression against --baseline. Baselines are per machine.',
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.25,
+        help='Allowed fractional p95/peak-memory growth over the baseline.',
+    )
+    parser.add_argument('--save-baseline', help='Write results as a new baseline here.')
+    parser.add_argument(
+        '--on-disk',
+        action='store_true',
+        help='Put the SQLite test database in a file rather than in memory.',
+    )
+    args = parser.parse_args(argv)
+    if args.check and not args.baseline:
+        parser.error('--check needs --baseline')
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    import django
+
+    django.setup()
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    from .cases import CASES, SCALES, setup_environment
+    from .harness import measure
+
+    if args.scale not in SCALES:
+        parser.error(f'--scale must be one of {", ".join(SCALES)}')
+    selected = args.cases or list(CASES)
+    unknown = sorted(set(selected) - set(CASES))
+    if unknown:
+        parser.error(f'unknown cases: {", ".join(unknown)}')
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    directory = tempfile.TemporaryDirectory()
+    if args.on_disk and connection.vendor == 'sqlite':
+        connection.settings_dict['TEST']['NAME'] = os.path.join(directory.name, 'benchmarks.sqlite3')
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        env, seed_seconds = setup_environment(args.scale)
+        print(
+            f'scale={args.scale} seeded in {seed_seconds:.1f}s; '
+            f'heavy user has {env.message_count} messages'
+        )
+        results = {}
+        for name in selected:
+            factory, repeat, warmup, items = CASES[name]
+            run = factory(env)
+            if run is None:
+                print(f'{name:28} skipped on this database')
+                continue
+            results[name] = measure(
+                run,
+                repeat=repeat or args.repeat,
+                warmup=warmup,
+                items=items,
+            )
+            result = results[name]
+            # Case-specific figures, e.g. encoded frame sizes.
+            result.update(getattr(run, 'stats', {}))
+            line = (
+                f'{name:28} p50 {result["p50_ms"]:9.2f}ms  p95 {result["p95_ms"]:9.2f}ms  '
+                f'queries {result["queries"]:5}  peak {result["peak_kb"]:9.1f}KB'
+            )
+            if 'items_per_s' in result:
+                line += f'  {result["items_per_s"]:.0f} items/s'
+            if 'bytes_per_item' in result:
+                line += f'  {result["bytes_per_item"]} B/item'
+            if result.get('failed_turns'):
+                line += f'  {result["failed_turns"]} failed'
+            print(line)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        directory.cleanup()
+
+    report = {
+        'meta': {
+            'scale': args.scale,
+            'repeat': args.repeat,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'profile': settings.DATABASE_PROFILE,
+            'on_disk': args.on_disk or connection.vendor != 'sqlite',
+        },
+        'cases': results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            Path(path).write_text(json.dumps(report, indent=2) + '\n')
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        return gate(report, baseline, args.threshold, args.check)
+    return 0
+
+
+def gate(report, baseline, threshold, check):
+    # Prints how the run compares with the baseline; the exit status only
+    # reflects regressions with --check, since baselines are per machine.
+    from .harness import baseline_warnings, compare
+
+    for warning in baseline_warnings(report['meta'], baseline['meta']):
+        print(f'warning: {warning}')
+    regressions = compare(report['cases'], baseline['cases'], threshold)
+    if not regressions:
+        print('\nNo regressions against baseline.')
+        return 0
+    print('\nRegressions:')
+    for line in regressions:
+        print(f'  {line}')
+    return 1 if check else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,443 @@
+import asyncio
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from django.db.models import Count
+from django.test import AsyncClient
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from memory.framing import CODECS, assistant_frame
+from memory.learning import process_feedback_event
+from memory.llm.service import _mock_agent_response
+from memory.models import ChatMessage, DesignVersion, FeedbackEvent, GeneratedImage, Project
+from memory.pipeline import run_turn
+from memory.readpath import FastJSONRenderer, serialize_rows
+from memory.replay import recent_messages
+from memory.retrieval import resolve_context
+from memory.serializers import GeneratedImageSerializer
+from memory.testing import WebsocketClient
+
+# generate_load_data arguments for the background population, plus the
+# shape of the one heavy user every case runs as.
+SCALES = {
+    'small': {
+        'population': {'users': 20},
+        'heavy': {'projects_per_room': 2, 'messages': 100},
+        'lineage_depth': 200,
+    },
+    'medium': {
+        'population': {'users': 200},
+        'heavy': {'projects_per_room': 5, 'messages': 350},
+        'lineage_depth': 1000,
+    },
+    'large': {
+        'population': {'users': 2000},
+        'heavy': {'projects_per_room': 10, 'messages': 1700},
+        'lineage_depth': 1000,
+    },
+}
+
+CONCURRENT_TURNS = 200
+SIMULATED_LLM_SECONDS = 0.05
+FEEDBACK_EVENTS = 10000
+# The one-request-per-event path runs ~5 ms per event; a 10k sample would
+# dominate the suite, so it is timed on a slice and compared per event.
+FEEDBACK_SINGLE_EVENTS = 1000
+LIST_ROWS = 2000
+FRAME_TURNS = 20
+CHAT_WRITERS = 8
+CHAT_WRITER_TURNS = 5
+
+CASES = {}
+
+
+def case(name, repeat=None, warmup=2, items=None):
+    def register(factory):
+        CASES[name] = (factory, repeat, warmup, items)
+        return factory
+
+    return register
+
+
+class BenchEnv:
+    def __init__(self, scale):
+        config = SCALES[scale]
+        call_command(
+            'generate_load_data',
+            prefix='population',
+            seed=1,
+            stdout=io.StringIO(),
+            **config['population'],
+        )
+        call_command(
+            'generate_load_data',
+            prefix='bench',
+            users=1,
+            uniform=True,
+            seed=2,
+            stdout=io.StringIO(),
+            **config['heavy'],
+        )
+        User = get_user_model()
+        self.user = User.objects.filter(username__startswith='bench-').get()
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.project = (
+            Project.objects.filter(user=self.user)
+            .annotate(message_count=Count('chatmessage'))
+            .order_by('-message_count')
+            .first()
+        )
+        self.message_count = ChatMessage.objects.filter(project__user=self.user).count()
+        # Turn-running cases write here so they do not grow the listing cases.
+        self.chat_project = Project.objects.create(
+            user=self.user,
+            room_type='living_room',
+            title='Benchmark chat',
+        )
+        self.lineage_depth = config['lineage_depth']
+        self.lineage_project = Project.objects.create(
+            user=self.user,
+            room_type='other',
+            title='Deep lineage',
+        )
+        parent = None
+        for number in range(1, self.lineage_depth + 2):
+            parent = DesignVersion.objects.create(
+                project=self.lineage_project,
+                parent_version=parent,
+                version_number=number,
+            )
+        self.lineage_leaf = parent
+
+
+@case('resolve_context')
+def resolve_context_case(env):
+    def run():
+        resolve_context(
+            user_id=env.user.id,
+            message='design my living room with the same vibe as bedroom',
+            project_id=env.project.id,
+        )
+
+    return run
+
+
+@case('process_feedback_event')
+def process_feedback_case(env):
+    event = FeedbackEvent.objects.create(
+        user=env.user,
+        project=env.project,
+        event_type='modify',
+        payload_json={'text': 'make it warmer and add plants'},
+    )
+
+    def run():
+        process_feedback_event(event)
+
+    return run
+
+
+@case('agent_chat')
+def agent_chat_case(env):
+    def run():
+        response = env.client.post(
+            '/api/agent/chat',
+            {'project_id': env.chat_project.id, 'message': 'make the palette warmer'},
+            format='json',
+        )
+        assert response.status_code == 200, response.content
+
+    return run
+
+
+@case('agent_chat_concurrent', repeat=5)
+def agent_chat_concurrent_case(env):
+    # One sample is a burst of simultaneous turns against an LLM that takes
+    # SIMULATED_LLM_SECONDS; serial handling would take turns * latency.
+    async def slow_llm(context, message):
+        await asyncio.sleep(SIMULATED_LLM_SECONDS)
+        return _mock_agent_response(message)
+
+    async def burst():
+        client = AsyncClient()
+        headers = {'Authorization': f'Token {env.token.key}'}
+        with mock.patch('memory.pipeline.agenerate_agent_response', slow_llm):
+            responses = await asyncio.gather(
+                *[
+                    client.post(
+                        '/api/agent/chat',
+                        {'project_id': env.chat_project.id, 'message': f'concurrent {index}'},
+                        content_type='application/json',
+                        headers=headers,
+                    )
+                    for index in range(CONCURRENT_TURNS)
+                ]
+            )
+        assert all(response.status_code == 200 for response in responses)
+
+    return async_to_sync(burst)
+
+
+@case('agent_chat_writers', repeat=5, items=CHAT_WRITERS * CHAT_WRITER_TURNS)
+def agent_chat_writers_case(env):
+    # Threads posting turns at once, each on its own connection: the
+    # write-heavy path the storage profiles differ on. Threads cannot share
+    # SQLite's in-memory test database, so this needs --on-disk there.
+    if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+        return None
+
+    def writer(index):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {env.token.key}')
+        failed = 0
+        try:
+            for turn in range(CHAT_WRITER_TURNS):
+                try:
+                    response = client.post(
+                        '/api/agent/chat',
+                        {'project_id': env.chat_project.id, 'message': f'writer {index} turn {turn}'},
+                        format='json',
+                    )
+                except OperationalError:
+                    failed += 1
+                else:
+                    assert response.status_code == 200, response.content
+            return failed
+        finally:
+            connections.close_all()
+
+    def run():
+        with ThreadPoolExecutor(CHAT_WRITERS) as pool:
+            run.stats['failed_turns'] += sum(pool.map(writer, range(CHAT_WRITERS)))
+
+    run.stats = {'failed_turns': 0}
+    return run
+
+
+def _feedback_events(env, count):
+    version, _ = DesignVersion.objects.get_or_create(project=env.chat_project, version_number=1)
+    texts = ['make it warmer', 'add plants', 'more minimal please']
+    events = []
+    for index in range(count):
+        if index % 2:
+            payload = {'selected_option_index': index % 5}
+        else:
+            payload = {'text': texts[index % 3]}
+        events.append(
+            {
+                'project': env.chat_project.id,
+                'design_version': version.id,
+                'event_type': 'select' if index % 2 else 'modify',
+                'payload_json': payload,
+            }
+        )
+    return events
+
+
+@case('feedback_single', repeat=3, warmup=0, items=FEEDBACK_SINGLE_EVENTS)
+def feedback_single_case(env):
+    events = _feedback_events(env, FEEDBACK_SINGLE_EVENTS)
+
+    def run():
+        for event in events:
+            response = env.client.post('/api/feedback/', dict(event, user=env.user.id), format='json')
+            assert response.status_code == 201, response.content
+
+    return run
+
+
+@case('feedback_batch', repeat=3, warmup=1, items=FEEDBACK_EVENTS)
+def feedback_batch_case(env):
+    events = _feedback_events(env, FEEDBACK_EVENTS)
+
+    def run():
+        response = env.client.post('/api/feedback/batch/', {'events': events}, format='json')
+        assert response.status_code == 201, response.content
+
+    return run
+
+
+@case('previews')
+def previews_case(env):
+    def run():
+        response = env.client.get('/api/projects/previews/')
+        assert response.status_code == 200
+
+    return run
+
+
+@case('list_rows_drf', items=LIST_ROWS)
+def list_rows_drf_case(env):
+    # The listing work both read paths share is query + serialize + render.
+    def run():
+        images = GeneratedImage.objects.order_by('id')[:LIST_ROWS]
+        JSONRenderer().render(GeneratedImageSerializer(images, many=True).data)
+
+    return run
+
+
+@case('list_rows_fast', items=LIST_ROWS)
+def list_rows_fast_case(env):
+    def run():
+        images = GeneratedImage.objects.order_by('id')[:LIST_ROWS]
+        FastJSONRenderer().render(serialize_rows(images, GeneratedImageSerializer))
+
+    return run
+
+
+@case('messages_full')
+def messages_full_case(env):
+    def run():
+        response = env.client.get(f'/api/projects/{env.project.id}/messages/')
+        assert response.status_code == 200
+
+    return run
+
+
+@case('messages_page')
+def messages_page_case(env):
+    def run():
+        response = env.client.get(
+            f'/api/projects/{env.project.id}/messages/',
+            {'limit': 50, 'include_metadata': 'false'},
+        )
+        assert response.status_code == 200
+
+    return run
+
+
+@case('version_ancestors')
+def version_ancestors_case(env):
+    def run():
+        count = len(env.lineage_leaf.ancestors())
+        assert count == env.lineage_depth, count
+
+    return run
+
+
+@case('version_tree')
+def version_tree_case(env):
+    def run():
+        response = env.client.get(
+            f'/api/projects/{env.lineage_project.id}/versions/tree/',
+            {'ancestors_of': env.lineage_leaf.id},
+        )
+        assert response.status_code == 200
+
+    return run
+
+
+@case('search')
+def search_case(env):
+    def run():
+        response = env.client.get('/api/search', {'q': 'warmer living'})
+        assert response.status_code == 200
+        assert response.json()['results']
+
+    return run
+
+
+@case('chat_consumer_round_trip')
+def chat_consumer_case(env):
+    from backend.asgi import application
+
+    async def round_trip():
+        client = WebsocketClient(
+            application,
+            '/ws/chat/',
+            {'token': env.token.key, 'project_id': env.chat_project.id},
+        )
+        assert await client.connect()
+        await client.receive_until('connected')
+        await client.send_json({'type': 'user_message', 'message': 'add plants'})
+        await client.receive_until('assistant_message', timeout=5)
+        await client.disconnect()
+
+    return async_to_sync(round_trip)
+
+
+@case('chat_reconnect_replay')
+def chat_reconnect_case(env):
+    from backend.asgi import application
+
+    # A socket that missed the last few messages of the heavy project, with
+    # those messages still in this process's replay buffer.
+    recent = list(
+        ChatMessage.objects.filter(project=env.project)
+        .select_related('context_snapshot')
+        .order_by('-created_at', '-id')[:6]
+    )[::-1]
+    for message in recent:
+        recent_messages().record(message)
+    last_seen = recent[0].id
+
+    async def reconnect():
+        client = WebsocketClient(
+            application,
+            '/ws/chat/',
+            {'token': env.token.key, 'project_id': env.project.id, 'last_message_id': last_seen},
+        )
+        assert await client.connect()
+        await client.receive_until('connected')
+        frame = await client.receive_until('replay')
+        assert frame['source'] == 'buffer' and len(frame['messages']) == 5, frame
+        await client.disconnect()
+
+    return async_to_sync(reconnect)
+
+
+def _frame_case(encoding, include_context):
+    # Encoding assistant_message frames from real (mock-LLM) turns; the
+    # mean encoded size is reported alongside the timings.
+    def factory(env):
+        if not hasattr(env, 'turns'):
+            env.turns = [
+                run_turn(env.user, env.chat_project, f'warmer palette with plants, take {index}')
+                for index in range(FRAME_TURNS)
+            ]
+        frames = [assistant_frame(index, turn, include_context) for index, turn in enumerate(env.turns)]
+        encode = CODECS[encoding].encode
+
+        def run():
+            for frame in frames:
+                encode(frame)
+
+        run.stats = {'bytes_per_item': round(sum(len(encode(frame)) for frame in frames) / len(frames))}
+        return run
+
+    return factory
+
+
+for _name, _encoding, _include_context in (
+    ('ws_frame_json', 'json', True),
+    ('ws_frame_json_compact', 'json', False),
+    ('ws_frame_deflate_compact', 'json-deflate', False),
+    ('ws_frame_cbor_compact', 'cbor', False),
+):
+    case(_name, items=FRAME_TURNS)(_frame_case(_encoding, _include_context))
+
+
+def setup_environment(scale):
+    os.environ['MOCK_LLM'] = 'true'
+    # Chat cases time the request; image jobs stay queued rather than
+    # rendering on threads against the shared in-memory database.
+    settings.IMAGE_JOB_WORKERS = 0
+    # The cases drive one user far past the per-user admission limits.
+    settings.ADMISSION_RATE = 0
+    settings.ADMISSION_USER_CONCURRENCY = CONCURRENT_TURNS
+    settings.ADMISSION_GLOBAL_CONCURRENCY = CONCURRENT_TURNS
+    started = time.monotonic()
+    env = BenchEnv(scale)
+    return env, time.monotonic() - started
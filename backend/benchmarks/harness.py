@@ -0,0 +1,85 @@
+import statistics
+import time
+import tracemalloc
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+def _percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(fn, repeat, warmup=2, items=None):
+    # Latency samples run without tracing; queries and peak memory come from
+    # one extra instrumented call so tracemalloc overhead does not skew p95.
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    result = {
+        'p50_ms': round(_percentile(samples, 0.50), 3),
+        'p95_ms': round(_percentile(samples, 0.95), 3),
+        'mean_ms': round(statistics.fmean(samples), 3),
+        'queries': len(queries),
+        'peak_kb': round(peak / 1024, 1),
+        'samples': repeat,
+    }
+    if items:
+        result['items_per_s'] = round(items / (result['p50_ms'] / 1000), 1)
+    return result
+
+
+# Peak-memory growth below this many KB is treated as noise.
+MEMORY_NOISE_KB = 64
+
+
+def compare(current, baseline, threshold):
+    regressions = []
+    for name, result in current.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        limit = reference['p95_ms'] * (1 + threshold)
+        if result['p95_ms'] > limit:
+            regressions.append(
+                f'{name}: p95 {result["p95_ms"]:.2f}ms > {limit:.2f}ms '
+                f'(baseline {reference["p95_ms"]:.2f}ms)'
+            )
+        if result['queries'] > reference['queries']:
+            regressions.append(
+                f'{name}: {result["queries"]} queries > baseline {reference["queries"]}'
+            )
+        memory_limit = reference['peak_kb'] * (1 + threshold) + MEMORY_NOISE_KB
+        if result['peak_kb'] > memory_limit:
+            regressions.append(
+                f'{name}: peak {result["peak_kb"]:.0f}KB > {memory_limit:.0f}KB '
+                f'(baseline {reference["peak_kb"]:.0f}KB)'
+            )
+    return regressions
+
+
+# Timings only compare on the machine and setup that recorded the baseline.
+COMPARABLE_META = ('scale', 'host', 'python', 'database', 'profile', 'on_disk')
+
+
+def baseline_warnings(meta, baseline_meta):
+    return [
+        f'baseline was recorded with {key}={baseline_meta[key]}, this run has {key}={meta.get(key)}'
+        for key in COMPARABLE_META
+        if key in baseline_meta and baseline_meta[key] != meta.get(key)
+    ]
@@ -5,6 +5,7 @@ from .models import (
     DesignVersion,
     FeedbackEvent,
     GeneratedImage,
+    ImageJob,
     Preference,
     Project,
     ProjectLink,
@@ -16,6 +17,7 @@ admin.site.register(Project)
 admin.site.register(ChatMessage)
 admin.site.register(DesignVersion)
 admin.site.register(GeneratedImage)
+admin.site.register(ImageJob)
 admin.site.register(FeedbackEvent)
 admin.site.register(Preference)
 admin.site.register(ProjectLink)
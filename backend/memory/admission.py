@@ -0,0 +1,429 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+# Admission control in front of the LLM calls. A per-user token bucket
+# limits how often turns start; per-user and global in-flight caps limit how
+# many run at once. Async callers that find the caps full wait in a bounded
+# queue served round-robin across users and are handed a slot when one is
+# released; sync callers are turned away with a retry-after rather than
+# holding a worker thread.
+
+GLOBAL_KEY = '*'
+STORES = {
+    'local': 'memory.admission.LocalStore',
+    'cache': 'memory.admission.CacheStore',
+}
+
+
+class Rejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_seconds(self):
+        return max(1, math.ceil(self.retry_after))
+
+
+def _gcra(tat, now, rate, burst):
+    # Token bucket as a generic cell rate algorithm: one timestamp per user.
+    # Returns (new theoretical arrival time, 0) or (None, seconds to wait).
+    interval = 1 / rate
+    tat = max(tat or now, now)
+    allowed_at = tat - (burst - 1) * interval
+    if now < allowed_at:
+        return None, allowed_at - now
+    return tat + interval, 0.0
+
+
+class LocalStore:
+    # Process-local state; every worker process limits on its own.
+    PRUNE_AT = 10000
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._arrivals = {}
+        self._inflight = {}
+
+    def take_token(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._arrivals) >= self.PRUNE_AT:
+                self._arrivals = {k: tat for k, tat in self._arrivals.items() if tat > now}
+            tat, wait = _gcra(self._arrivals.get(key), now, rate, burst)
+            if tat is not None:
+                self._arrivals[key] = tat
+            return wait
+
+    def refund_token(self, key, rate):
+        with self._lock:
+            tat = self._arrivals.get(key)
+            if tat is not None:
+                self._arrivals[key] = tat - 1 / rate
+
+    def acquire(self, key, limit, global_limit):
+        with self._lock:
+            if self._inflight.get(GLOBAL_KEY, 0) >= global_limit or self._inflight.get(key, 0) >= limit:
+                return False
+            for counter in (GLOBAL_KEY, key):
+                self._inflight[counter] = self._inflight.get(counter, 0) + 1
+            return True
+
+    def release(self, key):
+        with self._lock:
+            for counter in (GLOBAL_KEY, key):
+                remaining = self._inflight.get(counter, 0) - 1
+                if remaining > 0:
+                    self._inflight[counter] = remaining
+                else:
+                    self._inflight.pop(counter, None)
+
+
+class CacheStore:
+    # State in the ADMISSION_CACHE cache, shared by every process pointed at
+    # the same Redis or memcached. In-flight counters use atomic incr/decr and
+    # expire after COUNTER_TTL idle seconds, so a crashed process cannot hold
+    # slots forever. The bucket is read-modify-write, so racing requests from
+    # one user can briefly exceed the rate. Every call is a round trip, so
+    # async callers make them from a worker thread.
+    COUNTER_TTL = 300
+    shared = True
+
+    def __init__(self, alias=None):
+        self.cache = caches[alias or settings.ADMISSION_CACHE]
+
+    def take_token(self, key, rate, burst):
+        cache_key = f'admission:tat:{key}'
+        now = time.time()
+        tat, wait = _gcra(self.cache.get(cache_key), now, rate, burst)
+        if tat is not None:
+            self.cache.set(cache_key, tat, timeout=math.ceil(tat - now) + 1)
+        return wait
+
+    def refund_token(self, key, rate):
+        cache_key = f'admission:tat:{key}'
+        tat = self.cache.get(cache_key)
+        if tat is not None:
+            self.cache.set(cache_key, tat - 1 / rate, timeout=max(1, math.ceil(tat - time.time())))
+
+    def _incr(self, counter):
+        self.cache.add(counter, 0, timeout=self.COUNTER_TTL)
+        try:
+            value = self.cache.incr(counter)
+        except ValueError:
+            self.cache.set(counter, 1, timeout=self.COUNTER_TTL)
+            value = 1
+        self.cache.touch(counter, self.COUNTER_TTL)
+        return value
+
+    def _decr(self, counter):
+        try:
+            self.cache.decr(counter)
+        except ValueError:
+            pass
+
+    def acquire(self, key, limit, global_limit):
+        taken = []
+        for counter, cap in (
+            (f'admission:inflight:{GLOBAL_KEY}', global_limit),
+            (f'admission:inflight:{key}', limit),
+        ):
+            taken.append(counter)
+            if self._incr(counter) > cap:
+                for held in taken:
+                    self._decr(held)
+                return False
+        return True
+
+    def release(self, key):
+        self._decr(f'admission:inflight:{GLOBAL_KEY}')
+        self._decr(f'admission:inflight:{key}')
+
+
+class Slot:
+    def __init__(self, controller, key):
+        self.controller = controller
+        self.key = key
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self.key, time.monotonic() - self.started)
+
+    async def arelease(self):
+        if not self.released:
+            self.released = True
+            await self.controller._call(self.controller._release, self.key, time.monotonic() - self.started)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.arelease()
+
+
+class _Waiter:
+    __slots__ = ('future', 'loop', 'granted')
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.granted = False
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        store,
+        rate,
+        burst,
+        user_concurrency,
+        global_concurrency,
+        queue_size,
+        user_queue_size,
+        poll_interval=0.5,
+    ):
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+        self.user_concurrency = user_concurrency
+        self.global_concurrency = global_concurrency
+        self.queue_size = queue_size
+        self.user_queue_size = user_queue_size
+        # Releases in this process hand slots to waiters directly; only a
+        # shared store's capacity, freed by other processes, is polled for.
+        self.poll_interval = poll_interval if store.shared else None
+        # Guards the queue and the estimates below. Store calls are never
+        # made while holding it.
+        self._lock = threading.Lock()
+        # user key -> waiters, in round-robin order: a user moves to the back
+        # each time one of their waiters is served.
+        self._waiting = OrderedDict()
+        self._queued = 0
+        # Moving average of slot hold time, for retry-after estimates.
+        self._hold_seconds = 1.0
+        self._dispatching = False
+        self._redispatch = False
+
+    async def _call(self, method, *args):
+        # Store calls that do I/O run off the event loop.
+        if self.store.shared:
+            return await sync_to_async(method, thread_sensitive=False)(*args)
+        return method(*args)
+
+    def _check_rate(self, key):
+        if self.rate:
+            wait = self.store.take_token(key, self.rate, self.burst)
+            if wait:
+                raise Rejected('rate_limited', wait)
+
+    def _refund_rate(self, key):
+        # A rejected request has not used the rate it was charged for.
+        if self.rate:
+            self.store.refund_token(key, self.rate)
+
+    def _queue_full(self, key):
+        waiters = self._waiting.get(key)
+        return self._queued >= self.queue_size or bool(waiters and len(waiters) >= self.user_queue_size)
+
+    def _acquire(self, key):
+        return self.store.acquire(key, self.user_concurrency, self.global_concurrency)
+
+    def _busy_retry_after(self):
+        with self._lock:
+            return self._hold_seconds * (self._queued + 1) / self.global_concurrency
+
+    def try_admit(self, user_id):
+        """Admit now or raise Rejected; for callers that cannot wait."""
+        key = str(user_id)
+        self._check_rate(key)
+        with self._lock:
+            queued = self._queued
+        if queued or not self._acquire(key):
+            self._refund_rate(key)
+            raise Rejected('busy', self._busy_retry_after())
+        return Slot(self, key)
+
+    async def admit(self, user_id, on_queued=None):
+        """Admit, waiting in the fair queue while the caps are full.
+
+        on_queued(position) is awaited once if the caller has to wait.
+        Raises Rejected when rate-limited or when the queue is full.
+        """
+        key = str(user_id)
+        # With others already waiting this request would queue, so a full
+        # queue turns it away before it is charged a rate token.
+        with self._lock:
+            full = bool(self._waiting) and self._queue_full(key)
+        if full:
+            raise Rejected('queue_full', self._busy_retry_after())
+        await self._call(self._check_rate, key)
+        with self._lock:
+            queued = bool(self._waiting)
+        if not queued and await self._call(self._acquire, key):
+            return Slot(self, key)
+        with self._lock:
+            full = self._queue_full(key)
+            if not full:
+                waiter = _Waiter(asyncio.get_running_loop())
+                self._waiting.setdefault(key, deque()).append(waiter)
+                self._queued += 1
+                position = self._position(key, waiter)
+        if full:
+            await self._call(self._refund_rate, key)
+            raise Rejected('queue_full', self._busy_retry_after())
+        try:
+            if on_queued is not None:
+                await on_queued(position)
+            # A slot may have been released since the acquire above failed.
+            await self._call(self._dispatch)
+            while not waiter.granted:
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), self.poll_interval)
+                except asyncio.TimeoutError:
+                    await self._call(self._dispatch)
+        except BaseException:
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._remove(key, waiter)
+            if granted:
+                await asyncio.shield(self._call(self._release, key, None))
+            raise
+        return Slot(self, key)
+
+    def _position(self, key, waiter):
+        # 1-based place in service order when each user gets one turn per round.
+        index = self._waiting[key].index(waiter)
+        ahead = index + 1
+        before = True
+        for other, waiters in self._waiting.items():
+            if other == key:
+                before = False
+                continue
+            ahead += min(len(waiters), index + 1 if before else index)
+        return ahead
+
+    def _remove(self, key, waiter):
+        waiters = self._waiting.get(key)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            self._queued -= 1
+            if not waiters:
+                del self._waiting[key]
+
+    def _dispatch(self):
+        # Hands free capacity to the first waiter of each user in turn; users
+        # at their own cap are skipped so they do not block everyone else.
+        # One pass runs at a time; a release during it makes it go round again.
+        with self._lock:
+            if self._dispatching:
+                self._redispatch = True
+                return
+            self._dispatching = True
+        try:
+            while True:
+                with self._lock:
+                    self._redispatch = False
+                    keys = list(self._waiting)
+                progress = False
+                for key in keys:
+                    with self._lock:
+                        if key not in self._waiting:
+                            continue
+                    if not self._acquire(key):
+                        continue
+                    with self._lock:
+                        waiter = self._grant(key)
+                    if waiter is None:
+                        # Its waiters gave up while the slot was being taken.
+                        self.store.release(key)
+                    else:
+                        progress = True
+                with self._lock:
+                    if not (self._redispatch or (progress and self._waiting)):
+                        self._dispatching = False
+                        return
+        except BaseException:
+            with self._lock:
+                self._dispatching = False
+            raise
+
+    def _grant(self, key):
+        waiters = self._waiting.pop(key, None)
+        if waiters is None:
+            return None
+        waiter = waiters.popleft()
+        self._queued -= 1
+        if waiters:
+            self._waiting[key] = waiters
+        waiter.granted = True
+        waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+        return waiter
+
+    def _release(self, key, held):
+        self.store.release(key)
+        with self._lock:
+            if held is not None:
+                self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * held
+            waiting = bool(self._waiting)
+        if waiting:
+            self._dispatch()
+
+
+def build_controller():
+    store = settings.ADMISSION_STORE
+    return AdmissionController(
+        store=import_string(STORES.get(store, store))(),
+        rate=settings.ADMISSION_RATE,
+        burst=settings.ADMISSION_BURST,
+        user_concurrency=settings.ADMISSION_USER_CONCURRENCY,
+        global_concurrency=settings.ADMISSION_GLOBAL_CONCURRENCY,
+        queue_size=settings.ADMISSION_QUEUE_SIZE,
+        user_queue_size=settings.ADMISSION_USER_QUEUE_SIZE,
+    )
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = build_controller()
+        return _controller
+
+
+@receiver(setting_changed)
+def _reset_controller(setting, **kwargs):
+    global _controller
+    if setting.startswith('ADMISSION_'):
+        with _controller_lock:
+            _controller = None
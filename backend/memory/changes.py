@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+
+from .events import PUBLISH_TIMEOUT, user_group
+
+# Change events for a user's open sockets, so clients patch the lists they
+# hold instead of refetching them after every action. memory.signals records
+# one after commit for each Project, ChatMessage, DesignVersion and
+# Preference write:
+#
+#   {'entity': 'message', 'id': 42, 'op': 'created', 'version': ..., 'project_id': 7}
+#
+# `version` is the write's time in microseconds (the row's updated_at where
+# it has one), so a client keeps the highest it has seen per (entity, id)
+# and ignores anything older. ChangeFeed holds events per user for
+# CHAT_CHANGE_WINDOW seconds, one per (entity, id), and then sends them all
+# as a single 'user.changes' message to user_<id>; ChatConsumer forwards it
+# as a 'changes' frame. More than CHAT_CHANGE_MAX_EVENTS in one window sends
+# {'reset': True} instead, and the client reloads.
+
+
+def change_event(entity, instance, op, project_id=None, updated_at=None):
+    version = int(updated_at.timestamp() * 1_000_000) if updated_at else time.time_ns() // 1000
+    event = {'entity': entity, 'id': instance.pk, 'op': op, 'version': version}
+    if project_id is not None:
+        event['project_id'] = project_id
+    return event
+
+
+def record_change(user_id, event):
+    # After commit, so a client that fetches on the event sees the write.
+    transaction.on_commit(lambda: change_feed().add(user_id, event))
+
+
+def _merge(previous, event):
+    if previous is None:
+        return event
+    merged = {**event, 'version': max(previous['version'], event['version'])}
+    if 'deleted' in (previous['op'], event['op']):
+        merged['op'] = 'deleted'
+    elif previous['op'] == 'created':
+        # Still news to the client, whatever happened to it since.
+        merged['op'] = 'created'
+    return merged
+
+
+class ChangeFeed:
+    def __init__(self, window, max_events):
+        self.window = window
+        self.max_events = max_events
+        self.loop = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+
+    def bind(self, loop):
+        # The server's event loop; the in-memory layer's queues belong to it.
+        self.loop = loop
+
+    def add(self, user_id, event):
+        with self._lock:
+            events = self._pending.setdefault(user_id, {})
+            key = (event['entity'], event['id'])
+            events[key] = _merge(events.get(key), event)
+            if self._timer is None and self.window:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if not self.window:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        messages = {user_id: self._message(events) for user_id, events in pending.items()}
+        if messages:
+            self._send(messages)
+
+    def _message(self, events):
+        # Children of a project deleted in the same window went with it.
+        gone = {key[1] for key, event in events.items() if key[0] == 'project' and event['op'] == 'deleted'}
+        events = [
+            event
+            for event in events.values()
+            if event['entity'] == 'project' or event.get('project_id') not in gone
+        ]
+        if len(events) > self.max_events:
+            return {'type': 'user.changes', 'reset': True}
+        return {'type': 'user.changes', 'events': events}
+
+    def _send(self, messages):
+        layer = get_channel_layer()
+        if layer is None:
+            return
+        groups = {user_group(user_id): message for user_id, message in messages.items()}
+        if isinstance(layer, InMemoryChannelLayer):
+            groups = {group: message for group, message in groups.items() if layer.groups.get(group)}
+            if not groups:
+                return
+
+        async def send():
+            for group, message in groups.items():
+                await layer.group_send(group, message)
+
+        loop = self.loop
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(send(), loop).result(PUBLISH_TIMEOUT)
+        else:
+            async_to_sync(send)()
+
+
+_feed = None
+_feed_lock = threading.Lock()
+
+
+def change_feed():
+    global _feed
+    with _feed_lock:
+        if _feed is None:
+            _feed = ChangeFeed(settings.CHAT_CHANGE_WINDOW, settings.CHAT_CHANGE_MAX_EVENTS)
+        return _feed
+
+
+@receiver(setting_changed)
+def _reset_feed(setting, **kwargs):
+    global _feed
+    if setting.startswith('CHAT_CHANGE_'):
+        with _feed_lock:
+            _feed = None
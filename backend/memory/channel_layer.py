@@ -0,0 +1,357 @@
+import asyncio
+import base64
+import json
+import logging
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.db import connections
+
+from .models import ChannelGroup, ChannelMessage
+
+logger = logging.getLogger(__name__)
+
+# A channel layer on the project database, so several ASGI worker processes
+# can share groups without Redis. Sends append rows to memory_channelmessage
+# (group_send fans out with one INSERT ... SELECT over memory_channelgroup);
+# each process claims the rows for its own channels in batches with
+# DELETE ... RETURNING, from a poller task on the event loop. A claim takes
+# no more rows per channel than its local queue has room for; the rest wait
+# in the table, where they count towards `capacity`. On Postgres
+# senders also NOTIFY, and with psycopg 3 installed the poller LISTENs, so
+# delivery does not wait for the next poll. Rows past their expiry are
+# skipped on delivery and swept every `expiry` seconds; `capacity` caps the
+# rows waiting per channel.
+#
+# All database work runs on one thread per process, with its own connection.
+
+NOTIFY_CHANNEL = 'memory_channel_layer'
+
+
+def _default(value):
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _object_hook(data):
+    if len(data) == 1 and '__bytes__' in data:
+        return base64.b64decode(data['__bytes__'])
+    return data
+
+
+def encode(message):
+    return json.dumps(message, default=_default, separators=(',', ':'))
+
+
+def decode(payload):
+    return json.loads(payload, object_hook=_object_hook)
+
+
+class DatabaseChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(
+        self,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        poll_interval=0.05,
+        batch_size=500,
+        database='default',
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.database = database
+        self.client_prefix = uuid.uuid4().hex[:12]
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='channel-layer')
+        self._local_groups = {}
+        self._reset(None)
+
+    def _reset(self, loop):
+        # Receive state belongs to one event loop, like the queues in it.
+        self._loop = loop
+        self._queues = {}
+        # channel -> latest expires_at put in its queue
+        self._expires = {}
+        self._waiters = Counter()
+        self._specific_inboxes = set()
+        self._wake = asyncio.Event()
+        self._poller = None
+        self._listener = None
+
+    # Database side, run on the layer's thread.
+
+    async def _db(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, function, args)
+
+    def _call(self, function, args):
+        connection = connections[self.database]
+        try:
+            return function(connection, *args)
+        except Exception:
+            connection.close()
+            raise
+
+    def _table(self, model):
+        return connections[self.database].ops.quote_name(model._meta.db_table)
+
+    def _insert(self, connection, channel, payload, expires_at, capacity):
+        messages = self._table(ChannelMessage)
+        inbox = self.non_local_name(channel)
+        with connection.cursor() as cursor:
+            # One statement, so the capacity check and the insert are atomic.
+            cursor.execute(
+                f'INSERT INTO {messages} (inbox, channel, payload, expires_at) '
+                f'SELECT %s, %s, %s, %s WHERE (SELECT COUNT(*) FROM {messages} WHERE channel = %s) < %s',
+                [inbox, channel, payload, expires_at, channel, capacity],
+            )
+            sent = cursor.rowcount > 0
+            if sent and connection.vendor == 'postgresql':
+                cursor.execute('SELECT pg_notify(%s, %s)', [NOTIFY_CHANNEL, inbox])
+        return sent
+
+    def _fan_out(self, connection, group, payload, now):
+        messages, groups = self._table(ChannelMessage), self._table(ChannelGroup)
+        with connection.cursor() as cursor:
+            # Members already at capacity are skipped, as in the Redis layer.
+            cursor.execute(
+                f'INSERT INTO {messages} (inbox, channel, payload, expires_at) '
+                f'SELECT g.inbox, g.channel, %s, %s FROM {groups} g '
+                f'WHERE g.group_name = %s AND g.expires_at > %s '
+                f'AND (SELECT COUNT(*) FROM {messages} m WHERE m.channel = g.channel) < %s',
+                [payload, now + self.expiry, group, now, self.capacity],
+            )
+            if cursor.rowcount > 0 and connection.vendor == 'postgresql':
+                cursor.execute(
+                    f'SELECT pg_notify(%s, inbox) FROM (SELECT DISTINCT inbox FROM {groups} '
+                    f'WHERE group_name = %s) AS inboxes',
+                    [NOTIFY_CHANNEL, group],
+                )
+
+    def _claim(self, connection, inboxes, room, default_room, limit):
+        # Up to room[channel] rows per channel (default_room for the rest),
+        # oldest first; a channel's place in line comes from ROW_NUMBER().
+        messages = self._table(ChannelMessage)
+        marks = ', '.join(['%s'] * len(inboxes))
+        cap = '%s'
+        if room:
+            cap = f"CASE channel {' '.join(['WHEN %s THEN %s'] * len(room))} ELSE %s END"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {messages} WHERE id IN ('
+                f'SELECT id FROM ('
+                f'SELECT id, channel, ROW_NUMBER() OVER (PARTITION BY channel ORDER BY id) AS position '
+                f'FROM {messages} WHERE inbox IN ({marks})'
+                f') ranked WHERE position <= {cap} ORDER BY id LIMIT %s'
+                f') RETURNING id, channel, payload, expires_at',
+                [*inboxes, *[value for item in room.items() for value in item], default_room, limit],
+            )
+            return sorted(cursor.fetchall())
+
+    def _sweep(self, connection, now):
+        ChannelMessage.objects.using(self.database).filter(expires_at__lt=now).delete()
+        ChannelGroup.objects.using(self.database).filter(expires_at__lt=now).delete()
+
+    def _add(self, connection, group, channel, expires_at):
+        ChannelGroup.objects.using(self.database).bulk_create(
+            [
+                ChannelGroup(
+                    group_name=group,
+                    channel=channel,
+                    inbox=self.non_local_name(channel),
+                    expires_at=expires_at,
+                )
+            ],
+            update_conflicts=True,
+            unique_fields=['group_name', 'channel'],
+            update_fields=['expires_at'],
+        )
+
+    def _discard(self, connection, group, channel):
+        ChannelGroup.objects.using(self.database).filter(group_name=group, channel=channel).delete()
+
+    def _flush(self, connection):
+        ChannelMessage.objects.using(self.database).all().delete()
+        ChannelGroup.objects.using(self.database).all().delete()
+
+    # Channel layer API.
+
+    async def new_channel(self, prefix='specific'):
+        return f'{prefix}.{self.client_prefix}!{uuid.uuid4().hex}'
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel)
+        sent = await self._db(
+            self._insert,
+            channel,
+            encode(message),
+            time.time() + self.expiry,
+            self.get_capacity(channel),
+        )
+        if not sent:
+            raise ChannelFull(channel)
+        if self.non_local_name(channel) in self._specific_inboxes:
+            self._wake_poller()
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group)
+        assert self.valid_channel_name(channel)
+        await self._db(self._add, group, channel, time.time() + self.group_expiry)
+        self._local_groups.setdefault(group, set()).add(channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group)
+        assert self.valid_channel_name(channel)
+        await self._db(self._discard, group, channel)
+        members = self._local_groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self._local_groups[group]
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_group_name(group)
+        await self._db(self._fan_out, group, encode(message), time.time())
+        if group in self._local_groups:
+            self._wake_poller()
+
+    async def flush(self):
+        await self._db(self._flush)
+        self._local_groups = {}
+        for queue in self._queues.values():
+            while not queue.empty():
+                queue.get_nowait()
+        self._expires.clear()
+
+    async def close(self):
+        for task in (self._poller, self._listener):
+            if task is not None:
+                task.cancel()
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._reset(loop)
+        if '!' in channel:
+            self._specific_inboxes.add(self.non_local_name(channel))
+        queue = self._queue(channel)
+        self._waiters[channel] += 1
+        self._start_poller()
+        try:
+            while True:
+                expires_at, message = await queue.get()
+                if expires_at > time.time():
+                    return message
+        finally:
+            self._waiters[channel] -= 1
+            if not self._waiters[channel]:
+                del self._waiters[channel]
+                if queue.empty():
+                    self._queues.pop(channel, None)
+                    self._expires.pop(channel, None)
+
+    # Receive side, on the event loop.
+
+    def _queue(self, channel):
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = asyncio.Queue(self.get_capacity(channel))
+        return queue
+
+    def _wake_poller(self):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _start_poller(self):
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll())
+        if self._listener is None and connections[self.database].vendor == 'postgresql':
+            self._listener = asyncio.ensure_future(self._listen())
+
+    def _room(self):
+        # Free places per local queue. Channels without a queue get the
+        # smallest capacity, so whichever capacity applies, a claim fits.
+        default_room = min([self.capacity, *(capacity for _, capacity in self.channel_capacity)])
+        room = {}
+        for channel, queue in self._queues.items():
+            free = queue.maxsize - queue.qsize()
+            if free != default_room:
+                room[channel] = free
+        return room, default_room
+
+    def _inboxes(self):
+        # This process's specific channels, and plain channels someone here
+        # is waiting on; rows for other plain channels stay for others.
+        return self._specific_inboxes | {channel for channel in self._waiters if '!' not in channel}
+
+    async def _poll(self):
+        next_sweep = 0
+        while self._waiters:
+            now = time.time()
+            self._wake.clear()
+            try:
+                if now >= next_sweep:
+                    next_sweep = now + self.expiry
+                    await self._db(self._sweep, now)
+                    self._drop_idle_queues(now)
+                room, default_room = self._room()
+                rows = await self._db(self._claim, sorted(self._inboxes()), room, default_room, self.batch_size)
+            except Exception:
+                logger.exception('channel layer poll failed')
+                await asyncio.sleep(self.poll_interval)
+                continue
+            now = time.time()
+            for _, channel, payload, expires_at in rows:
+                if expires_at > now:
+                    self._deliver(channel, expires_at, payload)
+            if len(rows) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _deliver(self, channel, expires_at, payload):
+        # _claim took only what fits, and only this task fills the queues.
+        self._queue(channel).put_nowait((expires_at, decode(payload)))
+        self._expires[channel] = max(expires_at, self._expires.get(channel, 0))
+
+    def _drop_idle_queues(self, now):
+        # Queues of channels nobody receives on any more, e.g. closed sockets
+        # still in a group, once everything in them has expired.
+        for channel in list(self._queues):
+            if channel not in self._waiters and self._expires.get(channel, 0) <= now:
+                del self._queues[channel]
+                self._expires.pop(channel, None)
+
+    async def _listen(self):
+        try:
+            import psycopg
+        except ImportError:
+            return
+        params = connections[self.database].get_connection_params()
+        params.pop('cursor_factory', None)
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(**params, autocommit=True) as connection:
+                    await connection.execute(f'LISTEN {NOTIFY_CHANNEL}')
+                    async for notify in connection.notifies():
+                        if notify.payload in self._inboxes():
+                            self._wake.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('channel layer LISTEN failed; polling until it reconnects')
+                await asyncio.sleep(1)
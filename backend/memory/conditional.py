@@ -0,0 +1,80 @@
+import hashlib
+import logging
+import threading
+from collections import defaultdict
+
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework import status
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+# Emit an INFO hit-rate summary per endpoint every this many conditional GETs.
+STATS_LOG_EVERY = 100
+
+_stats_lock = threading.Lock()
+_stats = defaultdict(lambda: {'requests': 0, 'hits': 0})
+
+
+def make_etag(*parts):
+    digest = hashlib.md5('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    return f'W/"{digest}"'
+
+
+def _etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    opaque = etag.removeprefix('W/')
+    return any(
+        candidate.strip().removeprefix('W/') == opaque
+        for candidate in header.split(',')
+    )
+
+
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return _etag_matches(if_none_match, etag)
+    if last_modified is not None:
+        since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+        return since is not None and int(last_modified.timestamp()) <= since
+    return False
+
+
+def _record(endpoint, hit):
+    with _stats_lock:
+        stats = _stats[endpoint]
+        stats['requests'] += 1
+        stats['hits'] += int(hit)
+        requests, hits = stats['requests'], stats['hits']
+    logger.debug('conditional GET %s hit=%s', endpoint, hit)
+    if requests % STATS_LOG_EVERY == 0:
+        logger.info(
+            'conditional GET %s: %d/%d not-modified (%.1f%% hit rate)',
+            endpoint,
+            hits,
+            requests,
+            100.0 * hits / requests,
+        )
+
+
+def get_stats():
+    with _stats_lock:
+        return {endpoint: dict(stats) for endpoint, stats in _stats.items()}
+
+
+def conditional_response(request, endpoint, etag, render, last_modified=None):
+    # `render` is only called on a miss, so a 304 skips querying and
+    # serializing the payload entirely.
+    hit = _not_modified(request, etag, last_modified)
+    _record(endpoint, hit)
+    if hit:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = render()
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
@@ -1,99 +1,315 @@
+import asyncio
+import itertools
 import json
+import logging
+import uuid
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from rest_framework.authtoken.models import Token
 
-from .models import ChatMessage, Project
-from .retrieval import resolve_context
-from .llm import generate_agent_response
+from .admission import Rejected, get_controller
+from .changes import change_feed
+from .events import project_group, user_group
+from .framing import CODECS, DECODE_ERRORS, assistant_frame, drop_context, negotiate, wants_context
+from .pipeline import StageTimings, arun_turn
+from .replay import find_cursor, recent_messages, replay_page, serialize_messages
+from .routers import read_scope
+from .sessions import ChatSession
+from .sockets import HEARTBEAT_CLOSE_CODE, IDLE_CLOSE_CODE, SocketStats, sockets
+from .writebehind import get_writer
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
+
+
+class Turn:
+    # One user_message being answered, run as its own task so the consumer
+    # keeps reading frames (cancel, newer messages) while the LLM works.
+    def __init__(self, turn_id, message, client_id=None):
+        self.id = turn_id
+        self.message = message
+        self.client_id = client_id
+        self.task = None
+        self.cancel_reason = None
+        self.timings = StageTimings()
+
+    def wasted_llm_seconds(self):
+        # LLM time spent on a turn that was cancelled before it returned.
+        return self.timings.running('generate')
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    # Until connect() has negotiated otherwise; see memory.framing.
+    codec = CODECS['json']
+    include_context = True
+    stats = None
+    heartbeat = None
+
     async def connect(self):
         params = self.scope['query_string'].decode()
         query = dict(q.split('=') for q in params.split('&') if '=' in q)
         token_key = query.get('token')
         self.project_id = query.get('project_id')
+        self.codec = negotiate(query.get('encoding'))
+        self.include_context = wants_context(query.get('include_context'), self.codec)
         self.user = await self._get_user(token_key)
         if not self.user:
             await self.close()
             return
-        if not await self._project_belongs_to_user(self.project_id, self.user.id):
+        if not self.project_id or not self.project_id.isdigit():
+            await self.close()
+            return
+        # Join before loading so no invalidation can slip in between. The
+        # base class discards self.groups on disconnect.
+        for group in (project_group(self.project_id), user_group(self.user.id)):
+            self.groups.append(group)
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.session = await database_sync_to_async(ChatSession(self.user, self.project_id).refresh)()
+        if self.session.project is None:
             await self.close()
             return
         await self.accept()
-        await self.send_json({'type': 'connected'})
+        change_feed().bind(asyncio.get_running_loop())
+        self.turns = {}
+        self.turn_ids = itertools.count(1)
+        self.cancelled_turns = 0
+        self.wasted_llm_seconds = 0.0
+        self.stats = SocketStats(self)
+        sockets().add(self.stats)
+        for stale in sockets().excess_idle(self.user.id, settings.CHAT_IDLE_CONNECTIONS_PER_USER):
+            await stale.consumer.reap(IDLE_CLOSE_CODE, 'idle')
+        if settings.CHAT_HEARTBEAT_SECONDS:
+            self.heartbeat = asyncio.create_task(self._heartbeat())
+        canonical = self.session.canonical_version
+        await self.send_json(
+            {
+                'type': 'connected',
+                'canonical_version_id': canonical.id if canonical else None,
+                'last_message_id': self.session.project.last_message_id,
+                'encoding': self.codec.name,
+                'include_context': self.include_context,
+            }
+        )
+        last_message_id = query.get('last_message_id', '')
+        if last_message_id.isdigit():
+            await self._replay(int(last_message_id))
+
+    async def _replay(self, message_id):
+        # Only the messages after the client's last one; see memory.replay.
+        project = self.session.project
+        messages = recent_messages().after(project.id, message_id, project.last_message_id)
+        if messages is not None:
+            await self.send_json(
+                {
+                    'type': 'replay',
+                    'source': 'buffer',
+                    'messages': self._replayed(serialize_messages(messages)),
+                    'has_more': False,
+                }
+            )
+            return
+        cursor = await database_sync_to_async(find_cursor)(project.id, message_id)
+        if cursor is None:
+            # Not a message of this project (deleted, or never was): the
+            # client has to reload the history.
+            await self.send_json(
+                {'type': 'replay', 'source': 'database', 'messages': [], 'has_more': False, 'reset': True}
+            )
+            return
+        has_more = True
+        while has_more:
+            data, has_more, cursor = await database_sync_to_async(replay_page)(project.id, cursor)
+            await self.send_json(
+                {
+                    'type': 'replay',
+                    'source': 'database',
+                    'messages': self._replayed(data),
+                    'has_more': has_more,
+                }
+            )
+
+    def _replayed(self, messages):
+        if self.include_context:
+            return messages
+        return [{**message, 'metadata_json': drop_context(message['metadata_json'])} for message in messages]
+
+    async def _heartbeat(self):
+        # Application-level ping; the ASGI server's own pings never reach
+        # the consumer, so a half-open socket would otherwise live forever.
+        while True:
+            await asyncio.sleep(settings.CHAT_HEARTBEAT_SECONDS)
+            if self.stats.silent_for() > settings.CHAT_HEARTBEAT_TIMEOUT:
+                await self.reap(HEARTBEAT_CLOSE_CODE, 'heartbeat')
+                return
+            try:
+                await self.send_json({'type': 'ping'})
+            except Exception:
+                await self.reap(HEARTBEAT_CLOSE_CODE, 'send failed')
+                return
+
+    async def reap(self, code, reason):
+        # Close from our side and release everything now: a half-open
+        # socket may never deliver the disconnect that would.
+        logger.info('reaping chat socket user=%s project=%s reason=%s', self.user.id, self.project_id, reason)
+        sockets().remove(self.channel_name)
+        if self.heartbeat is not None and self.heartbeat is not asyncio.current_task():
+            self.heartbeat.cancel()
+        self._cancel(list(self.turns.values()), 'disconnect')
+        for group in self.groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        await self.close(code)
 
     async def disconnect(self, close_code):
-        return
+        sockets().remove(self.channel_name)
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+        turns = list(getattr(self, 'turns', {}).values())
+        if not turns and not getattr(self, 'cancelled_turns', 0):
+            return
+        self._cancel(turns, 'disconnect')
+        await asyncio.gather(*(turn.task for turn in turns), return_exceptions=True)
+        logger.info(
+            'chat session user=%s project=%s cancelled_turns=%s wasted_llm_seconds=%.2f',
+            self.user.id,
+            self.project_id,
+            self.cancelled_turns,
+            self.wasted_llm_seconds,
+        )
+
+    async def project_event(self, event):
+        # Frames published with memory.events.publish.
+        await self.send_json(event['frame'])
+
+    async def session_invalidate(self, event):
+        self.session.invalidate(event['parts'])
+
+    async def user_changes(self, event):
+        # Coalesced change events for the user's projects; see memory.changes.
+        if event.get('reset'):
+            await self.send_json({'type': 'changes', 'reset': True})
+        else:
+            await self.send_json({'type': 'changes', 'events': event['events']})
 
     async def receive(self, text_data=None, bytes_data=None):
+        self.stats.received(text_data if bytes_data is None else bytes_data)
         try:
-            payload = json.loads(text_data or '{}')
-        except json.JSONDecodeError:
+            if bytes_data is not None:
+                payload = self.codec.decode(bytes_data)
+            else:
+                payload = json.loads(text_data or '{}')
+        except DECODE_ERRORS:
+            # Malformed text, or binary that is not the negotiated encoding.
+            return
+        if not isinstance(payload, dict) or payload.get('type') == 'pong':
+            return
+        self.stats.active()
+        if payload.get('type') == 'cancel':
+            turn_id = payload.get('turn_id')
+            self._cancel(
+                [turn for turn in self.turns.values() if turn_id in (None, turn.id)],
+                'client',
+            )
             return
         if payload.get('type') != 'user_message':
             return
         message = payload.get('message', '')
         if not message or not self.project_id:
             return
-        await self.send_json({'type': 'thinking'})
-        await self._handle_agent_flow(message)
-
-    async def _handle_agent_flow(self, message):
-        user = self.user
-        project = await self._get_project(self.project_id)
-        if not project:
-            await self.send_json({'type': 'error', 'detail': 'Project not found'})
-            return
-        user_chat = await self._create_chat_message(
-            user=user,
-            project=project,
-            role='user',
-            content=message,
-        )
-        context = await database_sync_to_async(resolve_context)(
-            user_id=user.id,
-            message=message,
-            project_id=project.id,
-        )
+        # The client may name the reply up front, so it can match the
+        # assistant_message and message_saved frames to its placeholder.
+        client_id = None
+        if payload.get('client_id') is not None:
+            try:
+                client_id = uuid.UUID(str(payload['client_id']))
+            except ValueError:
+                await self.send_json({'type': 'error', 'detail': 'client_id must be a UUID'})
+                return
+        if len(self.turns) >= settings.CHAT_TURNS_IN_FLIGHT:
+            if not payload.get('supersede'):
+                await self.send_json({'type': 'busy', 'in_flight': list(self.turns)})
+                return
+            self._cancel(list(self.turns.values()), 'superseded')
+        turn = Turn(next(self.turn_ids), message, client_id)
+        self.turns[turn.id] = turn
+        turn.task = asyncio.create_task(self._run_turn(turn))
+
+    def _cancel(self, turns, reason):
+        for turn in turns:
+            if turn.cancel_reason is None:
+                turn.cancel_reason = reason
+                turn.task.cancel()
+
+    async def _run_turn(self, turn):
+        async def send_queued(position):
+            await self.send_json({'type': 'queued', 'turn_id': turn.id, 'position': position})
+
         try:
-            llm_payload = await database_sync_to_async(generate_agent_response)(context, message)
+            try:
+                slot = await get_controller().admit(self.user.id, on_queued=send_queued)
+            except Rejected as exc:
+                await self.send_json(
+                    {
+                        'type': 'throttled',
+                        'turn_id': turn.id,
+                        'reason': exc.reason,
+                        'retry_after': exc.retry_after_seconds,
+                    }
+                )
+                return
+            async with slot:
+                await self.send_json({'type': 'thinking', 'turn_id': turn.id})
+                await self._handle_agent_flow(turn)
+        except asyncio.CancelledError:
+            wasted = turn.wasted_llm_seconds()
+            self.cancelled_turns += 1
+            self.wasted_llm_seconds += wasted
+            if turn.cancel_reason not in (None, 'disconnect'):
+                await self.send_json(
+                    {
+                        'type': 'cancelled',
+                        'turn_id': turn.id,
+                        'reason': turn.cancel_reason,
+                        'wasted_llm_seconds': round(wasted, 3),
+                    }
+                )
         except Exception:
-            llm_payload = {
-                'reply': 'I hit a snag generating a full response, but I can still help.',
-                'design_options': [],
-                'version_action': {'type': 'none'},
-                'preference_hints': [],
-            }
+            logger.exception('chat turn %s failed', turn.id)
+            await self.send_json({'type': 'error', 'turn_id': turn.id, 'detail': 'Turn failed'})
+        finally:
+            self.turns.pop(turn.id, None)
 
-        assistant = await self._create_chat_message(
-            user=user,
-            project=project,
-            role='assistant',
-            content=llm_payload.get('reply', ''),
-            metadata={
-                'design_options': llm_payload.get('design_options', []),
-                'resolved_context': context,
-                'version_id': None,
-            },
-        )
-        await self.send_json(
-            {
-                'type': 'assistant_message',
-                'message_id': assistant.id,
-                'content': assistant.content,
-                'metadata_json': assistant.metadata_json,
-                'created_at': assistant.created_at.isoformat(),
-            }
-        )
+    async def _handle_agent_flow(self, turn):
+        session = self.session
+        if session.stale:
+            await database_sync_to_async(session.refresh)()
+        if not session.project:
+            await self.send_json({'type': 'error', 'turn_id': turn.id, 'detail': 'Project not found'})
+            return
+        # The session's rows outlive the turn, so refresh() above reads the
+        # primary; the turn's own reads may use the replica until it writes.
+        with read_scope():
+            assistant = await arun_turn(
+                self.user,
+                session.project,
+                turn.message,
+                session=session,
+                timings=turn.timings,
+                writer=get_writer(),
+                client_id=turn.client_id,
+            )
+        await self.send_json(assistant_frame(turn.id, assistant, self.include_context))
 
     async def send_json(self, data):
-        await self.send(text_data=json.dumps(data))
+        encoded = self.codec.encode(data)
+        if self.stats is not None:
+            self.stats.sent(encoded)
+        if self.codec.binary:
+            await self.send(bytes_data=encoded)
+        else:
+            await self.send(text_data=encoded)
 
     @database_sync_to_async
     def _get_user(self, token_key):
@@ -101,21 +317,3 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return None
         token = Token.objects.filter(key=token_key).select_related('user').first()
         return token.user if token else None
-
-    @database_sync_to_async
-    def _project_belongs_to_user(self, project_id, user_id):
-        return Project.objects.filter(id=project_id, user_id=user_id).exists()
-
-    @database_sync_to_async
-    def _get_project(self, project_id):
-        return Project.objects.filter(id=project_id).first()
-
-    @database_sync_to_async
-    def _create_chat_message(self, user, project, role, content, metadata=None):
-        return ChatMessage.objects.create(
-            user=user,
-            project=project,
-            role=role,
-            content=content,
-            metadata_json=metadata or {},
-        )
@@ -0,0 +1,64 @@
+import asyncio
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.db import transaction
+
+# Server-initiated messages for open sockets. ChatConsumer joins
+# project_group() and user_group() on connect, forwards 'project.event'
+# frames to the client and applies 'session.invalidate' to its ChatSession.
+
+PUBLISH_TIMEOUT = 5
+
+
+def project_group(project_id):
+    return f'project_{project_id}'
+
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+
+def publish(project_id, frame, loop=None):
+    """Send a frame to the project's sockets from synchronous code.
+
+    Pass the server's event loop when calling from a worker thread: the
+    in-memory channel layer's queues belong to that loop and are not safe to
+    feed from a second one.
+    """
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    group = project_group(project_id)
+    message = {'type': 'project.event', 'frame': frame}
+    if loop is not None and loop.is_running():
+        future = asyncio.run_coroutine_threadsafe(layer.group_send(group, message), loop)
+        future.result(PUBLISH_TIMEOUT)
+    else:
+        async_to_sync(layer.group_send)(group, message)
+
+
+def invalidate_sessions(parts, project_ids=(), user_ids=()):
+    # Sent after commit so a consumer that reloads at once sees the new rows.
+    groups = [project_group(project_id) for project_id in set(project_ids)]
+    groups += [user_group(user_id) for user_id in set(user_ids)]
+    if groups:
+        transaction.on_commit(lambda: _send_invalidations(groups, list(parts)))
+
+
+def _send_invalidations(groups, parts):
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    if isinstance(layer, InMemoryChannelLayer):
+        # Skip the event-loop hop when no socket in this process is listening.
+        groups = [group for group in groups if layer.groups.get(group)]
+        if not groups:
+            return
+    message = {'type': 'session.invalidate', 'parts': parts}
+
+    async def send():
+        for group in groups:
+            await layer.group_send(group, message)
+
+    async_to_sync(send)()
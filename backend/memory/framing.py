@@ -0,0 +1,223 @@
+import json
+import struct
+import zlib
+
+# Wire encodings for ChatConsumer frames. A client asks with
+# ?encoding=<name>[,<name>...] and gets the first one this server has, or
+# 'json'; the 'connected' frame says which. Text frames are always JSON,
+# binary frames are always the negotiated encoding, so a client can tell
+# them apart without state.
+#
+#   json          text frames, as before
+#   json-deflate  JSON, zlib-compressed per frame (DecompressionStream('deflate'))
+#   cbor          RFC 8949 subset: ints, floats, text, bytes, arrays, maps,
+#                 true/false/null; no tags or indefinite lengths on output
+#   msgpack       only when the msgpack package is installed
+#
+# Independently of the encoding, ?include_context=false drops
+# metadata_json['resolved_context'] from assistant_message and replay
+# frames. It is kept by default for json and dropped for the others.
+
+DEFLATE_LEVEL = 6
+# Largest frame a client may send once inflated; a small deflate frame can
+# otherwise expand to gigabytes.
+MAX_FRAME = 1 << 20
+# What decoding a malformed client frame raises, with any codec. The CBOR
+# decoder indexes and unpacks past the end of truncated input; deep nesting
+# exhausts the recursion limit in every decoder.
+DECODE_ERRORS = (ValueError, TypeError, IndexError, struct.error, zlib.error, RecursionError)
+
+
+def _head(out, major, value):
+    if value < 24:
+        out.append(major << 5 | value)
+    elif value < 0x100:
+        out.append(major << 5 | 24)
+        out.append(value)
+    elif value < 0x10000:
+        out.append(major << 5 | 25)
+        out += value.to_bytes(2, 'big')
+    elif value < 0x100000000:
+        out.append(major << 5 | 26)
+        out += value.to_bytes(4, 'big')
+    elif value < 0x10000000000000000:
+        out.append(major << 5 | 27)
+        out += value.to_bytes(8, 'big')
+    else:
+        raise ValueError(f'{value} does not fit in a CBOR integer')
+
+
+def _encode(out, value):
+    if isinstance(value, str):
+        data = value.encode('utf-8')
+        _head(out, 3, len(data))
+        out += data
+    elif value is None:
+        out.append(0xF6)
+    elif value is True:
+        out.append(0xF5)
+    elif value is False:
+        out.append(0xF4)
+    elif isinstance(value, int):
+        if value >= 0:
+            _head(out, 0, value)
+        else:
+            _head(out, 1, -1 - value)
+    elif isinstance(value, float):
+        # Single precision when it round-trips exactly, as most scores do not.
+        try:
+            single = struct.pack('>f', value)
+        except OverflowError:
+            single = None
+        if single is not None and struct.unpack('>f', single)[0] == value:
+            out.append(0xFA)
+            out += single
+        else:
+            out.append(0xFB)
+            out += struct.pack('>d', value)
+    elif isinstance(value, dict):
+        _head(out, 5, len(value))
+        for key, item in value.items():
+            _encode(out, key)
+            _encode(out, item)
+    elif isinstance(value, (list, tuple)):
+        _head(out, 4, len(value))
+        for item in value:
+            _encode(out, item)
+    elif isinstance(value, (bytes, bytearray)):
+        _head(out, 2, len(value))
+        out += value
+    else:
+        raise TypeError(f'{type(value).__name__} is not CBOR serializable')
+
+
+def cbor_dumps(value):
+    out = bytearray()
+    _encode(out, value)
+    return bytes(out)
+
+
+_SIMPLE = {20: False, 21: True, 22: None, 23: None}
+_FLOATS = {25: '>e', 26: '>f', 27: '>d'}
+
+
+def _decode(data, offset):
+    initial = data[offset]
+    offset += 1
+    major, info = initial >> 5, initial & 0x1F
+    if major == 7:
+        if info in _SIMPLE:
+            return _SIMPLE[info], offset
+        if info in _FLOATS:
+            size = struct.calcsize(_FLOATS[info])
+            return struct.unpack(_FLOATS[info], data[offset : offset + size])[0], offset + size
+        raise ValueError(f'unsupported CBOR simple value {info}')
+    if info < 24:
+        argument = info
+    elif info < 28:
+        size = 1 << (info - 24)
+        argument = int.from_bytes(data[offset : offset + size], 'big')
+        offset += size
+    else:
+        raise ValueError('indefinite-length CBOR items are not supported')
+    if major == 0:
+        return argument, offset
+    if major == 1:
+        return -1 - argument, offset
+    if major == 2:
+        return bytes(data[offset : offset + argument]), offset + argument
+    if major == 3:
+        return bytes(data[offset : offset + argument]).decode('utf-8'), offset + argument
+    if major == 4:
+        items = []
+        for _ in range(argument):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return items, offset
+    if major == 5:
+        mapping = {}
+        for _ in range(argument):
+            key, offset = _decode(data, offset)
+            mapping[key], offset = _decode(data, offset)
+        return mapping, offset
+    # Tag: the tagged item stands for itself.
+    return _decode(data, offset)
+
+
+def cbor_loads(data):
+    value, offset = _decode(memoryview(data), 0)
+    if offset != len(data):
+        raise ValueError('trailing bytes after CBOR item')
+    return value
+
+
+class Codec:
+    def __init__(self, name, binary, encode, decode):
+        self.name = name
+        self.binary = binary
+        self.encode = encode
+        self.decode = decode
+
+
+def _deflate(data):
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'), DEFLATE_LEVEL)
+
+
+def _inflate(data):
+    inflater = zlib.decompressobj()
+    raw = inflater.decompress(data, MAX_FRAME)
+    if inflater.unconsumed_tail:
+        raise ValueError(f'frame inflates to more than {MAX_FRAME} bytes')
+    if not inflater.eof:
+        raise ValueError('truncated deflate stream')
+    return json.loads(raw)
+
+
+CODECS = {
+    'json': Codec('json', False, json.dumps, json.loads),
+    'json-deflate': Codec('json-deflate', True, _deflate, _inflate),
+    'cbor': Codec('cbor', True, cbor_dumps, cbor_loads),
+}
+
+try:
+    import msgpack
+except ImportError:
+    pass
+else:
+    CODECS['msgpack'] = Codec('msgpack', True, msgpack.packb, msgpack.unpackb)
+    DECODE_ERRORS += (msgpack.UnpackException,)
+
+
+def negotiate(requested):
+    for name in (requested or '').split(','):
+        codec = CODECS.get(name.strip().lower())
+        if codec is not None:
+            return codec
+    return CODECS['json']
+
+
+def wants_context(value, codec):
+    if value is None or value == '':
+        return codec.name == 'json'
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def drop_context(metadata):
+    if 'resolved_context' not in metadata:
+        return metadata
+    return {key: value for key, value in metadata.items() if key != 'resolved_context'}
+
+
+def assistant_frame(turn_id, assistant, include_context=True):
+    # message_id is None while a write-behind insert is pending; a
+    # message_saved or message_failed frame for client_id follows.
+    metadata = assistant.full_metadata if include_context else drop_context(assistant.metadata_json)
+    return {
+        'type': 'assistant_message',
+        'turn_id': turn_id,
+        'message_id': assistant.id,
+        'client_id': str(assistant.client_id),
+        'content': assistant.content,
+        'metadata_json': metadata,
+        'created_at': assistant.created_at.isoformat(),
+    }
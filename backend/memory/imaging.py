@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .events import publish
+from .models import GeneratedImage, ImageJob
+
+logger = logging.getLogger(__name__)
+
+# Image rendering runs outside the request: agent_chat creates a
+# GeneratedImage slot and a queued ImageJob per design option, and a bounded
+# pool of worker threads renders them through the configured renderer and
+# pushes an 'image_job' frame to the project's sockets when each one settles.
+
+RENDERERS = {
+    'placeholder': 'memory.imaging.PlaceholderRenderer',
+    'local': 'memory.imaging.LocalPNGRenderer',
+}
+IMAGE_WIDTH = 600
+IMAGE_HEIGHT = 400
+
+
+def get_renderer(name=None):
+    # A key of RENDERERS or the dotted path of any class with url_for/render.
+    name = name or settings.IMAGE_RENDERER
+    return import_string(RENDERERS.get(name, name))()
+
+
+def _option_index(image):
+    return (image.params_json or {}).get('option_index', image.pk)
+
+
+class PlaceholderRenderer:
+    # Stock photos seeded by version and option; nothing is drawn.
+
+    def url_for(self, version_id, option_index):
+        return f'https://picsum.photos/seed/{version_id}-{option_index}/{IMAGE_WIDTH}/{IMAGE_HEIGHT}'
+
+    def render(self, image):
+        return self.url_for(image.design_version_id, _option_index(image))
+
+
+class LocalPNGRenderer(PlaceholderRenderer):
+    # Stand-in for a real model: a gradient seeded by the prompt, written
+    # under MEDIA_ROOT. url_for is known before rendering, so the slot URL
+    # stored in chat metadata is already the final one.
+    directory = 'renders'
+
+    def _name(self, version_id, option_index):
+        return f'{self.directory}/{version_id}-{option_index}.png'
+
+    def url_for(self, version_id, option_index):
+        return f'{settings.PUBLIC_BASE_URL}{settings.MEDIA_URL}{self._name(version_id, option_index)}'
+
+    def render(self, image):
+        version_id, option_index = image.design_version_id, _option_index(image)
+        path = os.path.join(settings.MEDIA_ROOT, self._name(version_id, option_index))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f'{path}.{threading.get_ident()}.part'
+        with open(partial, 'wb') as handle:
+            handle.write(gradient_png(image.prompt))
+        os.replace(partial, path)
+        return self.url_for(version_id, option_index)
+
+
+def _png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+
+def gradient_png(seed, width=IMAGE_WIDTH, height=IMAGE_HEIGHT):
+    digest = hashlib.sha256(seed.encode('utf-8')).digest()
+    top, bottom = digest[:3], digest[3:6]
+    rows = []
+    for y in range(height):
+        t = y / max(height - 1, 1)
+        pixel = bytes(round(a + (b - a) * t) for a, b in zip(top, bottom))
+        rows.append(b'\x00' + pixel * width)
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + _png_chunk(b'IHDR', header)
+        + _png_chunk(b'IDAT', zlib.compress(b''.join(rows)))
+        + _png_chunk(b'IEND', b'')
+    )
+
+
+def job_frame(job):
+    image = job.image
+    return {
+        'type': 'image_job',
+        'job_id': job.id,
+        'image_id': image.id,
+        'version_id': image.design_version_id,
+        'option_index': _option_index(image),
+        'status': job.status,
+        'image_url': image.image_url,
+        'error': job.error,
+    }
+
+
+def run_job(job_id, loop=None):
+    """Claim, render and settle one queued job.
+
+    Returns the job, or None when it was not queued (another worker claimed
+    it first). Renderer errors are retried up to IMAGE_JOB_ATTEMPTS times.
+    """
+    claimed = ImageJob.objects.filter(id=job_id, status='queued').update(
+        status='running',
+        started_at=timezone.now(),
+    )
+    if not claimed:
+        return None
+    job = ImageJob.objects.select_related('image__design_version').get(id=job_id)
+    image = job.image
+    renderer = get_renderer(job.renderer)
+    for _ in range(settings.IMAGE_JOB_ATTEMPTS):
+        job.attempts += 1
+        try:
+            url = renderer.render(image)
+        except Exception as exc:
+            logger.warning('image job %s attempt %s failed: %s', job.id, job.attempts, exc)
+            job.error = f'{type(exc).__name__}: {exc}'
+            continue
+        if url != image.image_url:
+            GeneratedImage.objects.filter(id=image.id).update(image_url=url)
+            image.image_url = url
+        job.status = 'succeeded'
+        job.error = ''
+        break
+    else:
+        job.status = 'failed'
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'attempts', 'error', 'finished_at'])
+    publish(image.design_version.project_id, job_frame(job), loop)
+    return job
+
+
+def requeue_stale(seconds):
+    # Jobs left running by a worker that died mid-render.
+    cutoff = timezone.now() - timedelta(seconds=seconds)
+    return ImageJob.objects.filter(status='running', started_at__lt=cutoff).update(status='queued')
+
+
+def _work(job_id, loop):
+    try:
+        return run_job(job_id, loop)
+    except Exception:
+        logger.exception('image job %s crashed', job_id)
+        return None
+    finally:
+        connections.close_all()
+
+
+class WorkerPool:
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-job')
+
+    def submit(self, job_ids, loop=None):
+        return [self.executor.submit(_work, job_id, loop) for job_id in job_ids]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(settings.IMAGE_JOB_WORKERS)
+        return _pool
+
+
+def enqueue(job_ids, loop=None):
+    # Dispatch waits for commit so workers can see the rows. With
+    # IMAGE_JOB_WORKERS = 0 jobs stay queued for `manage.py run_image_jobs`.
+    if job_ids and settings.IMAGE_JOB_WORKERS > 0:
+        transaction.on_commit(lambda: get_pool().submit(job_ids, loop))
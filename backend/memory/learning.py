@@ -1,5 +1,9 @@
-from typing import List
+from typing import Dict, Iterable, List, Tuple
 
+from django.utils import timezone
+
+from .changes import change_event, record_change
+from .events import invalidate_sessions
 from .models import FeedbackEvent, Preference
 
 
@@ -22,44 +26,81 @@ def _text_contains_any(text, phrases):
     return any(phrase in lower for phrase in phrases)
 
 
-def process_feedback_event(event: FeedbackEvent) -> List[Preference]:
+def _preference_updates(event: FeedbackEvent) -> List[Tuple[str, str, float, str]]:
     updates = []
     payload = event.payload_json or {}
     text = payload.get('text', '') or ''
 
     if text:
         if _text_contains_any(text, ['warmer', 'warm tones', 'warm']):
-            updates.append(
-                upsert_preference(
-                    event.user_id,
-                    key='tone',
-                    value='warm',
-                    delta_confidence=0.3,
-                    source='explicit',
-                )
-            )
+            updates.append(('tone', 'warm', 0.3, 'explicit'))
         if _text_contains_any(text, ['add plants', 'plants', 'greenery']):
-            updates.append(
-                upsert_preference(
-                    event.user_id,
-                    key='plants',
-                    value='true',
-                    delta_confidence=0.3,
-                    source='explicit',
-                )
-            )
+            updates.append(('plants', 'true', 0.3, 'explicit'))
 
     if event.event_type == 'select':
         selected_index = payload.get('selected_option_index')
         if selected_index is not None:
-            updates.append(
-                upsert_preference(
-                    event.user_id,
-                    key='favorite_option_index',
-                    value=str(selected_index),
-                    delta_confidence=0.5,
-                    source='implicit',
-                )
-            )
+            updates.append(('favorite_option_index', str(selected_index), 0.5, 'implicit'))
 
     return updates
+
+
+def process_feedback_event(event: FeedbackEvent) -> List[Preference]:
+    return [
+        upsert_preference(
+            event.user_id,
+            key=key,
+            value=value,
+            delta_confidence=delta,
+            source=source,
+        )
+        for key, value, delta, source in _preference_updates(event)
+    ]
+
+
+def process_feedback_events(events: Iterable[FeedbackEvent]) -> List[Preference]:
+    # Folds every event's deltas per (user, key) so a batch costs one read and
+    # one write per table instead of a get_or_create + save per update. The
+    # last event wins value/source, matching sequential processing; deltas are
+    # non-negative, so capping the sum once equals capping after each step.
+    folded: Dict[Tuple[int, str], List] = {}
+    for event in events:
+        for key, value, delta, source in _preference_updates(event):
+            entry = folded.setdefault((event.user_id, key), [value, 0.0, source])
+            entry[0] = value
+            entry[1] += delta
+            entry[2] = source
+    if not folded:
+        return []
+
+    existing = {}
+    for preference in Preference.objects.filter(
+        user_id__in={user_id for user_id, _ in folded},
+        key__in={key for _, key in folded},
+    ).order_by('id'):
+        existing.setdefault((preference.user_id, preference.key), preference)
+
+    now = timezone.now()
+    to_create, to_update = [], []
+    for (user_id, key), (value, delta, source) in folded.items():
+        preference = existing.get((user_id, key))
+        if preference is None:
+            preference = Preference(user_id=user_id, key=key, confidence=0.0)
+            to_create.append(preference)
+        else:
+            to_update.append(preference)
+        preference.value = value
+        preference.source = source
+        preference.confidence = min(1.0, preference.confidence + float(delta))
+        preference.updated_at = now
+
+    if to_update:
+        Preference.objects.bulk_update(to_update, ['value', 'confidence', 'source', 'updated_at'])
+    if to_create:
+        Preference.objects.bulk_create(to_create)
+    # Bulk writes send no post_save, so do what preference_changed would.
+    invalidate_sessions(['preferences'], user_ids=[user_id for user_id, _ in folded])
+    for op, preferences in (('updated', to_update), ('created', to_create)):
+        for preference in preferences:
+            record_change(preference.user_id, change_event('preference', preference, op, updated_at=now))
+    return to_update + to_create
@@ -1,3 +1,3 @@
-from .service import generate_agent_response, generate_design_suggestions
+from .service import agenerate_agent_response, generate_agent_response, generate_design_suggestions
 
-__all__ = ['generate_design_suggestions', 'generate_agent_response']
+__all__ = ['generate_design_suggestions', 'generate_agent_response', 'agenerate_agent_response']
@@ -1,8 +1,13 @@
+import http.client
 import json
 import os
 import urllib.error
 import urllib.request
 
+from asgiref.sync import sync_to_async
+
+API_URL = 'https://api.anthropic.com/v1/messages'
+
 
 class ClaudeClient:
     def __init__(self, api_key):
@@ -11,32 +16,51 @@ class ClaudeClient:
         self.api_key = api_key
         self.model = os.environ.get('ANTHROPIC_MODEL', 'claude-3-5-sonnet-latest')
 
-    def generate(self, prompt, max_tokens=800):
+    def _payload(self, prompt, max_tokens):
         payload = {
             'model': self.model,
             'max_tokens': max_tokens,
             'temperature': 0.3,
             'messages': [{'role': 'user', 'content': prompt}],
         }
-        body = json.dumps(payload).encode('utf-8')
-        request = urllib.request.Request(
-            'https://api.anthropic.com/v1/messages',
-            data=body,
-            method='POST',
-        )
-        request.add_header('content-type', 'application/json')
-        request.add_header('x-api-key', self.api_key)
-        request.add_header('anthropic-version', '2023-06-01')
+        return json.dumps(payload).encode('utf-8')
+
+    def _headers(self):
+        return {
+            'content-type': 'application/json',
+            'x-api-key': self.api_key,
+            'anthropic-version': '2023-06-01',
+        }
 
+    def generate(self, prompt, max_tokens=800, timeout=30):
+        body = self._payload(prompt, max_tokens)
+        request = urllib.request.Request(API_URL, data=body, method='POST')
+        for name, value in self._headers().items():
+            request.add_header(name, value)
+
+        # Every failure surfaces as RuntimeError, which callers fall back on.
         try:
-            with urllib.request.urlopen(request, timeout=30) as response:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
                 data = json.loads(response.read().decode('utf-8'))
         except urllib.error.HTTPError as exc:
-            raise RuntimeError(f'Anthropic API error: {exc.read().decode("utf-8")}') from exc
+            raise RuntimeError(f'Anthropic API error: {exc.read().decode("utf-8", "replace")}') from exc
         except urllib.error.URLError as exc:
             raise RuntimeError(f'Anthropic API connection error: {exc.reason}') from exc
+        except (OSError, http.client.HTTPException) as exc:
+            raise RuntimeError(f'Anthropic API connection error: {exc!r}') from exc
+        except ValueError as exc:
+            raise RuntimeError(f'Unreadable Anthropic response: {exc}') from exc
+
+        return _extract_text(data)
+
+    async def agenerate(self, prompt, max_tokens=800, timeout=30):
+        # urllib in a worker thread: proxies, redirects and TLS as in
+        # generate, without blocking the event loop.
+        return await sync_to_async(self.generate, thread_sensitive=False)(prompt, max_tokens, timeout)
+
 
-        content = data.get('content', [])
-        if not content or 'text' not in content[0]:
-            raise RuntimeError('Unexpected Anthropic response format')
-        return content[0]['text']
+def _extract_text(data):
+    content = data.get('content') if isinstance(data, dict) else None
+    if not content or not isinstance(content[0], dict) or 'text' not in content[0]:
+        raise RuntimeError('Unexpected Anthropic response format')
+    return content[0]['text']
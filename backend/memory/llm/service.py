@@ -109,3 +109,14 @@ def generate_agent_response(context, message, client=None):
     client = client or ClaudeClient(api_key=api_key)
     response_text = client.generate(prompt)
     return _parse_agent_response(response_text)
+
+
+async def agenerate_agent_response(context, message, client=None):
+    if os.environ.get('MOCK_LLM', 'false').lower() == 'true':
+        return _mock_agent_response(message)
+
+    api_key = os.environ.get('ANTHROPIC_API_KEY')
+    prompt = build_agent_prompt(context, message)
+    client = client or ClaudeClient(api_key=api_key)
+    response_text = await client.agenerate(prompt)
+    return _parse_agent_response(response_text)
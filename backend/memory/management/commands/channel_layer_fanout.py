@@ -0,0 +1,108 @@
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from memory.channel_layer import DatabaseChannelLayer
+
+GROUP = 'fanout-benchmark'
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = 'Measure group_send fan-out latency of the database channel layer across worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--interval', type=float, default=0.005, help='Seconds between sends.')
+        parser.add_argument('--timeout', type=float, default=30.0)
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+        parser.add_argument('--worker', action='store_true', help='Internal: run one receiving worker.')
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            result = asyncio.run(self._receive(options['messages'], options['timeout']))
+            self.stdout.write(json.dumps(result))
+            return
+        report = self._run(options)
+        if options['json']:
+            self.stdout.write(json.dumps(report))
+            return
+        self.stdout.write(
+            f"Workers: {report['workers']}, messages: {report['messages']}\n"
+            f"Delivered: {report['delivered']}/{report['expected']}, in order: {report['in_order']}\n"
+            f"Latency ms: p50 {report['p50_ms']}, p95 {report['p95_ms']}, max {report['max_ms']}"
+        )
+
+    async def _receive(self, count, timeout):
+        layer = DatabaseChannelLayer()
+        channel = await layer.new_channel()
+        await layer.group_add(GROUP, channel)
+        self.stdout.write('ready')
+        self.stdout.flush()
+        sequence, latencies = [], []
+        try:
+            while len(sequence) < count:
+                message = await asyncio.wait_for(layer.receive(channel), timeout)
+                sequence.append(message['seq'])
+                latencies.append((time.time() - message['sent_at']) * 1000)
+        except asyncio.TimeoutError:
+            pass
+        await layer.group_discard(GROUP, channel)
+        await layer.close()
+        return {'sequence': sequence, 'latencies': latencies}
+
+    async def _send(self, layer, count, interval):
+        for seq in range(count):
+            await layer.group_send(GROUP, {'type': 'fanout', 'seq': seq, 'sent_at': time.time()})
+            await asyncio.sleep(interval)
+
+    def _run(self, options):
+        workers, count = options['workers'], options['messages']
+        layer = DatabaseChannelLayer()
+        asyncio.run(layer.flush())
+        command = [
+            sys.executable,
+            str(settings.BASE_DIR / 'manage.py'),
+            'channel_layer_fanout',
+            '--worker',
+            '--messages',
+            str(count),
+            '--timeout',
+            str(options['timeout']),
+        ]
+        processes = [
+            subprocess.Popen(command, cwd=settings.BASE_DIR, stdout=subprocess.PIPE, text=True)
+            for _ in range(workers)
+        ]
+        try:
+            for process in processes:
+                if process.stdout.readline().strip() != 'ready':
+                    raise CommandError('a worker failed to start')
+            asyncio.run(self._send(layer, count, options['interval']))
+            results = [json.loads(process.communicate(timeout=options['timeout'] + 10)[0]) for process in processes]
+        finally:
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+        latencies = [latency for result in results for latency in result['latencies']]
+        return {
+            'workers': workers,
+            'messages': count,
+            'expected': workers * count,
+            'delivered': len(latencies),
+            'in_order': all(result['sequence'] == sorted(result['sequence']) for result in results),
+            'p50_ms': round(statistics.median(latencies), 2) if latencies else None,
+            'p95_ms': round(_percentile(latencies, 0.95), 2) if latencies else None,
+            'max_ms': round(max(latencies), 2) if latencies else None,
+        }
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from memory.models import ChatMessage, ContextSnapshot
+from memory.snapshots import dedup_message_contexts, delete_unreferenced_snapshots
+
+
+class Command(BaseCommand):
+    help = (
+        'Move inline resolved_context copies on chat messages into shared snapshots '
+        'and delete snapshots no message references.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        stats = dedup_message_contexts(ChatMessage, ContextSnapshot, options['batch_size'])
+        orphans = delete_unreferenced_snapshots(ChatMessage, ContextSnapshot)
+        before = stats['bytes_before']
+        saved = stats['bytes_saved']
+        self.stdout.write(
+            f"Messages rewritten: {stats['messages']}\n"
+            f"Snapshots written: {stats['snapshots']}\n"
+            f"Unreferenced snapshots deleted: {orphans}\n"
+            f"resolved_context bytes: {before} -> {stats['bytes_after']}"
+        )
+        ratio = f' ({100.0 * saved / before:.1f}%)' if before else ''
+        self.stdout.write(self.style.SUCCESS(f'Saved {saved} bytes{ratio}'))
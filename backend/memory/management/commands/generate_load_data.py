@@ -0,0 +1,385 @@
+import random
+import time
+from datetime import timedelta
+from functools import partial
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from memory.models import (
+    ChatMessage,
+    ContextSnapshot,
+    DesignVersion,
+    FeedbackEvent,
+    GeneratedImage,
+    Preference,
+    Project,
+    SearchDocument,
+)
+from memory.search import optimize_index
+from memory.snapshots import context_digest
+
+User = get_user_model()
+
+# Insert order matters: rows only reference tables earlier in this list,
+# except Project.last_message, which relies on FK checks deferred to commit.
+MODELS = [
+    User,
+    Project,
+    DesignVersion,
+    GeneratedImage,
+    FeedbackEvent,
+    Preference,
+    ContextSnapshot,
+    ChatMessage,
+    SearchDocument,
+]
+
+EVENT_WEIGHTS = [('select', 0.4), ('modify', 0.3), ('reject', 0.2), ('save', 0.1)]
+MODIFY_TEXTS = [
+    'make it warmer',
+    'add plants and greenery',
+    'more minimal please',
+    'swap the rug for something textured',
+    'brighter lighting',
+    'less clutter on the shelves',
+]
+USER_MESSAGES = [
+    'Help me design a modern {room}',
+    'Same vibe as my bedroom for the {room}',
+    'Can you make the {room} warmer?',
+    'I pick option {option}, save this.',
+    'Add plants to the {room}',
+]
+PREFERENCE_KEYS = [
+    ('tone', ['warm', 'cool', 'neutral'], 'explicit'),
+    ('plants', ['true', 'false'], 'explicit'),
+    ('favorite_option_index', ['1', '2', '3', '4', '5'], 'implicit'),
+    ('style', ['minimal', 'boho', 'industrial', 'scandinavian'], 'explicit'),
+]
+ROOM_TYPES = [room_type for room_type, _ in Project.ROOM_TYPES]
+
+
+def _identity(value):
+    return value
+
+
+class Command(BaseCommand):
+    help = 'Bulk-load synthetic users, projects, versions, feedback and chat for benchmarking.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--projects-per-room', type=int, default=1)
+        parser.add_argument('--versions', type=int, default=8, help='Mean versions per project.')
+        parser.add_argument(
+            '--branch-probability',
+            type=float,
+            default=0.15,
+            help='Chance a version forks from an earlier one instead of extending the chain.',
+        )
+        parser.add_argument('--images-per-version', type=int, default=3)
+        parser.add_argument('--events', type=int, default=10, help='Mean feedback events per project.')
+        parser.add_argument('--messages', type=int, default=40, help='Mean chat messages per project.')
+        parser.add_argument(
+            '--skew',
+            type=float,
+            default=1.5,
+            help='Pareto shape for per-user activity; lower is more skewed.',
+        )
+        parser.add_argument(
+            '--uniform',
+            action='store_true',
+            help='Give every user the mean activity instead of a skewed draw.',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--prefix', default='load')
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--users and --batch-size must be positive')
+        if options['skew'] <= 1:
+            raise CommandError('--skew must be greater than 1')
+
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        self.now = timezone.now()
+        self.next_ids = {
+            model: (model.objects.aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+            for model in MODELS
+            if model._meta.pk.name == 'id'
+        }
+        self.totals = {model: 0 for model in MODELS}
+        self._plans = {}
+
+        started = time.monotonic()
+        pending = {model: [] for model in MODELS}
+        pending_rows = 0
+        for _ in range(options['users']):
+            for model, rows in self._build_user().items():
+                pending[model].extend(rows)
+                pending_rows += len(rows)
+            if pending_rows >= options['batch_size'] * len(MODELS):
+                self._flush(pending)
+                pending = {model: [] for model in MODELS}
+                pending_rows = 0
+        self._flush(pending)
+        self._reset_sequences()
+        optimize_index()
+
+        elapsed = time.monotonic() - started
+        total = sum(self.totals.values())
+        for model in MODELS:
+            self.stdout.write(f'{model.__name__}: {self.totals[model]}')
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Created {total} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/s)'
+            )
+        )
+
+    def _allocate_id(self, model):
+        value = self.next_ids[model]
+        self.next_ids[model] += 1
+        return value
+
+    def _activity(self):
+        # Pareto-distributed multiplier normalised to a mean of ~1, capped so
+        # a single whale cannot dominate the dataset.
+        if self.options['uniform']:
+            return 1.0
+        alpha = self.options['skew']
+        return min(self.rng.paretovariate(alpha) * (alpha - 1) / alpha, 25.0)
+
+    def _count(self, mean, weight, minimum=0):
+        jitter = 1.0 if self.options['uniform'] else self.rng.uniform(0.5, 1.5)
+        return max(minimum, int(round(mean * weight * jitter)))
+
+    def _timestamp(self, days_ago_max=180):
+        return self.now - timedelta(seconds=self.rng.uniform(0, days_ago_max * 86400))
+
+    def _build_user(self):
+        rng = self.rng
+        rows = {model: [] for model in MODELS}
+        user_id = self._allocate_id(User)
+        username = f'{self.options["prefix"]}-{user_id}'
+        rows[User].append(
+            User(
+                id=user_id,
+                username=username,
+                email=f'{username}@example.com',
+                password='!',
+            )
+        )
+        weight = self._activity()
+
+        preferences = []
+        for key, values, source in PREFERENCE_KEYS:
+            if rng.random() < 0.7:
+                preferences.append(
+                    Preference(
+                        id=self._allocate_id(Preference),
+                        user_id=user_id,
+                        key=key,
+                        value=rng.choice(values),
+                        confidence=round(rng.uniform(0.1, 1.0), 2),
+                        source=source,
+                        updated_at=self._timestamp(),
+                    )
+                )
+        rows[Preference].extend(preferences)
+        context_preferences = [
+            {'key': pref.key, 'value': pref.value, 'confidence': pref.confidence, 'source': pref.source}
+            for pref in preferences
+        ]
+
+        for room_type in ROOM_TYPES:
+            for index in range(self.options['projects_per_room']):
+                self._build_project(rows, user_id, room_type, index, weight, context_preferences)
+        return rows
+
+    def _build_project(self, rows, user_id, room_type, index, weight, context_preferences):
+        rng = self.rng
+        options = self.options
+        created_at = self._timestamp()
+        project = Project(
+            id=self._allocate_id(Project),
+            user_id=user_id,
+            room_type=room_type,
+            title=f'{room_type.replace("_", " ").title()} {index + 1}',
+            created_at=created_at,
+            updated_at=created_at,
+        )
+        rows[Project].append(project)
+
+        versions = []
+        for number in range(1, self._count(options['versions'], weight, minimum=1) + 1):
+            parent_id = None
+            if versions:
+                if rng.random() < options['branch_probability']:
+                    parent_id = rng.choice(versions).id
+                else:
+                    parent_id = versions[-1].id
+            versions.append(
+                DesignVersion(
+                    id=self._allocate_id(DesignVersion),
+                    project_id=project.id,
+                    version_number=number,
+                    parent_version_id=parent_id,
+                    notes=rng.choice(MODIFY_TEXTS),
+                    created_at=created_at + timedelta(minutes=number),
+                )
+            )
+            for option in range(1, options['images_per_version'] + 1):
+                image_id = self._allocate_id(GeneratedImage)
+                image = GeneratedImage(
+                    id=image_id,
+                    design_version_id=versions[-1].id,
+                    prompt=f'{room_type} option {option}',
+                    params_json={'option_index': option},
+                    image_url=f'https://picsum.photos/seed/{image_id}/600/400',
+                    created_at=versions[-1].created_at,
+                )
+                rows[GeneratedImage].append(image)
+                self._index(rows, 'image', image, user_id, project.id, image.prompt)
+        rows[DesignVersion].extend(versions)
+        project.next_version_number = len(versions) + 1
+        for version in versions:
+            self._index(rows, 'version', version, user_id, project.id, version.notes)
+
+        event_types, event_weights = zip(*EVENT_WEIGHTS)
+        for _ in range(self._count(options['events'], weight)):
+            event_type = rng.choices(event_types, event_weights)[0]
+            if event_type == 'select':
+                payload = {'selected_option_index': rng.randint(1, 5)}
+            elif event_type == 'modify':
+                payload = {'text': rng.choice(MODIFY_TEXTS)}
+            else:
+                payload = {'note': event_type}
+            rows[FeedbackEvent].append(
+                FeedbackEvent(
+                    id=self._allocate_id(FeedbackEvent),
+                    user_id=user_id,
+                    project_id=project.id,
+                    design_version_id=rng.choice(versions).id,
+                    event_type=event_type,
+                    payload_json=payload,
+                    created_at=self._timestamp(),
+                )
+            )
+
+        room_label = room_type.replace('_', ' ')
+        context = {
+            'target_room_type': room_type,
+            'target_project': {'id': project.id, 'room_type': room_type, 'title': project.title},
+            'preferences': context_preferences,
+        }
+        snapshot = ContextSnapshot(
+            digest=context_digest(context),
+            payload=context,
+            created_at=created_at,
+        )
+        rows[ContextSnapshot].append(snapshot)
+        message_time = created_at
+        for turn in range(self._count(options['messages'], weight)):
+            message_time += timedelta(seconds=rng.randint(5, 600))
+            if turn % 2 == 0:
+                role = 'user'
+                content = rng.choice(USER_MESSAGES).format(room=room_label, option=rng.randint(1, 5))
+                metadata = {}
+            else:
+                role = 'assistant'
+                version = rng.choice(versions)
+                content = f'Here are some ideas for your {room_label}.'
+                metadata = {
+                    'version_id': version.id,
+                    'design_options': [
+                        {
+                            'id': f'opt_{option}',
+                            'title': f'Option {option}',
+                            'image_url': f'https://picsum.photos/seed/{version.id}-{option}/600/400',
+                        }
+                        for option in range(1, 4)
+                    ],
+                }
+            message = ChatMessage(
+                id=self._allocate_id(ChatMessage),
+                user_id=user_id,
+                project_id=project.id,
+                role=role,
+                content=content,
+                metadata_json=metadata,
+                context_snapshot_id=snapshot.digest if role == 'assistant' else None,
+                created_at=message_time,
+            )
+            rows[ChatMessage].append(message)
+            self._index(rows, 'message', message, user_id, project.id, content)
+            project.last_message_id = message.id
+            project.updated_at = message_time
+
+    def _index(self, rows, kind, instance, user_id, project_id, body):
+        # Mirrors memory.signals, which raw inserts bypass.
+        rows[SearchDocument].append(
+            SearchDocument(
+                id=self._allocate_id(SearchDocument),
+                kind=kind,
+                object_id=instance.id,
+                user_id=user_id,
+                project_id=project_id,
+                body=body,
+                created_at=instance.created_at,
+            )
+        )
+
+    def _flush(self, pending):
+        batch_size = self.options['batch_size']
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in MODELS:
+                rows = pending[model]
+                if not rows:
+                    continue
+                sql, converters = self._insert_plan(model)
+                for start in range(0, len(rows), batch_size):
+                    cursor.executemany(
+                        sql,
+                        [
+                            [convert(getattr(row, attname)) for attname, convert in converters]
+                            for row in rows[start:start + batch_size]
+                        ],
+                    )
+                self.totals[model] += len(rows)
+
+    def _insert_plan(self, model):
+        # A prepared INSERT run through executemany. bulk_create spends most
+        # of its time compiling per-row SQL, capping it at ~10k rows/s, which
+        # is far from the 10M-row scale this command targets.
+        if model not in self._plans:
+            ops = connection.ops
+            fields = model._meta.concrete_fields
+            converters = []
+            for field in fields:
+                if field.get_internal_type() == 'DateTimeField':
+                    convert = ops.adapt_datetimefield_value
+                elif field.get_internal_type() == 'JSONField':
+                    convert = partial(ops.adapt_json_value, encoder=field.encoder)
+                else:
+                    convert = _identity
+                converters.append((field.attname, convert))
+            sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+                ops.quote_name(model._meta.db_table),
+                ', '.join(ops.quote_name(field.column) for field in fields),
+                ', '.join(['%s'] * len(fields)),
+            )
+            self._plans[model] = (sql, converters)
+        return self._plans[model]
+
+    def _reset_sequences(self):
+        # Explicit ids leave Postgres sequences behind; SQLite needs nothing.
+        statements = connection.ops.sequence_reset_sql(no_style(), MODELS)
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from memory.models import ChatMessage, DesignVersion, GeneratedImage, SearchDocument
+from memory.search import optimize_index, rebuild_documents
+
+
+class Command(BaseCommand):
+    help = 'Rebuild search documents from chat messages, version notes and image prompts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        with transaction.atomic():
+            total = rebuild_documents(
+                SearchDocument,
+                ChatMessage,
+                DesignVersion,
+                GeneratedImage,
+                batch_size=options['batch_size'],
+            )
+        optimize_index()
+        self.stdout.write(
+            self.style.SUCCESS(f'Indexed {total} documents in {time.monotonic() - started:.1f}s')
+        )
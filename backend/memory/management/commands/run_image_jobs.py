@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from memory.imaging import WorkerPool, requeue_stale, run_job
+from memory.models import ImageJob
+
+
+class Command(BaseCommand):
+    help = 'Render queued image jobs, requeueing ones a dead worker left running.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--stale-after', type=int, default=600, help='seconds')
+        parser.add_argument(
+            '--poll',
+            type=float,
+            default=0,
+            help='keep running, checking for new jobs every POLL seconds',
+        )
+
+    def handle(self, *args, **options):
+        pool = WorkerPool(options['workers']) if options['workers'] > 1 else None
+        try:
+            while True:
+                self._drain(pool, options['stale_after'])
+                if not options['poll']:
+                    break
+                time.sleep(options['poll'])
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def _drain(self, pool, stale_after):
+        requeued = requeue_stale(stale_after)
+        job_ids = list(
+            ImageJob.objects.filter(status='queued').order_by('created_at', 'id').values_list('id', flat=True)
+        )
+        if pool is None:
+            jobs = [run_job(job_id) for job_id in job_ids]
+        else:
+            jobs = [future.result() for future in pool.submit(job_ids)]
+        settled = [job for job in jobs if job is not None]
+        failed = sum(job.status == 'failed' for job in settled)
+        if job_ids or requeued:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'Rendered {len(settled) - failed} images, {failed} failed, {requeued} requeued'
+                )
+            )
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.1 on 2026-10-19 13:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_last_message(apps, schema_editor):
+    Project = apps.get_model('memory', 'Project')
+    ChatMessage = apps.get_model('memory', 'ChatMessage')
+    latest = (
+        ChatMessage.objects.filter(project=OuterRef('pk'))
+        .order_by('-created_at', '-id')
+        .values('id')[:1]
+    )
+    Project.objects.update(last_message=Subquery(latest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0002_chatmessage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='memory.chatmessage'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['project', 'created_at', 'id'], name='chat_project_created_idx'),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
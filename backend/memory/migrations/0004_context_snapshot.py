@@ -0,0 +1,88 @@
+# Generated by Django 5.0.1 on 2026-10-19 13:25
+
+import hashlib
+import json
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+# The backfill is frozen here rather than imported from memory.snapshots, so
+# later changes there cannot change what this migration does. Run
+# `manage.py dedup_context_snapshots` for a report of the space saved.
+BATCH_SIZE = 1000
+
+
+def dedup_contexts(apps, schema_editor):
+    ChatMessage = apps.get_model('memory', 'ChatMessage')
+    ContextSnapshot = apps.get_model('memory', 'ContextSnapshot')
+    last_id = 0
+    while True:
+        batch = list(
+            ChatMessage.objects.filter(id__gt=last_id, context_snapshot__isnull=True)
+            .order_by('id')
+            .only('id', 'metadata_json')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        last_id = batch[-1].id
+        snapshots = {}
+        changed = []
+        for message in batch:
+            metadata = message.metadata_json or {}
+            context = metadata.get('resolved_context')
+            if not isinstance(context, dict):
+                continue
+            encoded = json.dumps(context, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+            digest = hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+            snapshots.setdefault(digest, ContextSnapshot(digest=digest, payload=context))
+            message.metadata_json = {key: value for key, value in metadata.items() if key != 'resolved_context'}
+            message.context_snapshot_id = digest
+            changed.append(message)
+        ContextSnapshot.objects.bulk_create(snapshots.values(), ignore_conflicts=True)
+        ChatMessage.objects.bulk_update(changed, ['metadata_json', 'context_snapshot'])
+
+
+def inline_contexts(apps, schema_editor):
+    ChatMessage = apps.get_model('memory', 'ChatMessage')
+    last_id = 0
+    while True:
+        batch = list(
+            ChatMessage.objects.filter(id__gt=last_id, context_snapshot__isnull=False)
+            .select_related('context_snapshot')
+            .order_by('id')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        last_id = batch[-1].id
+        for message in batch:
+            message.metadata_json = {
+                **(message.metadata_json or {}),
+                'resolved_context': message.context_snapshot.payload,
+            }
+            message.context_snapshot = None
+        ChatMessage.objects.bulk_update(batch, ['metadata_json', 'context_snapshot'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0003_project_last_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContextSnapshot',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('payload', models.JSONField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='context_snapshot',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='memory.contextsnapshot'),
+        ),
+        migrations.RunPython(dedup_contexts, inline_contexts),
+    ]
@@ -0,0 +1,130 @@
+# Generated by Django 5.0.1 on 2026-10-19 13:44
+
+import sqlite3
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+# Index DDL and backfill are frozen here rather than imported from
+# memory.search, so later changes there cannot change what this migration
+# does. Run `manage.py rebuild_search_index` to rebuild with current code.
+DOCUMENT_TABLE = 'memory_searchdocument'
+FTS_TABLE = 'memory_searchdocument_fts'
+GIN_INDEX = 'memory_searchdocument_body_tsv'
+KIND_CODES = {'message': 0, 'version': 1, 'image': 2}
+BATCH_SIZE = 2000
+
+SQLITE_SCHEMA = [
+    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+    f"body, content='{DOCUMENT_TABLE}', content_rowid='id', "
+    f"tokenize='porter unicode61 remove_diacritics 2')",
+    f"CREATE TRIGGER {DOCUMENT_TABLE}_ai AFTER INSERT ON {DOCUMENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, new.body); END",
+    f"CREATE TRIGGER {DOCUMENT_TABLE}_ad AFTER DELETE ON {DOCUMENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body) VALUES ('delete', old.id, old.body); END",
+    f"CREATE TRIGGER {DOCUMENT_TABLE}_au AFTER UPDATE ON {DOCUMENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body) VALUES ('delete', old.id, old.body); "
+    f"INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, new.body); END",
+]
+SQLITE_DROP = [
+    f'DROP TRIGGER IF EXISTS {DOCUMENT_TABLE}_au',
+    f'DROP TRIGGER IF EXISTS {DOCUMENT_TABLE}_ad',
+    f'DROP TRIGGER IF EXISTS {DOCUMENT_TABLE}_ai',
+    f'DROP TABLE IF EXISTS {FTS_TABLE}',
+]
+POSTGRES_SCHEMA = [
+    f"CREATE INDEX {GIN_INDEX} ON {DOCUMENT_TABLE} USING GIN (to_tsvector('english', body))",
+]
+POSTGRES_DROP = [f'DROP INDEX IF EXISTS {GIN_INDEX}']
+
+
+def index_statements(connection, create):
+    if connection.vendor == 'postgresql':
+        return POSTGRES_SCHEMA if create else POSTGRES_DROP
+    if connection.vendor != 'sqlite':
+        return []
+    probe = sqlite3.connect(':memory:')
+    try:
+        probe.execute('CREATE VIRTUAL TABLE probe USING fts5(body)')
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        probe.close()
+    return SQLITE_SCHEMA if create else SQLITE_DROP
+
+
+def create_index(apps, schema_editor):
+    # SQLite rebuilds tables on most ALTERs, dropping their triggers: any later
+    # migration that alters SearchDocument must drop and recreate the index.
+    for sql in index_statements(schema_editor.connection, create=True):
+        schema_editor.execute(sql)
+
+
+def remove_index(apps, schema_editor):
+    for sql in index_statements(schema_editor.connection, create=False):
+        schema_editor.execute(sql)
+
+
+def backfill(apps, schema_editor):
+    SearchDocument = apps.get_model('memory', 'SearchDocument')
+    sources = [
+        ('message', apps.get_model('memory', 'ChatMessage').objects.exclude(content='').values_list(
+            'id', 'user_id', 'project_id', 'content', 'created_at'
+        )),
+        ('version', apps.get_model('memory', 'DesignVersion').objects.exclude(notes='').values_list(
+            'id', 'project__user_id', 'project_id', 'notes', 'created_at'
+        )),
+        ('image', apps.get_model('memory', 'GeneratedImage').objects.exclude(prompt='').values_list(
+            'id', 'design_version__project__user_id', 'design_version__project_id', 'prompt', 'created_at'
+        )),
+    ]
+    batch = []
+    for kind, rows in sources:
+        for object_id, user_id, project_id, body, created_at in rows.iterator():
+            batch.append(
+                SearchDocument(
+                    # user << 34 | kind << 32 | object_id, as memory.search.document_key.
+                    id=(user_id << 34) | (KIND_CODES[kind] << 32) | object_id,
+                    kind=kind,
+                    object_id=object_id,
+                    user_id=user_id,
+                    project_id=project_id,
+                    body=body,
+                    created_at=created_at,
+                )
+            )
+            if len(batch) >= BATCH_SIZE:
+                SearchDocument.objects.bulk_create(batch)
+                batch = []
+    SearchDocument.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0004_context_snapshot'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('message', 'Chat message'), ('version', 'Version notes'), ('image', 'Image prompt')], max_length=20)),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('body', models.TextField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='memory.project')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='searchdocument',
+            constraint=models.UniqueConstraint(fields=('kind', 'object_id'), name='unique_search_document'),
+        ),
+        migrations.RunPython(create_index, remove_index),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:14
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    Project = apps.get_model('memory', 'Project')
+    DesignVersion = apps.get_model('memory', 'DesignVersion')
+    highest = Subquery(
+        DesignVersion.objects.filter(project=OuterRef('pk'))
+        .values('project')
+        .annotate(highest=Max('version_number'))
+        .values('highest')
+    )
+    Project.objects.update(next_version_number=Coalesce(highest, 0) + 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0005_search_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='next_version_number',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
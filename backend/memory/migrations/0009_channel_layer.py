@@ -0,0 +1,52 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0008_chat_message_client_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelMessage',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('inbox', models.CharField(max_length=100)),
+                ('channel', models.CharField(max_length=100)),
+                ('payload', models.TextField()),
+                ('expires_at', models.FloatField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChannelGroup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group_name', models.CharField(max_length=100)),
+                ('channel', models.CharField(max_length=100)),
+                ('inbox', models.CharField(max_length=100)),
+                ('expires_at', models.FloatField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['expires_at'], name='channel_group_expiry')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='channelgroup',
+            constraint=models.UniqueConstraint(fields=('group_name', 'channel'), name='unique_channel_group'),
+        ),
+        migrations.AddIndex(
+            model_name='channelmessage',
+            index=models.Index(fields=['inbox', 'id'], name='channel_message_inbox'),
+        ),
+        migrations.AddIndex(
+            model_name='channelmessage',
+            index=models.Index(fields=['channel'], name='channel_message_channel'),
+        ),
+        migrations.AddIndex(
+            model_name='channelmessage',
+            index=models.Index(fields=['expires_at'], name='channel_message_expiry'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-19 15:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0009_channel_layer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='messages_version',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 5.0.1 on 2026-10-19 16:02
+
+import sqlite3
+
+from django.conf import settings
+from django.db import migrations, models
+
+# Rekeys search documents on a sequence. On SQLite, altering the primary key
+# rebuilds the table, which drops the FTS5 triggers, so the index is dropped
+# first and recreated and rebuilt from the table afterwards (frozen DDL, as
+# in 0005). Existing documents keep their ids. The Postgres GIN index
+# survives the ALTER.
+DOCUMENT_TABLE = 'memory_searchdocument'
+FTS_TABLE = 'memory_searchdocument_fts'
+
+SQLITE_SCHEMA = [
+    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+    f"body, content='{DOCUMENT_TABLE}', content_rowid='id', "
+    f"tokenize='porter unicode61 remove_diacritics 2')",
+    f"CREATE TRIGGER {DOCUMENT_TABLE}_ai AFTER INSERT ON {DOCUMENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, new.body); END",
+    f"CREATE TRIGGER {DOCUMENT_TABLE}_ad AFTER DELETE ON {DOCUMENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body) VALUES ('delete', old.id, old.body); END",
+    f"CREATE TRIGGER {DOCUMENT_TABLE}_au AFTER UPDATE ON {DOCUMENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body) VALUES ('delete', old.id, old.body); "
+    f"INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, new.body); END",
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+SQLITE_DROP = [
+    f'DROP TRIGGER IF EXISTS {DOCUMENT_TABLE}_au',
+    f'DROP TRIGGER IF EXISTS {DOCUMENT_TABLE}_ad',
+    f'DROP TRIGGER IF EXISTS {DOCUMENT_TABLE}_ai',
+    f'DROP TABLE IF EXISTS {FTS_TABLE}',
+]
+
+
+def has_fts5(connection):
+    if connection.vendor != 'sqlite':
+        return False
+    probe = sqlite3.connect(':memory:')
+    try:
+        probe.execute('CREATE VIRTUAL TABLE probe USING fts5(body)')
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def drop_fts(apps, schema_editor):
+    if has_fts5(schema_editor.connection):
+        for sql in SQLITE_DROP:
+            schema_editor.execute(sql)
+
+
+def create_fts(apps, schema_editor):
+    if has_fts5(schema_editor.connection):
+        for sql in SQLITE_SCHEMA:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0010_project_messages_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_fts, create_fts),
+        migrations.RemoveConstraint(
+            model_name='searchdocument',
+            name='unique_search_document',
+        ),
+        migrations.AlterField(
+            model_name='searchdocument',
+            name='id',
+            field=models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID'),
+        ),
+        migrations.AddIndex(
+            model_name='searchdocument',
+            index=models.Index(fields=['kind', 'object_id'], name='search_document_object_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='searchdocument',
+            constraint=models.UniqueConstraint(fields=('user', 'kind', 'object_id'), name='unique_search_document'),
+        ),
+        migrations.RunPython(create_fts, drop_fts),
+    ]
@@ -1,8 +1,17 @@
 from django.conf import settings
-from django.db import models, transaction
-from django.db.models import Max
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.expressions import RawSQL
 from django.utils import timezone
 
+from .snapshots import context_digest
+
+# Guards the recursive lineage queries against runaway (cyclic) parent chains.
+MAX_LINEAGE_DEPTH = 10000
+# Version inserts retried after a number collision before giving up.
+VERSION_NUMBER_ATTEMPTS = 5
+
 
 class UserProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -27,10 +36,79 @@ class Project(models.Model):
     title = models.CharField(max_length=200)
     created_at = models.DateTimeField(default=timezone.now, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
+    # Denormalized pointer for sidebar previews; maintained by ChatMessage.save.
+    last_message = models.ForeignKey(
+        'ChatMessage',
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='+',
+    )
+    # Next DesignVersion.version_number to hand out; see allocate_version_number.
+    next_version_number = models.PositiveIntegerField(default=1, editable=False)
+    # Bumped on every write to the project's messages; validates the
+    # messages listing. See messages_changed.
+    messages_version = models.PositiveBigIntegerField(default=0, editable=False)
 
     def __str__(self):
         return f'{self.title} ({self.get_room_type_display()})'
 
+    @classmethod
+    def messages_changed(cls, project_ids):
+        # Bumps messages_version and points last_message at the newest
+        # message, whichever path wrote it and in what order. ChatMessage
+        # saves and deletes call it; so must bulk writes to messages.
+        cls.objects.filter(id__in=project_ids).update(
+            messages_version=models.F('messages_version') + 1,
+            last_message=Subquery(
+                ChatMessage.objects.filter(project=OuterRef('pk')).order_by('-created_at', '-id').values('id')[:1]
+            ),
+        )
+
+    @classmethod
+    def allocate_version_number(cls, project_id):
+        # One atomic increment on the project row: O(1) however many
+        # versions exist, and the row lock lasts only for this statement.
+        # UPDATE ... RETURNING needs SQLite 3.35+, the release that added
+        # RETURNING to INSERT too; older databases increment, then read the
+        # row back under the lock the UPDATE took.
+        table = cls._meta.db_table
+        if connection.features.can_return_columns_from_insert:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {table} SET next_version_number = next_version_number + 1'
+                    f' WHERE id = %s RETURNING next_version_number',
+                    [project_id],
+                )
+                row = cursor.fetchone()
+            if row is None:
+                raise cls.DoesNotExist(f'Project {project_id} does not exist')
+            return row[0] - 1
+        with transaction.atomic():
+            if not cls.objects.filter(id=project_id).update(
+                next_version_number=models.F('next_version_number') + 1
+            ):
+                raise cls.DoesNotExist(f'Project {project_id} does not exist')
+            return cls.objects.filter(id=project_id).values_list(
+                'next_version_number', flat=True
+            ).get() - 1
+
+    @classmethod
+    def sync_version_counter(cls, project_ids=None):
+        # Moves counters past the highest existing number, never backwards.
+        # Scans versions, so it only runs after a collision and in the
+        # backfill migration.
+        projects = cls.objects.all() if project_ids is None else cls.objects.filter(id__in=project_ids)
+        highest = Subquery(
+            DesignVersion.objects.filter(project=OuterRef('pk'))
+            .values('project')
+            .annotate(highest=Max('version_number'))
+            .values('highest')
+        )
+        projects.update(
+            next_version_number=Greatest(models.F('next_version_number'), Coalesce(highest, 0) + 1)
+        )
+
 
 class DesignVersion(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
@@ -54,17 +132,67 @@ class DesignVersion(models.Model):
         ]
 
     def save(self, *args, **kwargs):
-        if self.version_number:
+        if not self._state.adding:
             return super().save(*args, **kwargs)
 
-        with transaction.atomic():
-            current_max = (
-                DesignVersion.objects.select_for_update()
-                .filter(project=self.project)
-                .aggregate(max_version=Max('version_number'))
-            )['max_version']
-            self.version_number = (current_max or 0) + 1
-            return super().save(*args, **kwargs)
+        if self.version_number:
+            # Explicit numbers (seeds, imports) push the counter past them.
+            with transaction.atomic():
+                result = super().save(*args, **kwargs)
+                Project.objects.filter(
+                    id=self.project_id,
+                    next_version_number__lte=self.version_number,
+                ).update(next_version_number=self.version_number + 1)
+            return result
+
+        for attempt in range(VERSION_NUMBER_ATTEMPTS):
+            self.version_number = Project.allocate_version_number(self.project_id)
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                # A number written behind the counter's back (raw SQL, old
+                # rows): resync and take the next free one. Any other
+                # integrity error is the caller's.
+                taken = DesignVersion.objects.filter(
+                    project_id=self.project_id,
+                    version_number=self.version_number,
+                ).exists()
+                self.version_number = None
+                if not taken or attempt == VERSION_NUMBER_ATTEMPTS - 1:
+                    raise
+                Project.sync_version_counter([self.project_id])
+
+    def ancestors(self):
+        # Parent chain up to the root, resolved by one recursive CTE.
+        table = self._meta.db_table
+        sql = (
+            f'WITH RECURSIVE lineage(id, parent_id, depth) AS ('
+            f' SELECT id, parent_version_id, 0 FROM {table} WHERE id = %s'
+            f' UNION ALL'
+            f' SELECT v.id, v.parent_version_id, l.depth + 1'
+            f' FROM {table} v JOIN lineage l ON v.id = l.parent_id'
+            f' WHERE l.depth < %s'
+            f') SELECT id FROM lineage WHERE depth > 0'
+        )
+        return DesignVersion.objects.filter(
+            id__in=RawSQL(sql, (self.pk, MAX_LINEAGE_DEPTH))
+        )
+
+    def descendants(self):
+        table = self._meta.db_table
+        sql = (
+            f'WITH RECURSIVE subtree(id, depth) AS ('
+            f' SELECT id, 1 FROM {table} WHERE parent_version_id = %s'
+            f' UNION ALL'
+            f' SELECT v.id, s.depth + 1'
+            f' FROM {table} v JOIN subtree s ON v.parent_version_id = s.id'
+            f' WHERE s.depth < %s'
+            f') SELECT id FROM subtree'
+        )
+        return DesignVersion.objects.filter(
+            id__in=RawSQL(sql, (self.pk, MAX_LINEAGE_DEPTH))
+        )
 
     def __str__(self):
         return f'{self.project.title} v{self.version_number}'
@@ -81,6 +209,31 @@ class GeneratedImage(models.Model):
         return f'Image for {self.design_version}'
 
 
+class ImageJob(models.Model):
+    # One render of a GeneratedImage slot, run by memory.imaging workers.
+    STATUSES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+
+    image = models.OneToOneField(GeneratedImage, on_delete=models.CASCADE, related_name='job')
+    status = models.CharField(max_length=20, choices=STATUSES, default='queued')
+    renderer = models.CharField(max_length=120, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'], name='image_job_status')]
+
+    def __str__(self):
+        return f'Job {self.pk} {self.status}'
+
+
 class FeedbackEvent(models.Model):
     EVENT_TYPES = [
         ('select', 'Select'),
@@ -147,6 +300,16 @@ class ProjectLink(models.Model):
         return f'{self.from_project} -> {self.to_project}'
 
 
+class ContextSnapshot(models.Model):
+    # Content-addressed resolved_context payloads shared by chat messages.
+    digest = models.CharField(max_length=64, primary_key=True)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    def __str__(self):
+        return self.digest[:12]
+
+
 class ChatMessage(models.Model):
     ROLE_CHOICES = [
         ('user', 'User'),
@@ -159,7 +322,124 @@ class ChatMessage(models.Model):
     role = models.CharField(max_length=20, choices=ROLE_CHOICES)
     content = models.TextField()
     metadata_json = models.JSONField(default=dict, blank=True)
+    context_snapshot = models.ForeignKey(
+        ContextSnapshot,
+        on_delete=models.PROTECT,
+        blank=True,
+        null=True,
+        related_name='+',
+    )
+    # Known before the INSERT, so a reply can be sent ahead of its write
+    # (memory.writebehind) and matched up with its id afterwards. The client
+    # picks it in its user_message frame, or the server makes one up.
+    client_id = models.UUIDField(null=True, blank=True, unique=True, editable=False)
     created_at = models.DateTimeField(default=timezone.now, editable=False)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['project', 'created_at', 'id'],
+                name='chat_project_created_idx',
+            )
+        ]
+
+    @property
+    def full_metadata(self):
+        # metadata_json with the snapshot's resolved_context put back inline.
+        if self.context_snapshot_id is None:
+            return self.metadata_json
+        return {**self.metadata_json, 'resolved_context': self.context_snapshot.payload}
+
+    def detach_context(self):
+        """Move an inline resolved_context out into an unsaved ContextSnapshot.
+
+        Returns the snapshot for the caller to store, or None. save() does
+        this one message at a time, memory.writebehind for a whole batch.
+        """
+        context = (self.metadata_json or {}).get('resolved_context')
+        if not isinstance(context, dict) or self.context_snapshot_id is not None:
+            return None
+        self.context_snapshot = ContextSnapshot(digest=context_digest(context), payload=context)
+        self.metadata_json = {key: value for key, value in self.metadata_json.items() if key != 'resolved_context'}
+        return self.context_snapshot
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self._state.adding:
+                snapshot = self.detach_context()
+                if snapshot is not None:
+                    ContextSnapshot.objects.bulk_create([snapshot], ignore_conflicts=True)
+            result = super().save(*args, **kwargs)
+            Project.messages_changed([self.project_id])
+            return result
+
     def __str__(self):
         return f'{self.project.title} {self.role}'
+
+
+class SearchDocument(models.Model):
+    # Denormalized copy of searchable text, indexed by memory.search.
+    KINDS = [
+        ('message', 'Chat message'),
+        ('version', 'Version notes'),
+        ('image', 'Image prompt'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KINDS)
+    object_id = models.PositiveBigIntegerField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='+')
+    body = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'kind', 'object_id'],
+                name='unique_search_document',
+            )
+        ]
+        # Signals find a row from its source object, without the user.
+        indexes = [models.Index(fields=['kind', 'object_id'], name='search_document_object_idx')]
+
+    def __str__(self):
+        return f'{self.kind} {self.object_id}'
+
+
+class ChannelMessage(models.Model):
+    # Queue rows for memory.channel_layer.DatabaseChannelLayer. `inbox` is
+    # the receiving process for process-specific channels (the name up to
+    # and including '!') and the channel itself otherwise. Times are epoch
+    # seconds so the layer's raw SQL compares plain numbers.
+    id = models.BigAutoField(primary_key=True)
+    inbox = models.CharField(max_length=100)
+    channel = models.CharField(max_length=100)
+    payload = models.TextField()
+    expires_at = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['inbox', 'id'], name='channel_message_inbox'),
+            models.Index(fields=['channel'], name='channel_message_channel'),
+            models.Index(fields=['expires_at'], name='channel_message_expiry'),
+        ]
+
+    def __str__(self):
+        return f'{self.channel} #{self.pk}'
+
+
+class ChannelGroup(models.Model):
+    # Group membership for DatabaseChannelLayer.
+    group_name = models.CharField(max_length=100)
+    channel = models.CharField(max_length=100)
+    inbox = models.CharField(max_length=100)
+    expires_at = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['group_name', 'channel'], name='unique_channel_group'),
+        ]
+        indexes = [models.Index(fields=['expires_at'], name='channel_group_expiry')]
+
+    def __str__(self):
+        return f'{self.group_name} {self.channel}'
@@ -0,0 +1,251 @@
+import asyncio
+import time
+import uuid
+from contextlib import contextmanager
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .imaging import enqueue, get_renderer
+from .llm import agenerate_agent_response, generate_agent_response
+from .models import ChatMessage, DesignVersion, FeedbackEvent, GeneratedImage, ImageJob
+from .retrieval import get_canonical_version, resolve_context
+
+# One chat turn as explicit stages, shared by views.agent_chat and
+# ChatConsumer:
+#
+#   persist_user   the user's ChatMessage
+#   resolve        resolve_context
+#   generate       the LLM call
+#   apply          version_action: new version, image slots and jobs, save
+#   persist_reply  the assistant's ChatMessage
+#
+# Nothing downstream reads the user's message, so arun_turn writes it while
+# resolve and generate run; everything else is sequential. Stage durations
+# go into the reply's metadata_json['timings'], except persist_reply, which
+# is the write that stores them. Given a memory.writebehind.ReplyWriter,
+# arun_turn returns the reply unsaved (id None, client_id set) and leaves
+# the INSERT to the writer.
+
+STAGES = ('persist_user', 'resolve', 'generate', 'apply', 'persist_reply')
+FALLBACK_REPLY = 'I hit a snag generating a full response, but I can still help.'
+
+
+class StageTimings:
+    def __init__(self):
+        self.started = {}
+        self.seconds = {}
+
+    @contextmanager
+    def stage(self, name):
+        # A stage that raises or is cancelled keeps its start but no duration.
+        self.started[name] = time.monotonic()
+        yield
+        self.seconds[name] = time.monotonic() - self.started[name]
+
+    def running(self, name):
+        # Seconds spent so far in a stage that started and did not finish.
+        if name not in self.started or name in self.seconds:
+            return 0.0
+        return time.monotonic() - self.started[name]
+
+    def as_ms(self):
+        return {name: round(seconds * 1000, 2) for name, seconds in self.seconds.items()}
+
+
+def _fallback_payload():
+    return {
+        'reply': FALLBACK_REPLY,
+        'design_options': [],
+        'version_action': {'type': 'none'},
+        'preference_hints': [],
+    }
+
+
+def persist_user_message(user, project, message):
+    return ChatMessage.objects.create(user=user, project=project, role='user', content=message)
+
+
+def resolve(user, project, message, session=None):
+    return resolve_context(
+        user_id=user.id,
+        message=message,
+        project_id=project.id,
+        session=session,
+    )
+
+
+def _canonical_version(project, session):
+    if session is not None:
+        return session.canonical_version
+    return get_canonical_version(project.id)
+
+
+def _option(index, option, image_url):
+    prompt = option.get('image_prompt') or option.get('description') or 'Design option'
+    return {
+        'id': f'opt_{index}',
+        'title': option.get('title') or f'Option {index}',
+        'description': option.get('description') or '',
+        'image_prompt': prompt,
+        'image_url': image_url,
+    }
+
+
+def apply_actions(user, project, message, payload, session=None, loop=None):
+    """Carry out the payload's version_action and any save request.
+
+    Returns the reply metadata describing what was done. `loop` is the
+    server's event loop, handed to the image workers for socket pushes.
+    """
+    version_action = payload.get('version_action') or {}
+    action_type = version_action.get('type', 'none')
+    version = None
+    created_images = []
+    design_options = []
+
+    if action_type in ('create_version', 'revise_version'):
+        parent_version = None
+        parent_id = version_action.get('parent_version_id')
+        if parent_id:
+            parent_version = DesignVersion.objects.filter(id=parent_id, project=project).first()
+        if parent_version is None:
+            parent_version = _canonical_version(project, session)
+        version = DesignVersion.objects.create(
+            project=project,
+            parent_version=parent_version,
+            notes=version_action.get('notes') or 'Assistant suggested update',
+        )
+        # Each option gets an image slot now; rendering happens in the
+        # background and completion is pushed to the project's sockets.
+        renderer = get_renderer()
+        images = []
+        for index, option in enumerate(payload.get('design_options', []), start=1):
+            enriched = _option(index, option, renderer.url_for(version.id, index))
+            image = GeneratedImage.objects.create(
+                design_version=version,
+                prompt=enriched['image_prompt'],
+                params_json={'option_index': index},
+                image_url=enriched['image_url'],
+            )
+            enriched['image_id'] = image.id
+            images.append(image)
+            design_options.append(enriched)
+        jobs = ImageJob.objects.bulk_create(
+            [ImageJob(image=image, renderer=settings.IMAGE_RENDERER) for image in images]
+        )
+        created_images = [
+            {
+                'id': image.id,
+                'image_url': image.image_url,
+                'prompt': image.prompt,
+                'job_id': job.id,
+                'status': job.status,
+            }
+            for image, job in zip(images, jobs)
+        ]
+        enqueue([job.id for job in jobs], loop)
+    else:
+        design_options = [
+            _option(index, option, f'https://picsum.photos/seed/{project.id}-{index}/600/400')
+            for index, option in enumerate(payload.get('design_options', []), start=1)
+        ]
+
+    saved = action_type == 'save_final' or 'save' in message.lower()
+    if saved:
+        FeedbackEvent.objects.create(
+            user=user,
+            project=project,
+            design_version=_canonical_version(project, session) or version,
+            event_type='save',
+            payload_json={'note': 'saved via chat'},
+        )
+
+    return {
+        'version_id': version.id if version else None,
+        'created_images': created_images,
+        'design_options': design_options,
+        'saved': saved,
+        'action_type': action_type,
+    }
+
+
+def build_reply(user, project, payload, context, actions, timings, client_id=None):
+    return ChatMessage(
+        user=user,
+        project=project,
+        role='assistant',
+        content=payload.get('reply', ''),
+        metadata_json={'resolved_context': context, **actions, 'timings': timings},
+        client_id=client_id or uuid.uuid4(),
+    )
+
+
+def _timings_metadata(timings, started):
+    return {**timings.as_ms(), 'total': round((time.monotonic() - started) * 1000, 2)}
+
+
+def run_turn(user, project, message, session=None, timings=None):
+    """Answer one message from synchronous code, stage after stage.
+
+    Returns the saved assistant ChatMessage.
+    """
+    timings = timings if timings is not None else StageTimings()
+    started = time.monotonic()
+    with timings.stage('persist_user'):
+        persist_user_message(user, project, message)
+    with timings.stage('resolve'):
+        context = resolve(user, project, message, session)
+    with timings.stage('generate'):
+        try:
+            payload = generate_agent_response(context, message)
+        except Exception:
+            payload = _fallback_payload()
+    with timings.stage('apply'):
+        actions = apply_actions(user, project, message, payload, session)
+    with timings.stage('persist_reply'):
+        reply = build_reply(user, project, payload, context, actions, _timings_metadata(timings, started))
+        reply.save()
+    return reply
+
+
+async def arun_turn(user, project, message, session=None, timings=None, writer=None, client_id=None):
+    """Async run_turn; the user-message write overlaps resolve and generate.
+
+    Pass a StageTimings to watch progress from outside, e.g. to see how long
+    a cancelled turn had been waiting on the LLM, and the client's UUID for
+    the reply as client_id; one is made up otherwise.
+    """
+    timings = timings if timings is not None else StageTimings()
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+
+    async def persist_user():
+        with timings.stage('persist_user'):
+            await database_sync_to_async(persist_user_message)(user, project, message)
+
+    async def answer():
+        with timings.stage('resolve'):
+            context = await database_sync_to_async(resolve)(user, project, message, session)
+        with timings.stage('generate'):
+            try:
+                payload = await agenerate_agent_response(context, message)
+            except Exception:
+                payload = _fallback_payload()
+        return context, payload
+
+    # answer() goes first so resolve is ahead of the write on the
+    # thread-sensitive executor; the write then runs during the LLM call.
+    (context, payload), _ = await asyncio.gather(answer(), persist_user())
+    with timings.stage('apply'):
+        actions = await database_sync_to_async(apply_actions)(
+            user, project, message, payload, session, loop
+        )
+    with timings.stage('persist_reply'):
+        reply = build_reply(
+            user, project, payload, context, actions, _timings_metadata(timings, started), client_id
+        )
+        # A full queue falls back to writing inline, which is the backpressure.
+        if writer is None or not writer.submit(reply, loop):
+            await database_sync_to_async(reply.save)()
+    return reply
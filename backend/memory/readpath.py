@@ -0,0 +1,173 @@
+import re
+from datetime import timezone as dt_timezone
+
+try:
+    import orjson
+except ImportError:  # in requirements.txt; DRF's renderer covers a broken install
+    orjson = None
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+# Read-only fast path for list endpoints: rows come straight from .values()
+# and only datetimes need converting, instead of a ModelSerializer walking its
+# fields for every instance. The output matches the serializer exactly; the
+# golden tests in memory.tests hold the two together.
+
+# DRF fields whose to_representation is the identity for values loaded from
+# their model column.
+PASSTHROUGH_FIELDS = (
+    serializers.BooleanField,
+    serializers.CharField,
+    serializers.ChoiceField,
+    serializers.FloatField,
+    serializers.IntegerField,
+    serializers.JSONField,
+    serializers.PrimaryKeyRelatedField,
+)
+
+_plans = {}
+
+
+def datetime_formatter():
+    # DRF's ISO 8601 DateTimeField output: current timezone, +00:00 as Z.
+    # The timezone is looked up once per listing rather than per value.
+    current = timezone.get_current_timezone() if settings.USE_TZ else None
+
+    def format_datetime(value):
+        if value is None:
+            return None
+        if current is not None:
+            value = value.astimezone(current)
+        elif timezone.is_aware(value):
+            value = timezone.make_naive(value, dt_timezone.utc)
+        value = value.isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+
+    return format_datetime
+
+
+def _plan(serializer_class):
+    """(column, key, converter factory) per readable field, or None.
+
+    Serializers that override to_representation, read a non-column source or
+    use a non-ISO or per-field-timezone DateTimeField are left to DRF.
+    """
+    if serializer_class not in _plans:
+        _plans[serializer_class] = _build_plan(serializer_class)
+    return _plans[serializer_class]
+
+
+def _build_plan(serializer_class):
+    if serializer_class.to_representation is not serializers.ModelSerializer.to_representation:
+        return None
+    model = serializer_class.Meta.model
+    plan = []
+    for name, field in serializer_class().fields.items():
+        if field.write_only:
+            continue
+        try:
+            column = model._meta.get_field(field.source).attname
+        except FieldDoesNotExist:
+            return None
+        if isinstance(field, serializers.DateTimeField):
+            output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+            if hasattr(field, 'timezone') or str(output_format).lower() != ISO_8601:
+                return None
+            plan.append((column, name, datetime_formatter))
+        elif isinstance(field, PASSTHROUGH_FIELDS):
+            plan.append((column, name, None))
+        else:
+            return None
+    return plan
+
+
+def serialize_rows(queryset, serializer_class):
+    plan = _plan(serializer_class)
+    if plan is None:
+        return serializer_class(queryset, many=True).data
+    columns = [column for column, _, _ in plan]
+    converters = [(index, factory()) for index, (_, _, factory) in enumerate(plan) if factory]
+    keys = [key for _, key, _ in plan]
+    rows = []
+    for values in queryset.values_list(*columns):
+        if converters:
+            values = list(values)
+            for index, convert in converters:
+                values[index] = convert(values[index])
+        rows.append(dict(zip(keys, values)))
+    return rows
+
+
+# orjson writes NaN and Infinity as null where DRF's strict JSON raises, and
+# exponents as 1e16 and 1e-5 where the stdlib writes 1e+16 and 1e-05. Any
+# other float prints the same shortest repr in both, so only output that
+# has a null or an exponent needs its floats checked.
+_EXPONENT = re.compile(rb'[0-9]e-?[0-9]')
+_SCALARS = {str, int, bool, type(None)}
+
+
+def _floats_render_alike(values):
+    for value in values:
+        kind = type(value)
+        if kind in _SCALARS:
+            continue
+        if kind is float:
+            if not (value == 0.0 or 1e-4 <= abs(value) < 1e16):
+                return False
+        elif isinstance(value, dict):
+            if not _floats_render_alike(value.values()):
+                return False
+        elif isinstance(value, (list, tuple)):
+            if not _floats_render_alike(value):
+                return False
+    return True
+
+
+class FastJSONRenderer(JSONRenderer):
+    # orjson, with the same bytes as DRF's renderer. Payloads orjson would
+    # write differently (non-finite or exponent floats, integers past 64
+    # bits) go to DRF's renderer, as does everything if orjson fails to import.
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None
+            or data is None
+            or self.get_indent(accepted_media_type, renderer_context or {}) is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(
+                data,
+                default=self.encoder_class().default,
+                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+            )
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        if (b'null' in ret or _EXPONENT.search(ret)) and not _floats_render_alike([data]):
+            return super().render(data, accepted_media_type, renderer_context)
+        # DRF escapes these two so the output is also valid JavaScript.
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+
+class FastListMixin:
+    # Swaps the per-row serializer for serialize_rows on list(); every other
+    # action, including writes and their responses, still uses the serializer.
+    renderer_classes = [FastJSONRenderer] + [
+        renderer
+        for renderer in api_settings.DEFAULT_RENDERER_CLASSES
+        if not issubclass(renderer, JSONRenderer)
+    ]
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return Response(serialize_rows(queryset, self.get_serializer_class()))
@@ -0,0 +1,112 @@
+import bisect
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .models import ChatMessage
+from .retrieval import get_message_page
+from .serializers import ChatMessageSerializer
+
+# Catch-up for a reconnecting socket: ChatConsumer accepts
+# ?last_message_id= and sends the project's messages after it as 'replay'
+# frames shaped like the messages listing. Recent messages come from a
+# per-project ring buffer filled as messages commit in this process; older
+# gaps, or any doubt about the buffer, fall back to a keyset query over
+# chat_project_created_idx.
+
+REPLAY_PAGE = 200
+
+
+def _key(message):
+    return (message.created_at, message.id)
+
+
+class RecentMessages:
+    """The last `size` committed messages of up to `projects` projects.
+
+    Entries are kept in (created_at, id) order, the order of the listing,
+    whatever order they commit in.
+    """
+
+    def __init__(self, size, projects):
+        self.size = size
+        self.projects = projects
+        self._lock = threading.Lock()
+        self._buffers = OrderedDict()
+
+    def record(self, message):
+        if not self.size:
+            return
+        if message.context_snapshot_id and not ChatMessage.context_snapshot.is_cached(message):
+            # Serializing it would query from the event loop; leave this
+            # project to the database.
+            self.forget(message.project_id)
+            return
+        with self._lock:
+            entries = [
+                entry for entry in self._buffers.pop(message.project_id, ()) if entry.id != message.id
+            ]
+            self._buffers[message.project_id] = entries
+            keys = [_key(entry) for entry in entries]
+            entries.insert(bisect.bisect(keys, _key(message)), message)
+            del entries[: -self.size]
+            while len(self._buffers) > self.projects:
+                self._buffers.popitem(last=False)
+
+    def forget(self, project_id):
+        with self._lock:
+            self._buffers.pop(project_id, None)
+
+    def after(self, project_id, message_id, last_message_id):
+        """Buffered messages after message_id, or None to ask the database.
+
+        The buffer only answers when it still holds message_id and its
+        newest entry is the project's last_message, i.e. nothing written
+        since, here or by another process, is missing from it.
+        """
+        with self._lock:
+            entries = list(self._buffers.get(project_id, ()))
+        if not entries or entries[-1].id != last_message_id:
+            return None
+        for index, entry in enumerate(entries):
+            if entry.id == message_id:
+                return entries[index + 1 :]
+        return None
+
+
+_recent = None
+_recent_lock = threading.Lock()
+
+
+def recent_messages():
+    global _recent
+    with _recent_lock:
+        if _recent is None:
+            _recent = RecentMessages(settings.CHAT_REPLAY_BUFFER, settings.CHAT_REPLAY_PROJECTS)
+        return _recent
+
+
+@receiver(setting_changed)
+def _reset_recent(setting, **kwargs):
+    global _recent
+    if setting.startswith('CHAT_REPLAY_'):
+        with _recent_lock:
+            _recent = None
+
+
+def serialize_messages(messages):
+    return ChatMessageSerializer(messages, many=True).data
+
+
+def find_cursor(project_id, message_id):
+    return ChatMessage.objects.filter(project_id=project_id, id=message_id).only('id', 'created_at').first()
+
+
+def replay_page(project_id, cursor):
+    """(serialized messages, has_more, last message) for one page after cursor."""
+    queryset = ChatMessage.objects.filter(project_id=project_id).select_related('context_snapshot')
+    messages, has_more = get_message_page(queryset, REPLAY_PAGE, after=cursor)
+    return serialize_messages(messages), has_more, messages[-1] if messages else cursor
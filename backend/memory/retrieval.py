@@ -1,6 +1,11 @@
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
-from .models import DesignVersion, FeedbackEvent, GeneratedImage, Preference, Project
+from django.db.models import Count, Q
+
+from .models import ChatMessage, DesignVersion, FeedbackEvent, GeneratedImage, Preference, Project
+
+PREFERENCE_LIMIT = 10
+RECENT_EVENT_LIMIT = 5
 
 
 def get_canonical_version(project_id: int) -> Optional[DesignVersion]:
@@ -16,6 +21,72 @@ def get_canonical_version(project_id: int) -> Optional[DesignVersion]:
     return last_save.design_version if last_save else None
 
 
+def get_message_page(
+    queryset,
+    limit: int,
+    before: Optional[ChatMessage] = None,
+    after: Optional[ChatMessage] = None,
+) -> Tuple[List[ChatMessage], bool]:
+    # Keyset page over (created_at, id), returned oldest first. With `after`
+    # the page starts right after that message; otherwise it is the newest
+    # `limit` messages older than `before` (or overall).
+    if after is not None:
+        queryset = queryset.filter(
+            Q(created_at__gt=after.created_at)
+            | Q(created_at=after.created_at, id__gt=after.id)
+        ).order_by('created_at', 'id')
+        rows = list(queryset[: limit + 1])
+        return rows[:limit], len(rows) > limit
+
+    if before is not None:
+        queryset = queryset.filter(
+            Q(created_at__lt=before.created_at)
+            | Q(created_at=before.created_at, id__lt=before.id)
+        )
+    rows = list(queryset.order_by('-created_at', '-id')[: limit + 1])
+    has_more = len(rows) > limit
+    return rows[:limit][::-1], has_more
+
+
+def get_version_tree(versions, canonical_id: Optional[int] = None) -> List[Dict]:
+    # Flat pre-order node list with depths; deep lineages would overflow the
+    # JSON encoder's recursion limit if nested.
+    rows = list(
+        versions.annotate(
+            image_count=Count('generatedimage', distinct=True),
+            save_count=Count(
+                'feedbackevent',
+                filter=Q(feedbackevent__event_type='save'),
+                distinct=True,
+            ),
+        ).order_by('version_number', 'id')
+    )
+    by_id = {version.id: version for version in rows}
+    children = {}
+    roots = []
+    for version in rows:
+        if version.parent_version_id in by_id:
+            children.setdefault(version.parent_version_id, []).append(version)
+        else:
+            roots.append(version)
+
+    nodes = []
+    stack = [(version, 0) for version in reversed(roots)]
+    while stack:
+        version, depth = stack.pop()
+        nodes.append(
+            {
+                **_serialize_version(version),
+                'depth': depth,
+                'image_count': version.image_count,
+                'saved': version.save_count > 0,
+                'is_canonical': version.id == canonical_id,
+            }
+        )
+        stack.extend((child, depth + 1) for child in reversed(children.get(version.id, [])))
+    return nodes
+
+
 ROOM_ALIASES = {
     'living room': 'living_room',
     'livingroom': 'living_room',
@@ -102,13 +173,22 @@ def _serialize_version(version: DesignVersion) -> Dict:
     }
 
 
-def resolve_context(user_id: int, message: str, project_id: Optional[int] = None) -> Dict:
+def resolve_context(
+    user_id: int,
+    message: str,
+    project_id: Optional[int] = None,
+    session=None,
+) -> Dict:
+    # `session` is a refreshed memory.sessions.ChatSession for this user; its
+    # cached rows replace the target project, preference and event queries.
     target_room_type = _detect_room_type(message)
     reference_room_type = _detect_reference_room_type(message)
     retrieval_reason = _detect_reference_reason(message)
 
     target_project = None
-    if project_id:
+    if session is not None:
+        target_project = session.project
+    elif project_id:
         target_project = (
             Project.objects.filter(id=project_id, user_id=user_id).first()
         )
@@ -148,16 +228,21 @@ def resolve_context(user_id: int, message: str, project_id: Optional[int] = None
                 .first()
             )
 
-    preferences = list(
-        Preference.objects.filter(user_id=user_id)
-        .order_by('-confidence', '-updated_at')[:10]
-    )
+    if session is not None:
+        preferences = session.preferences
+    else:
+        preferences = list(
+            Preference.objects.filter(user_id=user_id)
+            .order_by('-confidence', '-updated_at')[:PREFERENCE_LIMIT]
+        )
 
     target_events = []
-    if target_project:
+    if session is not None and target_project is session.project:
+        target_events = session.events
+    elif target_project:
         target_events = list(
             FeedbackEvent.objects.filter(project=target_project)
-            .order_by('-created_at')[:5]
+            .order_by('-created_at')[:RECENT_EVENT_LIMIT]
         )
 
     reference_summary = None
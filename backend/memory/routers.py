@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.decorators import sync_and_async_middleware
+
+# Reads of memory models go to READ_REPLICA_DATABASE, when one is set, but
+# only inside a read scope: a request (read_replica_middleware) or a chat
+# turn (ChatConsumer). The first write in a scope pins the rest of it to the
+# primary, so a request or turn always reads its own writes; so does an open
+# transaction on the primary. Outside a scope (management commands, the
+# write-behind writer, image workers, change feeds) everything stays on the
+# primary. Writes always go to the primary, including saves of instances
+# that were read from the replica.
+
+REPLICA_APPS = {'memory'}
+
+
+class _Scope:
+    # Shared by every context copied from the scope's, so a write in a
+    # sync_to_async thread or a child task pins the whole request or turn.
+    __slots__ = ('pinned',)
+
+    def __init__(self):
+        self.pinned = False
+
+
+_scope = ContextVar('memory_read_scope', default=None)
+
+
+@contextmanager
+def read_scope():
+    """Let the reads inside use the replica until something writes.
+
+    Nested scopes share the outer one, so a turn run inside a request keeps
+    the request's pin.
+    """
+    if _scope.get() is not None:
+        yield
+        return
+    token = _scope.set(_Scope())
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def pin_primary():
+    scope = _scope.get()
+    if scope is not None:
+        scope.pinned = True
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replica = settings.READ_REPLICA_DATABASE
+        if not replica or model._meta.app_label not in REPLICA_APPS:
+            return None
+        scope = _scope.get()
+        if scope is None or scope.pinned or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            # Explicitly, or an instance read from the replica would pull its
+            # related rows from there too.
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        pin_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, settings.READ_REPLICA_DATABASE}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        # The replica gets its schema from the primary.
+        if db == settings.READ_REPLICA_DATABASE:
+            return False
+        return None
+
+
+@sync_and_async_middleware
+def read_replica_middleware(get_response):
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            with read_scope():
+                return await get_response(request)
+
+    else:
+
+        def middleware(request):
+            with read_scope():
+                return get_response(request)
+
+    return middleware
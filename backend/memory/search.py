@@ -0,0 +1,223 @@
+import functools
+import re
+import sqlite3
+
+from django.db import connection, connections, router
+
+# Full-text search over chat messages, version notes and image prompts.
+#
+# Every searchable row is mirrored into memory_searchdocument (kept current by
+# memory.signals). On SQLite an FTS5 external-content table indexes it through
+# triggers; on Postgres a GIN index over to_tsvector('english', body) does.
+# Other backends fall back to a case-insensitive substring scan. Migration
+# 0005 creates the index and its triggers; 0011 recreates them. Any later
+# migration that alters SearchDocument on SQLite must drop and recreate them
+# too, since SQLite rebuilds the table.
+
+DOCUMENT_TABLE = 'memory_searchdocument'
+FTS_TABLE = 'memory_searchdocument_fts'
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 100
+MAX_QUERY_TERMS = 16
+SNIPPET_WORDS = 16
+MATCH_START = '\x01'
+MATCH_END = '\x02'
+
+
+@functools.lru_cache(maxsize=None)
+def sqlite_has_fts5():
+    # Compile options belong to the linked library, so one probe per process.
+    probe = sqlite3.connect(':memory:')
+    try:
+        probe.execute('CREATE VIRTUAL TABLE probe USING fts5(body)')
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def search_backend(vendor):
+    if vendor == 'sqlite' and sqlite_has_fts5():
+        return 'fts5'
+    if vendor == 'postgresql':
+        return 'tsvector'
+    return 'scan'
+
+
+def optimize_index():
+    # Merges the many small segments a bulk load leaves behind.
+    if search_backend(connection.vendor) == 'fts5':
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+
+def _source_rows(ChatMessage, DesignVersion, GeneratedImage):
+    yield from (
+        ('message', *row)
+        for row in ChatMessage.objects.exclude(content='').values_list(
+            'id', 'user_id', 'project_id', 'content', 'created_at'
+        ).iterator()
+    )
+    yield from (
+        ('version', *row)
+        for row in DesignVersion.objects.exclude(notes='').values_list(
+            'id', 'project__user_id', 'project_id', 'notes', 'created_at'
+        ).iterator()
+    )
+    yield from (
+        ('image', *row)
+        for row in GeneratedImage.objects.exclude(prompt='').values_list(
+            'id',
+            'design_version__project__user_id',
+            'design_version__project_id',
+            'prompt',
+            'created_at',
+        ).iterator()
+    )
+
+
+def rebuild_documents(SearchDocument, ChatMessage, DesignVersion, GeneratedImage, batch_size=2000):
+    SearchDocument.objects.all().delete()
+    total = 0
+    batch = []
+    for kind, object_id, user_id, project_id, body, created_at in _source_rows(
+        ChatMessage, DesignVersion, GeneratedImage
+    ):
+        batch.append(
+            SearchDocument(
+                kind=kind,
+                object_id=object_id,
+                user_id=user_id,
+                project_id=project_id,
+                body=body,
+                created_at=created_at,
+            )
+        )
+        if len(batch) >= batch_size:
+            SearchDocument.objects.bulk_create(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        SearchDocument.objects.bulk_create(batch)
+        total += len(batch)
+    return total
+
+
+def parse_query(text):
+    # User text never reaches MATCH verbatim: each word becomes a quoted
+    # phrase (implicit AND). No prefix queries: FTS5 merges the postings of
+    # every expansion across the whole table, which defeats the user range.
+    terms = re.findall(r'\w+', (text or '').lower())[:MAX_QUERY_TERMS]
+    return ' '.join(f'"{term}"' for term in terms)
+
+
+def _snippet(marked, words=SNIPPET_WORDS):
+    tokens = marked.split()
+    first = next((index for index, token in enumerate(tokens) if MATCH_START in token), 0)
+    start = max(0, first - words // 4)
+    window = ' '.join(tokens[start:start + words])
+    if start > 0:
+        window = '…' + window
+    if start + words < len(tokens):
+        window += '…'
+    return window.replace(MATCH_START, '[').replace(MATCH_END, ']')
+
+
+def _fts5_hits(user_id, text, kinds, project_id, limit, offset):
+    # bm25() ranks every match of the user's, whatever its age; the page is
+    # cut in SQL.
+    sql = (
+        f'SELECT d.id, -bm25({FTS_TABLE}), highlight({FTS_TABLE}, 0, %s, %s)'
+        f' FROM {FTS_TABLE} JOIN {DOCUMENT_TABLE} d ON d.id = {FTS_TABLE}.rowid'
+        f' WHERE {FTS_TABLE} MATCH %s AND d.user_id = %s'
+    )
+    params = [MATCH_START, MATCH_END, parse_query(text), user_id]
+    sql, params = _filters(sql, params, kinds, project_id)
+    sql += f' ORDER BY bm25({FTS_TABLE}), d.id DESC LIMIT %s OFFSET %s'
+    params += [limit, offset]
+    with _read_cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(doc_id, score, _snippet(marked)) for doc_id, score, marked in cursor.fetchall()]
+
+
+def _tsvector_hits(user_id, text, kinds, project_id, limit, offset):
+    # websearch_to_tsquery accepts arbitrary user input without syntax errors.
+    sql = (
+        "SELECT d.id, ts_rank_cd(to_tsvector('english', d.body), q) AS score,"
+        " ts_headline('english', d.body, q, 'StartSel=[, StopSel=], MaxWords=16')"
+        f" FROM {DOCUMENT_TABLE} d, websearch_to_tsquery('english', %s) q"
+        " WHERE d.user_id = %s AND to_tsvector('english', d.body) @@ q"
+    )
+    params = [text, user_id]
+    sql, params = _filters(sql, params, kinds, project_id)
+    sql += ' ORDER BY score DESC, d.id DESC LIMIT %s OFFSET %s'
+    params += [limit, offset]
+    with _read_cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _scan_hits(user_id, text, kinds, project_id, limit, offset):
+    from .models import SearchDocument
+
+    documents = SearchDocument.objects.filter(user_id=user_id)
+    for term in re.findall(r'\w+', text)[:MAX_QUERY_TERMS]:
+        documents = documents.filter(body__icontains=term)
+    if kinds:
+        documents = documents.filter(kind__in=kinds)
+    if project_id:
+        documents = documents.filter(project_id=project_id)
+    rows = documents.order_by('-id').values_list('id', 'body')[offset:offset + limit]
+    return [(doc_id, 0.0, body[:200]) for doc_id, body in rows]
+
+
+def _filters(sql, params, kinds, project_id):
+    if kinds:
+        sql += f' AND d.kind IN ({", ".join(["%s"] * len(kinds))})'
+        params += list(kinds)
+    if project_id:
+        sql += ' AND d.project_id = %s'
+        params.append(project_id)
+    return sql, params
+
+
+def _read_cursor():
+    # On whichever database SearchDocument reads are routed to.
+    from .models import SearchDocument
+
+    return connections[router.db_for_read(SearchDocument)].cursor()
+
+
+HIT_FINDERS = {'fts5': _fts5_hits, 'tsvector': _tsvector_hits, 'scan': _scan_hits}
+
+
+def search_documents(user_id, text, kinds=None, project_id=None, limit=SEARCH_PAGE_DEFAULT, offset=0):
+    """Ranked page of a user's documents matching text, best first.
+
+    Returns (results, has_more); each result carries kind, object_id,
+    project_id, created_at, score and a snippet with matches in [brackets].
+    """
+    from .models import SearchDocument
+
+    if not parse_query(text):
+        return [], False
+    find = HIT_FINDERS[search_backend(connection.vendor)]
+    hits = find(user_id, text, kinds, project_id, limit + 1, offset)
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+    documents = SearchDocument.objects.in_bulk([doc_id for doc_id, _, _ in hits])
+    results = []
+    for doc_id, score, snippet in hits:
+        document = documents[doc_id]
+        results.append(
+            {
+                'kind': document.kind,
+                'object_id': document.object_id,
+                'project_id': document.project_id,
+                'created_at': document.created_at,
+                'score': round(float(score), 4),
+                'snippet': snippet,
+            }
+        )
+    return results, has_more
@@ -59,7 +59,31 @@ class GeneratedImageSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'design_version']
 
 
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Looks ids up in context['prefetched'][model] when the caller loaded them.
+
+    Lets a many=True serializer validate a batch with one query per table;
+    errors are the ones PrimaryKeyRelatedField would report.
+    """
+
+    def to_internal_value(self, data):
+        prefetched = self.context.get('prefetched', {}).get(self.get_queryset().model)
+        if prefetched is None:
+            return super().to_internal_value(data)
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            pk = int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if pk not in prefetched:
+            self.fail('does_not_exist', pk_value=data)
+        return prefetched[pk]
+
+
 class FeedbackEventSerializer(serializers.ModelSerializer):
+    serializer_related_field = PrefetchedPrimaryKeyRelatedField
+
     class Meta:
         model = FeedbackEvent
         fields = [
@@ -72,6 +96,30 @@ class FeedbackEventSerializer(serializers.ModelSerializer):
             'created_at',
         ]
         read_only_fields = ['id', 'created_at']
+        extra_kwargs = {'user': {'default': serializers.CurrentUserDefault()}}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        if request is not None and request.user.is_authenticated:
+            # Events are recorded for the caller, on the caller's projects.
+            user = request.user
+            fields['user'].queryset = User.objects.filter(pk=user.pk)
+            fields['project'].queryset = Project.objects.filter(user=user)
+            fields['design_version'].queryset = DesignVersion.objects.filter(project__user=user)
+        return fields
+
+    def validate_payload_json(self, value):
+        if not isinstance(value, dict):
+            raise serializers.ValidationError('Must be an object')
+        return value
+
+    def validate(self, attrs):
+        version = attrs.get('design_version')
+        project = attrs.get('project', getattr(self.instance, 'project', None))
+        if version is not None and version.project_id != project.id:
+            raise serializers.ValidationError({'design_version': ['Version does not belong to the project']})
+        return attrs
 
 
 class PreferenceSerializer(serializers.ModelSerializer):
@@ -101,3 +149,15 @@ class ChatMessageSerializer(serializers.ModelSerializer):
             'created_at',
         ]
         read_only_fields = ['id', 'user', 'project', 'created_at']
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data['metadata_json'] = instance.full_metadata
+        return data
+
+
+class ChatMessageSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChatMessage
+        fields = ['id', 'user', 'project', 'role', 'content', 'created_at']
+        read_only_fields = fields
@@ -0,0 +1,43 @@
+from .models import FeedbackEvent, Preference, Project
+from .retrieval import PREFERENCE_LIMIT, RECENT_EVENT_LIMIT, get_canonical_version
+
+# Rows a ChatConsumer reads on every turn, kept for the life of the
+# connection. memory.signals publishes 'session.invalidate' messages to the
+# project_<id> and user_<id> groups when they change; the consumer marks the
+# named parts stale and refresh() reloads only those before the next turn.
+
+PARTS = ('project', 'preferences', 'events', 'canonical')
+
+
+class ChatSession:
+    def __init__(self, user, project_id):
+        self.user = user
+        self.project_id = int(project_id)
+        self.project = None
+        self.preferences = []
+        self.events = []
+        self.canonical_version = None
+        self.stale = set(PARTS)
+
+    def invalidate(self, parts):
+        self.stale.update(part for part in parts if part in PARTS)
+
+    def refresh(self):
+        # Swap before loading so an invalidation that lands mid-refresh
+        # still marks its part stale for the next turn.
+        stale, self.stale = self.stale, set()
+        if 'project' in stale:
+            self.project = Project.objects.filter(id=self.project_id, user=self.user).first()
+        if 'preferences' in stale:
+            self.preferences = list(
+                Preference.objects.filter(user=self.user)
+                .order_by('-confidence', '-updated_at')[:PREFERENCE_LIMIT]
+            )
+        if 'events' in stale:
+            self.events = list(
+                FeedbackEvent.objects.filter(project_id=self.project_id)
+                .order_by('-created_at')[:RECENT_EVENT_LIMIT]
+            )
+        if 'canonical' in stale:
+            self.canonical_version = get_canonical_version(self.project_id)
+        return self
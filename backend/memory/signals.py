@@ -0,0 +1,225 @@
+import threading
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .changes import change_event, record_change
+from .events import invalidate_sessions
+from .models import (
+    ChatMessage,
+    ContextSnapshot,
+    DesignVersion,
+    FeedbackEvent,
+    GeneratedImage,
+    Preference,
+    Project,
+    SearchDocument,
+)
+from .replay import recent_messages
+from .snapshots import delete_unreferenced_snapshots
+
+# Keeps memory_searchdocument in step with the rows it mirrors, tells open
+# chat sessions when rows they cache change, feeds the replay buffer and
+# records change events for the owner's sockets (memory.changes).
+# Bulk writes (bulk_create, bulk_update, QuerySet.update) bypass these
+# receivers. Bulk inserts of chat messages call messages_created; for other
+# bulk writes, run `manage.py rebuild_search_index` after them, and call
+# invalidate_sessions, record_change for each changed row and, for
+# messages, Project.messages_changed directly (see
+# learning.process_feedback_events).
+
+
+def _sync(kind, instance, created, user_id, project_id, body):
+    if not body:
+        if not created:
+            SearchDocument.objects.filter(kind=kind, object_id=instance.pk).delete()
+        return
+    fields = {
+        'user_id': user_id,
+        'project_id': project_id,
+        'body': body,
+        'created_at': instance.created_at,
+    }
+    if created:
+        SearchDocument.objects.create(kind=kind, object_id=instance.pk, **fields)
+    else:
+        SearchDocument.objects.update_or_create(kind=kind, object_id=instance.pk, defaults=fields)
+
+
+def _buffer(message):
+    transaction.on_commit(lambda: recent_messages().record(message))
+
+
+def messages_created(messages):
+    """Everything that follows inserting ChatMessages: index, buffer, notify.
+
+    post_save runs it for a message saved on its own; bulk inserts, which
+    send no post_save (memory.writebehind), call it for the batch. A new
+    side effect of creating a message belongs here, not in another
+    post_save receiver that bulk inserts would skip.
+    """
+    SearchDocument.objects.bulk_create(
+        [
+            SearchDocument(
+                kind='message',
+                object_id=message.pk,
+                user_id=message.user_id,
+                project_id=message.project_id,
+                body=message.content,
+                created_at=message.created_at,
+            )
+            for message in messages
+            if message.content
+        ]
+    )
+    for message in messages:
+        _buffer(message)
+        event = change_event('message', message, 'created', project_id=message.project_id)
+        record_change(message.user_id, event)
+
+
+@receiver(post_save, sender=ChatMessage)
+def message_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        messages_created([instance])
+        return
+    _sync('message', instance, False, instance.user_id, instance.project_id, instance.content)
+    _buffer(instance)
+    record_change(instance.user_id, change_event('message', instance, 'updated', project_id=instance.project_id))
+
+
+@receiver(post_delete, sender=ChatMessage)
+def unbuffer_message(sender, instance, **kwargs):
+    transaction.on_commit(lambda: recent_messages().forget(instance.project_id))
+
+
+_released_snapshots = threading.local()
+
+
+def _sweep_released_snapshots():
+    digests = _released_snapshots.__dict__.pop('digests', None)
+    if digests:
+        delete_unreferenced_snapshots(ChatMessage, ContextSnapshot, digests)
+
+
+@receiver(post_delete, sender=ChatMessage)
+def release_snapshot(sender, instance, **kwargs):
+    # A project or user delete cascades to many messages: collect their
+    # digests and check them in one sweep once the delete commits. Digests
+    # left by a rolled-back delete are swept with the next one; the sweep
+    # only removes snapshots nothing references.
+    if instance.context_snapshot_id is None:
+        return
+    if not hasattr(_released_snapshots, 'digests'):
+        _released_snapshots.digests = set()
+    _released_snapshots.digests.add(instance.context_snapshot_id)
+    transaction.on_commit(_sweep_released_snapshots)
+
+
+@receiver(post_save, sender=DesignVersion)
+def index_version(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    user_id = instance.project.user_id
+    _sync('version', instance, created, user_id, instance.project_id, instance.notes)
+
+
+@receiver(post_save, sender=GeneratedImage)
+def index_image(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    # Images are usually created with their version object in hand.
+    if GeneratedImage.design_version.is_cached(instance) and DesignVersion.project.is_cached(
+        instance.design_version
+    ):
+        project = instance.design_version.project
+        project_id, user_id = project.id, project.user_id
+    else:
+        project_id, user_id = DesignVersion.objects.filter(
+            id=instance.design_version_id
+        ).values_list('project_id', 'project__user_id').get()
+    _sync('image', instance, created, user_id, project_id, instance.prompt)
+
+
+@receiver(post_delete, sender=ChatMessage)
+@receiver(post_delete, sender=DesignVersion)
+@receiver(post_delete, sender=GeneratedImage)
+def unindex(sender, instance, **kwargs):
+    kind = {ChatMessage: 'message', DesignVersion: 'version', GeneratedImage: 'image'}[sender]
+    SearchDocument.objects.filter(kind=kind, object_id=instance.pk).delete()
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+def invalidate_project(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_sessions(['project'], project_ids=[instance.pk])
+
+
+@receiver(post_save, sender=Preference)
+@receiver(post_delete, sender=Preference)
+def invalidate_preferences(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_sessions(['preferences'], user_ids=[instance.user_id])
+
+
+@receiver(post_save, sender=FeedbackEvent)
+@receiver(post_delete, sender=FeedbackEvent)
+def invalidate_feedback(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_sessions(['events', 'canonical'], project_ids=[instance.project_id])
+
+
+@receiver(post_delete, sender=DesignVersion)
+def invalidate_version(sender, instance, **kwargs):
+    # Deleting a version nulls the design_version of its feedback events.
+    invalidate_sessions(['events', 'canonical'], project_ids=[instance.project_id])
+
+
+def _op(signal, created):
+    if signal is post_delete:
+        return 'deleted'
+    return 'created' if created else 'updated'
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+def project_changed(sender, instance, signal, created=False, raw=False, **kwargs):
+    if not raw:
+        updated_at = None if signal is post_delete else instance.updated_at
+        event = change_event('project', instance, _op(signal, created), updated_at=updated_at)
+        record_change(instance.user_id, event)
+
+
+@receiver(post_delete, sender=ChatMessage)
+def message_deleted(sender, instance, origin=None, **kwargs):
+    # Not when a project or user delete cascades: the project goes too.
+    if getattr(origin, 'model', type(origin)) is ChatMessage:
+        Project.messages_changed([instance.project_id])
+    record_change(instance.user_id, change_event('message', instance, 'deleted', project_id=instance.project_id))
+
+
+@receiver(post_save, sender=DesignVersion)
+@receiver(post_delete, sender=DesignVersion)
+def version_changed(sender, instance, signal, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    if DesignVersion.project.is_cached(instance):
+        user_id = instance.project.user_id
+    else:
+        user_id = Project.objects.filter(id=instance.project_id).values_list('user_id', flat=True).first()
+    if user_id is not None:
+        event = change_event('version', instance, _op(signal, created), project_id=instance.project_id)
+        record_change(user_id, event)
+
+
+@receiver(post_save, sender=Preference)
+@receiver(post_delete, sender=Preference)
+def preference_changed(sender, instance, signal, created=False, raw=False, **kwargs):
+    if not raw:
+        updated_at = None if signal is post_delete else instance.updated_at
+        event = change_event('preference', instance, _op(signal, created), updated_at=updated_at)
+        record_change(instance.user_id, event)
@@ -0,0 +1,78 @@
+import hashlib
+import json
+
+from django.db.models import Exists, OuterRef
+
+# Used by models and by `manage.py dedup_context_snapshots`. Migration 0004
+# has its own frozen copy of the backfill.
+
+
+def canonical_json(payload):
+    return json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def context_digest(payload):
+    return hashlib.sha256(canonical_json(payload).encode('utf-8')).hexdigest()
+
+
+def dedup_message_contexts(ChatMessage, ContextSnapshot, batch_size=1000):
+    # Walks assistant messages in id order, batch by batch, moving inline
+    # resolved_context copies into content-addressed snapshots.
+    stats = {'messages': 0, 'snapshots': 0, 'bytes_before': 0, 'bytes_after': 0}
+    seen = set()
+    last_id = 0
+    while True:
+        batch = list(
+            ChatMessage.objects.filter(id__gt=last_id, context_snapshot__isnull=True)
+            .order_by('id')
+            .only('id', 'metadata_json')[:batch_size]
+        )
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        snapshots = {}
+        changed = []
+        for message in batch:
+            metadata = message.metadata_json or {}
+            context = metadata.get('resolved_context')
+            if not isinstance(context, dict):
+                continue
+            encoded = canonical_json(context)
+            digest = hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+            stats['bytes_before'] += len(encoded.encode('utf-8'))
+            stats['bytes_after'] += len(digest)
+            if digest not in seen:
+                seen.add(digest)
+                snapshots[digest] = ContextSnapshot(digest=digest, payload=context)
+                stats['bytes_after'] += len(encoded.encode('utf-8'))
+            message.metadata_json = {
+                key: value for key, value in metadata.items() if key != 'resolved_context'
+            }
+            message.context_snapshot_id = digest
+            changed.append(message)
+
+        if snapshots:
+            ContextSnapshot.objects.bulk_create(snapshots.values(), ignore_conflicts=True)
+            stats['snapshots'] += len(snapshots)
+        if changed:
+            ChatMessage.objects.bulk_update(changed, ['metadata_json', 'context_snapshot'])
+            stats['messages'] += len(changed)
+    stats['bytes_saved'] = stats['bytes_before'] - stats['bytes_after']
+    return stats
+
+
+
+def delete_unreferenced_snapshots(ChatMessage, ContextSnapshot, digests=None, batch_size=500):
+    # Snapshots hold preference data, so one no message points at any more
+    # goes. With digests, only those are checked (after a delete); without,
+    # the whole table is swept. Returns how many were deleted.
+    referenced = ChatMessage.objects.filter(context_snapshot=OuterRef('pk'))
+    unreferenced = ContextSnapshot.objects.filter(~Exists(referenced))
+    if digests is None:
+        return unreferenced.delete()[0]
+    digests = sorted(digests)
+    deleted = 0
+    for start in range(0, len(digests), batch_size):
+        deleted += unreferenced.filter(digest__in=digests[start:start + batch_size]).delete()[0]
+    return deleted
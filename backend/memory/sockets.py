@@ -0,0 +1,156 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import types
+from collections import deque
+
+# This process's open chat sockets, for heartbeats, the per-user idle cap
+# and GET /api/admin/connections. ChatConsumer registers a SocketStats at
+# accept and removes it on disconnect or when it reaps the socket itself:
+# a socket the client has not answered for CHAT_HEARTBEAT_TIMEOUT seconds
+# (4008), or the least recently used of a user's idle sockets beyond
+# CHAT_IDLE_CONNECTIONS_PER_USER (4009). Everything here is per process;
+# each ASGI worker reports and caps its own sockets.
+
+HEARTBEAT_CLOSE_CODE = 4008
+IDLE_CLOSE_CODE = 4009
+
+# Shared machinery a connection points at but does not own.
+_NOT_OWNED = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    types.MethodType,
+    asyncio.AbstractEventLoop,
+    asyncio.Future,
+    type(threading.Lock()),
+)
+
+
+def deep_size(*roots):
+    """Approximate bytes held by roots and everything reachable from them."""
+    seen = set()
+    stack = list(roots)
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _NOT_OWNED):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            # Copies, since the event loop may be changing them meanwhile.
+            for key, value in list(obj.items()):
+                stack.append(key)
+                stack.append(value)
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(list(obj))
+        elif hasattr(obj, '__dict__'):
+            stack.append(vars(obj))
+    return total
+
+
+def _encoded_size(data):
+    if isinstance(data, str):
+        return len(data) if data.isascii() else len(data.encode('utf-8'))
+    return len(data)
+
+
+class SocketStats:
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.user_id = consumer.user.id
+        self.project_id = int(consumer.project_id)
+        self.connected_at = time.time()
+        self.last_received = time.monotonic()
+        self.last_active = self.last_received
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+
+    def received(self, data):
+        # Any frame, pongs included, proves the socket is alive.
+        self.last_received = time.monotonic()
+        self.frames_received += 1
+        self.bytes_received += _encoded_size(data or '')
+
+    def active(self):
+        # A real request from the user; orders sockets for the idle cap.
+        self.last_active = time.monotonic()
+
+    def sent(self, data):
+        self.frames_sent += 1
+        self.bytes_sent += _encoded_size(data)
+
+    def silent_for(self):
+        return time.monotonic() - self.last_received
+
+    def idle(self):
+        return not self.consumer.turns
+
+    def as_dict(self):
+        consumer = self.consumer
+        now = time.monotonic()
+        return {
+            'channel': consumer.channel_name,
+            'user_id': self.user_id,
+            'project_id': self.project_id,
+            'age_seconds': round(time.time() - self.connected_at, 1),
+            'silent_seconds': round(now - self.last_received, 1),
+            'inactive_seconds': round(now - self.last_active, 1),
+            'turns_in_flight': len(consumer.turns),
+            'encoding': consumer.codec.name,
+            'frames_sent': self.frames_sent,
+            'bytes_sent': self.bytes_sent,
+            'frames_received': self.frames_received,
+            'bytes_received': self.bytes_received,
+            'memory_bytes': deep_size(consumer.session, consumer.turns, consumer.groups),
+        }
+
+
+class SocketRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sockets = {}
+
+    def add(self, stats):
+        with self._lock:
+            self._sockets[stats.consumer.channel_name] = stats
+
+    def remove(self, channel_name):
+        with self._lock:
+            self._sockets.pop(channel_name, None)
+
+    def excess_idle(self, user_id, limit):
+        """The user's idle sockets beyond limit, least recently active first."""
+        with self._lock:
+            idle = [stats for stats in self._sockets.values() if stats.user_id == user_id and stats.idle()]
+        idle.sort(key=lambda stats: stats.last_active)
+        return idle[: max(0, len(idle) - limit)]
+
+    def report(self):
+        with self._lock:
+            sockets = list(self._sockets.values())
+        connections = [stats.as_dict() for stats in sockets]
+        return {
+            'pid': os.getpid(),
+            'connections': connections,
+            'totals': {
+                'connections': len(connections),
+                'users': len({row['user_id'] for row in connections}),
+                'turns_in_flight': sum(row['turns_in_flight'] for row in connections),
+                'bytes_sent': sum(row['bytes_sent'] for row in connections),
+                'memory_bytes': sum(row['memory_bytes'] for row in connections),
+            },
+        }
+
+
+_registry = SocketRegistry()
+
+
+def sockets():
+    return _registry
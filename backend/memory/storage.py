@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Per-connection SQLite tuning for the sqlite-wal storage profile (see
+# DATABASE_PROFILE in settings). Pragmas are connection state, except
+# journal_mode=wal which sticks to the file, so they are applied to every
+# new connection: request threads, the write-behind writer, the channel
+# layer's thread and the image workers alike.
+
+
+def sqlite_pragmas(connection):
+    """The pragmas applied to this connection, as SQLite reports them back."""
+    with connection.cursor() as cursor:
+        return {name: cursor.execute(f'PRAGMA {name}').fetchone()[0] for name in settings.SQLITE_PRAGMAS}
+
+
+@receiver(connection_created)
+def _tune_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+        return
+    # On the raw connection, in one call: this runs on every connect and
+    # should not show up as queries of whatever opened the connection.
+    connection.connection.executescript(
+        ''.join(f'PRAGMA {name} = {value};' for name, value in settings.SQLITE_PRAGMAS.items())
+    )
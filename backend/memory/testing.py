@@ -0,0 +1,55 @@
+import json
+from urllib.parse import urlencode
+
+from asgiref.testing import ApplicationCommunicator
+
+# channels.testing pulls in daphne for its live-server case; this is the
+# subset of WebsocketCommunicator the tests and benchmarks need.
+
+
+class WebsocketClient(ApplicationCommunicator):
+    def __init__(self, application, path, params=None):
+        query_string = urlencode(params or {}).encode('ascii')
+        super().__init__(
+            application,
+            {
+                'type': 'websocket',
+                'path': path,
+                'query_string': query_string,
+                'headers': [],
+                'subprotocols': [],
+            },
+        )
+
+    async def connect(self, timeout=1):
+        await self.send_input({'type': 'websocket.connect'})
+        response = await self.receive_output(timeout)
+        return response['type'] == 'websocket.accept'
+
+    async def send_json(self, data):
+        await self.send_input({'type': 'websocket.receive', 'text': json.dumps(data)})
+
+    async def send_bytes(self, data):
+        await self.send_input({'type': 'websocket.receive', 'bytes': data})
+
+    async def receive_frame(self, timeout=1):
+        response = await self.receive_output(timeout)
+        if response['type'] == 'websocket.close':
+            return response
+        return response.get('text') if response.get('text') is not None else response.get('bytes')
+
+    async def receive_json(self, timeout=1):
+        frame = await self.receive_frame(timeout)
+        if isinstance(frame, dict):
+            raise AssertionError(f'Socket closed: {frame}')
+        return json.loads(frame)
+
+    async def receive_until(self, frame_type, timeout=1):
+        while True:
+            data = await self.receive_json(timeout)
+            if data.get('type') == frame_type:
+                return data
+
+    async def disconnect(self, code=1000, timeout=1):
+        await self.send_input({'type': 'websocket.disconnect', 'code': code})
+        await self.wait(timeout)
@@ -1,13 +1,72 @@
+import asyncio
+import http.client
+import io
+import json
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import uuid
+import zlib
+from datetime import timedelta
+from unittest import mock
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.conf import settings
+from django.db import IntegrityError, connections
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from rest_framework import serializers as drf_serializers
 from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
 
+from asgiref.sync import sync_to_async
 from django.utils import timezone
 
+from benchmarks.harness import MEMORY_NOISE_KB, baseline_warnings, compare
+
+from .admission import AdmissionController, CacheStore, LocalStore, Rejected
+from .changes import ChangeFeed, change_feed
+from .framing import CODECS, DECODE_ERRORS, MAX_FRAME, cbor_dumps, cbor_loads, negotiate
+from .imaging import LocalPNGRenderer, run_job
 from .learning import process_feedback_event
-from .models import ChatMessage, DesignVersion, FeedbackEvent, Preference, Project
+from .llm.clients import ClaudeClient
+from .llm.service import _mock_agent_response
+from .models import (
+    ChatMessage,
+    ContextSnapshot,
+    DesignVersion,
+    FeedbackEvent,
+    GeneratedImage,
+    ImageJob,
+    Preference,
+    Project,
+    SearchDocument,
+)
+from .pipeline import run_turn
+from .readpath import FastJSONRenderer, _plan, datetime_formatter
+from .replay import RecentMessages
+from .routers import ReadReplicaRouter, read_scope
+from .search import search_documents
+from .sockets import HEARTBEAT_CLOSE_CODE, IDLE_CLOSE_CODE, sockets
+from .signals import _sweep_released_snapshots
+from .storage import sqlite_pragmas
 from .retrieval import get_canonical_version, resolve_context
+from .serializers import (
+    DesignVersionSerializer,
+    FeedbackEventSerializer,
+    GeneratedImageSerializer,
+    PreferenceSerializer,
+    ProjectSerializer,
+)
+from .testing import WebsocketClient
+from .writebehind import ReplyWriter, write_replies
 
 
 User = get_user_model()
@@ -175,3 +234,2013 @@ class ContextResolvePreferenceTests(TestCase):
         )
         self.assertIsNotNone(payload['reference_project'])
         self.assertTrue(any(pref['key'] == 'tone' for pref in payload['preferences']))
+
+
+class AsyncAgentChatTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='async-agent', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='office', title='Async Office')
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+
+    def test_agent_chat_rejects_missing_token(self):
+        response = self.client.post(
+            '/api/agent/chat',
+            {'project_id': self.project.id, 'message': 'Hi'},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(ADMISSION_BURST=20, ADMISSION_USER_CONCURRENCY=20)
+    async def test_concurrent_turns_overlap_llm_waits(self):
+        async def slow_llm(context, message):
+            await asyncio.sleep(0.2)
+            return {
+                'reply': f'ok: {message}',
+                'design_options': [],
+                'version_action': {'type': 'none'},
+                'preference_hints': [],
+            }
+
+        client = AsyncClient()
+        started = time.monotonic()
+        with mock.patch('memory.pipeline.agenerate_agent_response', slow_llm):
+            responses = await asyncio.gather(
+                *[
+                    client.post(
+                        '/api/agent/chat',
+                        {'project_id': self.project.id, 'message': f'turn {index}'},
+                        content_type='application/json',
+                        headers={'Authorization': f'Token {self.token.key}'},
+                    )
+                    for index in range(20)
+                ]
+            )
+        elapsed = time.monotonic() - started
+        self.assertTrue(all(response.status_code == 200 for response in responses))
+        self.assertLess(elapsed, 20 * 0.2 / 2)
+        self.assertEqual(
+            await ChatMessage.objects.filter(project=self.project, role='assistant').acount(),
+            20,
+        )
+
+
+class AgentPipelineTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='pipeline', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='bedroom', title='Pipeline')
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+
+    async def test_socket_turn_applies_version_action(self):
+        from backend.asgi import application
+
+        client = WebsocketClient(
+            application,
+            '/ws/chat/',
+            {'token': self.token.key, 'project_id': self.project.id},
+        )
+        self.assertTrue(await client.connect())
+        await client.receive_until('connected')
+        with mock.patch.dict(os.environ, {'MOCK_LLM': 'true'}):
+            await client.send_json({'type': 'user_message', 'message': 'warmer please'})
+            frame = await client.receive_until('assistant_message', timeout=5)
+        await client.disconnect()
+        metadata = frame['metadata_json']
+        self.assertEqual(metadata['action_type'], 'create_version')
+        version = await DesignVersion.objects.aget(id=metadata['version_id'])
+        self.assertEqual(version.project_id, self.project.id)
+        self.assertEqual(
+            [option['image_id'] for option in metadata['design_options']],
+            [image['id'] for image in metadata['created_images']],
+        )
+        self.assertEqual(await ImageJob.objects.filter(image__design_version=version).acount(), 2)
+        self.assertEqual(
+            set(metadata['timings']),
+            {'persist_user', 'resolve', 'generate', 'apply', 'total'},
+        )
+        roles = [
+            role
+            async for role in ChatMessage.objects.filter(project=self.project)
+            .order_by('created_at', 'id')
+            .values_list('role', flat=True)
+        ]
+        self.assertEqual(roles, ['user', 'assistant'])
+
+    def test_sync_turn_saves_new_version_when_no_canonical(self):
+        with mock.patch.dict(os.environ, {'MOCK_LLM': 'true'}):
+            assistant = run_turn(self.user, self.project, 'save this look')
+        metadata = assistant.metadata_json
+        self.assertTrue(metadata['saved'])
+        self.assertEqual(get_canonical_version(self.project.id).id, metadata['version_id'])
+        self.assertGreaterEqual(metadata['timings']['total'], metadata['timings']['generate'])
+        self.assertEqual(
+            assistant.full_metadata['resolved_context']['target_project']['id'],
+            self.project.id,
+        )
+
+
+class ProjectPreviewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='previewer', password='pass1234')
+        self.client = APIClient()
+        token, _ = Token.objects.get_or_create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.projects = [
+            Project.objects.create(user=self.user, room_type='bedroom', title=f'Room {index}')
+            for index in range(3)
+        ]
+        for project in self.projects[:2]:
+            for index in range(5):
+                ChatMessage.objects.create(
+                    user=self.user,
+                    project=project,
+                    role='user',
+                    content=f'{project.title} message {index}',
+                )
+
+    def test_create_maintains_last_message_pointer(self):
+        self.projects[0].refresh_from_db()
+        latest = ChatMessage.objects.filter(project=self.projects[0]).order_by('-id').first()
+        self.assertEqual(self.projects[0].last_message_id, latest.id)
+
+    def test_previews_return_latest_message_per_project(self):
+        # token auth, ETag validator, previews
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/projects/previews/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(set(data), {str(self.projects[0].id), str(self.projects[1].id)})
+        self.assertEqual(data[str(self.projects[1].id)]['content'], 'Room 1 message 4')
+
+    def test_previews_fall_back_when_pointer_missing(self):
+        Project.objects.update(last_message=None)
+        response = self.client.get('/api/projects/previews/')
+        self.assertEqual(response.json()[str(self.projects[0].id)]['content'], 'Room 0 message 4')
+
+
+class MessageHistoryPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='historian', password='pass1234')
+        self.client = APIClient()
+        token, _ = Token.objects.get_or_create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.project = Project.objects.create(user=self.user, room_type='kitchen', title='Kitchen')
+        self.messages = [
+            ChatMessage.objects.create(
+                user=self.user,
+                project=self.project,
+                role='assistant',
+                content=f'message {index}',
+                metadata_json={'resolved_context': {'index': index}},
+            )
+            for index in range(7)
+        ]
+        self.url = f'/api/projects/{self.project.id}/messages/'
+
+    def test_unpaginated_request_keeps_full_list(self):
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.json()), 7)
+
+    def test_latest_page_and_before_cursor(self):
+        first = self.client.get(self.url, {'limit': 3}).json()
+        self.assertEqual([m['content'] for m in first['results']], ['message 4', 'message 5', 'message 6'])
+        self.assertTrue(first['has_more'])
+        older = self.client.get(self.url, {'limit': 3, 'before': first['before']}).json()
+        self.assertEqual([m['content'] for m in older['results']], ['message 1', 'message 2', 'message 3'])
+        oldest = self.client.get(self.url, {'limit': 3, 'before': older['before']}).json()
+        self.assertEqual([m['content'] for m in oldest['results']], ['message 0'])
+        self.assertFalse(oldest['has_more'])
+
+    def test_after_cursor_returns_delta(self):
+        response = self.client.get(self.url, {'after': self.messages[4].id}).json()
+        self.assertEqual([m['id'] for m in response['results']], [self.messages[5].id, self.messages[6].id])
+        self.assertFalse(response['has_more'])
+        empty = self.client.get(self.url, {'after': self.messages[6].id}).json()
+        self.assertEqual(empty['results'], [])
+        self.assertEqual(empty['after'], self.messages[6].id)
+
+    def test_include_metadata_false_omits_metadata(self):
+        response = self.client.get(self.url, {'limit': 2, 'include_metadata': 'false'}).json()
+        self.assertNotIn('metadata_json', response['results'][0])
+
+    def test_foreign_cursor_is_rejected(self):
+        other = Project.objects.create(user=self.user, room_type='office', title='Other')
+        stray = ChatMessage.objects.create(user=self.user, project=other, role='user', content='x')
+        response = self.client.get(self.url, {'after': stray.id})
+        self.assertEqual(response.status_code, 400)
+
+    def test_non_numeric_cursor_is_rejected(self):
+        for key in ('before', 'after'):
+            response = self.client.get(self.url, {key: 'abc'})
+            self.assertEqual(response.status_code, 400)
+
+
+class VersionLineageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='lineage', password='pass1234')
+        self.client = APIClient()
+        token, _ = Token.objects.get_or_create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.project = Project.objects.create(user=self.user, room_type='bedroom', title='Tree')
+        self.root = DesignVersion.objects.create(project=self.project, notes='root')
+        self.child = DesignVersion.objects.create(project=self.project, parent_version=self.root)
+        self.sibling = DesignVersion.objects.create(project=self.project, parent_version=self.root)
+        self.grandchild = DesignVersion.objects.create(project=self.project, parent_version=self.child)
+        GeneratedImage.objects.create(
+            design_version=self.child,
+            prompt='p',
+            image_url='https://example.com/a.jpg',
+        )
+        FeedbackEvent.objects.create(
+            user=self.user,
+            project=self.project,
+            design_version=self.grandchild,
+            event_type='save',
+        )
+
+    def test_ancestors_and_descendants_use_one_query(self):
+        with self.assertNumQueries(1):
+            ancestors = set(self.grandchild.ancestors().values_list('id', flat=True))
+        self.assertEqual(ancestors, {self.child.id, self.root.id})
+        with self.assertNumQueries(1):
+            descendants = set(self.root.descendants().values_list('id', flat=True))
+        self.assertEqual(descendants, {self.child.id, self.sibling.id, self.grandchild.id})
+        self.assertFalse(self.root.ancestors().exists())
+
+    def test_tree_endpoint_marks_counts_and_canonical(self):
+        response = self.client.get(f'/api/projects/{self.project.id}/versions/tree/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['canonical_version_id'], self.grandchild.id)
+        nodes = {node['id']: node for node in data['nodes']}
+        self.assertEqual([node['id'] for node in data['nodes']], [
+            self.root.id, self.child.id, self.grandchild.id, self.sibling.id,
+        ])
+        self.assertEqual(nodes[self.grandchild.id]['depth'], 2)
+        self.assertEqual(nodes[self.child.id]['image_count'], 1)
+        self.assertTrue(nodes[self.grandchild.id]['is_canonical'])
+        self.assertTrue(nodes[self.grandchild.id]['saved'])
+
+    def test_ancestry_of_canonical(self):
+        response = self.client.get(
+            f'/api/projects/{self.project.id}/versions/tree/',
+            {'ancestors_of': 'canonical'},
+        )
+        ids = [node['id'] for node in response.json()['nodes']]
+        self.assertEqual(ids, [self.root.id, self.child.id, self.grandchild.id])
+
+    def test_deep_lineage(self):
+        parent = self.root
+        for number in range(10, 1010):
+            parent = DesignVersion.objects.create(
+                project=self.project,
+                parent_version=parent,
+                version_number=number,
+            )
+        self.assertEqual(parent.ancestors().count(), 1000)
+        response = self.client.get(
+            f'/api/projects/{self.project.id}/versions/tree/',
+            {'ancestors_of': parent.id},
+        )
+        self.assertEqual(response.json()['nodes'][-1]['depth'], 1000)
+
+    def test_tree_rejects_bad_anchors(self):
+        url = f'/api/projects/{self.project.id}/versions/tree/'
+        self.assertEqual(self.client.get(url, {'root': 'abc'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'ancestors_of': 'latest'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'root': 999999}).status_code, 404)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='poller', password='pass1234')
+        self.client = APIClient()
+        token, _ = Token.objects.get_or_create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.project = Project.objects.create(user=self.user, room_type='bedroom', title='Polled')
+        ChatMessage.objects.create(user=self.user, project=self.project, role='user', content='hi')
+
+    def assert_revalidates(self, url):
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        etag = first['ETag']
+        second = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second['ETag'], etag)
+        return etag
+
+    def test_messages_not_modified_until_new_message(self):
+        url = f'/api/projects/{self.project.id}/messages/'
+        etag = self.assert_revalidates(url)
+        # project lookup + auth only; the message table is not touched
+        with self.assertNumQueries(2):
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        ChatMessage.objects.create(user=self.user, project=self.project, role='user', content='again')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_messages_change_with_edits_bulk_inserts_and_deletes(self):
+        url = f'/api/projects/{self.project.id}/messages/'
+        message = ChatMessage.objects.get(project=self.project)
+
+        def edit():
+            message.metadata_json = {'pinned': True}
+            message.save()
+
+        def bulk_insert():
+            with self.captureOnCommitCallbacks(execute=True):
+                write_replies([ChatMessage(user=self.user, project=self.project, role='assistant', content='late')])
+
+        for write in (edit, bulk_insert, message.delete):
+            etag = self.assert_revalidates(url)
+            write()
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200, write)
+
+    def test_projects_and_previews_change_with_writes(self):
+        projects_etag = self.assert_revalidates('/api/projects/')
+        previews_etag = self.assert_revalidates('/api/projects/previews/')
+        ChatMessage.objects.create(user=self.user, project=self.project, role='user', content='new')
+        self.assertEqual(
+            self.client.get('/api/projects/previews/', HTTP_IF_NONE_MATCH=previews_etag).status_code,
+            200,
+        )
+        self.client.patch(f'/api/projects/{self.project.id}/', {'title': 'Renamed'}, format='json')
+        self.assertEqual(
+            self.client.get('/api/projects/', HTTP_IF_NONE_MATCH=projects_etag).status_code,
+            200,
+        )
+
+    def test_versions_change_when_version_added(self):
+        url = f'/api/projects/{self.project.id}/versions/'
+        etag = self.assert_revalidates(url)
+        DesignVersion.objects.create(project=self.project)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class GenerateLoadDataTests(TestCase):
+    def run_command(self, **options):
+        call_command('generate_load_data', stdout=io.StringIO(), **options)
+
+    def test_generates_linked_rows(self):
+        self.run_command(users=3, seed=7, messages=6, versions=4)
+        self.assertEqual(User.objects.filter(username__startswith='load-').count(), 3)
+        project = Project.objects.exclude(last_message=None).first()
+        latest = ChatMessage.objects.filter(project=project).order_by('-created_at', '-id').first()
+        self.assertEqual(project.last_message_id, latest.id)
+        version = DesignVersion.objects.exclude(parent_version=None).first()
+        self.assertEqual(version.parent_version.project_id, version.project_id)
+        self.assertTrue(ChatMessage.objects.create(user=project.user, project=project, role='user', content='x').id)
+
+    def test_seed_is_deterministic(self):
+        self.run_command(users=2, seed=3, prefix='a')
+        first = list(ChatMessage.objects.order_by('id').values_list('content', 'role'))
+        ChatMessage.objects.all().delete()
+        self.run_command(users=2, seed=3, prefix='b')
+        second = list(ChatMessage.objects.order_by('id').values_list('content', 'role'))
+        self.assertEqual(first, second)
+
+
+class FeedbackBatchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='batcher', password='pass1234')
+        self.client = APIClient()
+        token, _ = Token.objects.get_or_create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.project = Project.objects.create(user=self.user, room_type='bedroom', title='Batch')
+        self.version = DesignVersion.objects.create(project=self.project)
+        Preference.objects.create(user=self.user, key='tone', value='cool', confidence=0.2, source='explicit')
+
+    def event(self, event_type, **payload):
+        return {
+            'project': self.project.id,
+            'design_version': self.version.id,
+            'event_type': event_type,
+            'payload_json': payload,
+        }
+
+    def test_batch_matches_sequential_learning(self):
+        events = [
+            self.event('modify', text='make it warmer'),
+            self.event('select', selected_option_index=2),
+            self.event('modify', text='warm tones and plants'),
+            self.event('select', selected_option_index=4),
+        ]
+        response = self.client.post('/api/feedback/batch/', {'events': events}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 4)
+        self.assertEqual(FeedbackEvent.objects.filter(project=self.project).count(), 4)
+
+        tone = Preference.objects.get(user=self.user, key='tone')
+        self.assertEqual(tone.value, 'warm')
+        self.assertAlmostEqual(tone.confidence, 0.8)
+        favorite = Preference.objects.get(user=self.user, key='favorite_option_index')
+        self.assertEqual(favorite.value, '4')
+        self.assertEqual(favorite.confidence, 1.0)
+        self.assertAlmostEqual(Preference.objects.get(user=self.user, key='plants').confidence, 0.3)
+
+    def test_batch_records_preference_changes(self):
+        events = [self.event('modify', text='warm tones and plants')]
+        with mock.patch.object(change_feed(), 'add') as add, self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/feedback/batch/', events, format='json')
+        calls = [call.args for call in add.call_args_list]
+        self.assertEqual({user_id for user_id, _ in calls}, {self.user.id})
+        recorded = {(event['entity'], event['id']): event['op'] for _, event in calls}
+        tone = Preference.objects.get(user=self.user, key='tone')
+        plants = Preference.objects.get(user=self.user, key='plants')
+        self.assertEqual(recorded, {('preference', tone.id): 'updated', ('preference', plants.id): 'created'})
+
+    def test_batch_query_count_is_constant(self):
+        events = [self.event('modify', text='make it warmer') for _ in range(50)]
+        # auth, 2 validation lookups, savepoint pair, insert, pref read + update
+        with self.assertNumQueries(8):
+            self.client.post('/api/feedback/batch/', events, format='json')
+
+    def test_invalid_item_rejects_whole_batch(self):
+        other_project = Project.objects.create(
+            user=User.objects.create(username='stranger', email='stranger@example.com'),
+            room_type='office',
+            title='Not mine',
+        )
+        events = [
+            self.event('modify', text='warmer'),
+            {'project': other_project.id, 'event_type': 'save'},
+            {'project': self.project.id, 'event_type': 'explode'},
+        ]
+        response = self.client.post('/api/feedback/batch/', events, format='json')
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['errors']
+        self.assertEqual([error['index'] for error in errors], [1, 2])
+        self.assertIn('project', errors[0]['errors'])
+        self.assertIn('event_type', errors[1]['errors'])
+        self.assertFalse(FeedbackEvent.objects.exists())
+        self.assertEqual(Preference.objects.get(user=self.user, key='tone').value, 'cool')
+
+    def test_batch_and_single_endpoint_share_validation(self):
+        stranger = User.objects.create(username='outsider', email='outsider@example.com')
+        other_version = DesignVersion.objects.create(project=self.project)
+        other_project = Project.objects.create(user=self.user, room_type='office', title='Second')
+        cases = [
+            ({**self.event('save'), 'user': str(self.user.id)}, None),
+            ({**self.event('save'), 'user': stranger.id}, 'user'),
+            ({**self.event('save'), 'project': other_project.id, 'design_version': other_version.id}, 'design_version'),
+            ({**self.event('save'), 'payload_json': ['warm']}, 'payload_json'),
+        ]
+        for item, field in cases:
+            single = self.client.post('/api/feedback/', item, format='json')
+            batch = self.client.post('/api/feedback/batch/', [item], format='json')
+            if field is None:
+                self.assertEqual((single.status_code, batch.status_code), (201, 201))
+                continue
+            self.assertEqual((single.status_code, batch.status_code), (400, 400), item)
+            self.assertIn(field, single.json())
+            self.assertEqual(batch.json()['errors'], [{'index': 0, 'errors': single.json()}])
+
+
+class ContextSnapshotTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='snapshots', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='bedroom', title='Snap')
+        self.context = {'preferences': [{'key': 'tone', 'value': 'warm'}], 'target_project': None}
+
+    def create_reply(self, context):
+        return ChatMessage.objects.create(
+            user=self.user,
+            project=self.project,
+            role='assistant',
+            content='reply',
+            metadata_json={'resolved_context': context, 'version_id': None},
+        )
+
+    def test_identical_contexts_share_one_snapshot(self):
+        first = self.create_reply(self.context)
+        second = self.create_reply(dict(reversed(list(self.context.items()))))
+        self.assertEqual(ContextSnapshot.objects.count(), 1)
+        self.assertEqual(first.context_snapshot_id, second.context_snapshot_id)
+        stored = ChatMessage.objects.get(id=second.id)
+        self.assertNotIn('resolved_context', stored.metadata_json)
+        self.assertEqual(stored.full_metadata['resolved_context'], self.context)
+
+    def test_history_rehydrates_context(self):
+        self.create_reply(self.context)
+        for index in range(5):
+            self.create_reply({'n': index})
+        client = APIClient()
+        token, _ = Token.objects.get_or_create(user=self.user)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        for url in ('messages/', 'messages/?limit=10'):
+            # token auth, ETag validator, messages joined with their snapshots
+            with self.assertNumQueries(3):
+                response = client.get(f'/api/projects/{self.project.id}/{url}')
+            data = response.json()
+            messages = data if isinstance(data, list) else data['results']
+            self.assertEqual(messages[0]['metadata_json']['resolved_context'], self.context)
+            self.assertEqual(messages[-1]['metadata_json']['resolved_context'], {'n': 4})
+
+    def test_dedup_command_moves_inline_contexts(self):
+        messages = [self.create_reply({'n': index % 2}) for index in range(4)]
+        ChatMessage.objects.filter(id__in=[m.id for m in messages]).update(context_snapshot=None)
+        for message in messages:
+            ChatMessage.objects.filter(id=message.id).update(
+                metadata_json={'resolved_context': {'n': message.id % 2, 'padding': 'x' * 500}},
+            )
+        ContextSnapshot.objects.all().delete()
+        output = io.StringIO()
+        call_command('dedup_context_snapshots', batch_size=3, stdout=output)
+        self.assertIn('Messages rewritten: 4', output.getvalue())
+        self.assertEqual(ContextSnapshot.objects.count(), 2)
+        self.assertFalse(
+            ChatMessage.objects.filter(metadata_json__has_key='resolved_context').exists()
+        )
+
+    def test_deleting_the_last_reference_deletes_the_snapshot(self):
+        first = self.create_reply(self.context)
+        second = self.create_reply(self.context)
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(ContextSnapshot.objects.filter(digest=second.context_snapshot_id).exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(ContextSnapshot.objects.exists())
+
+    def test_user_delete_sweeps_its_snapshots_once(self):
+        other = User.objects.create_user(username='keeps', email='keeps@example.com', password='pass1234')
+        other_project = Project.objects.create(user=other, room_type='kitchen', title='Kept')
+        ChatMessage.objects.create(
+            user=other,
+            project=other_project,
+            role='assistant',
+            content='reply',
+            metadata_json={'resolved_context': self.context},
+        )
+        for index in range(3):
+            self.create_reply({'n': index})
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.user.delete()
+        self.assertEqual(ContextSnapshot.objects.count(), 1)
+        self.assertEqual(ContextSnapshot.objects.get().payload, self.context)
+        sweeps = [callback for callback in callbacks if callback is _sweep_released_snapshots]
+        self.assertEqual(len(sweeps), 3)
+        with self.assertNumQueries(0):
+            sweeps[0]()
+
+    def test_dedup_command_deletes_unreferenced_snapshots(self):
+        kept = self.create_reply(self.context)
+        ContextSnapshot.objects.create(digest='0' * 64, payload={'orphan': True})
+        output = io.StringIO()
+        call_command('dedup_context_snapshots', stdout=output)
+        self.assertIn('Unreferenced snapshots deleted: 1', output.getvalue())
+        self.assertEqual(list(ContextSnapshot.objects.values_list('digest', flat=True)), [kept.context_snapshot_id])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='searcher', email='s@example.com', password='pass1234')
+        self.other = User.objects.create_user(username='other', email='o@example.com', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='living_room', title='Loft')
+        self.client = APIClient()
+        token, _ = Token.objects.get_or_create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def message(self, content, user=None, project=None):
+        return ChatMessage.objects.create(
+            user=user or self.user,
+            project=project or self.project,
+            role='user',
+            content=content,
+        )
+
+    def search(self, **params):
+        response = self.client.get('/api/search', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_finds_messages_notes_and_prompts(self):
+        self.message('I love that warm walnut option')
+        version = DesignVersion.objects.create(project=self.project, notes='Walnut shelving, warmer light')
+        GeneratedImage.objects.create(
+            design_version=version,
+            prompt='living room with walnut floor',
+            image_url='https://example.com/a.png',
+        )
+        self.message('Something cool and grey')
+        data = self.search(q='walnut')
+        self.assertEqual({hit['kind'] for hit in data['results']}, {'message', 'version', 'image'})
+        self.assertIn('[walnut]', data['results'][0]['snippet'].lower())
+        self.assertEqual(self.search(q='warm walnut')['results'][0]['kind'], 'message')
+        self.assertEqual(len(self.search(q='walnut', kind='image')['results']), 1)
+
+    def test_scoped_to_user(self):
+        other_project = Project.objects.create(user=self.other, room_type='bedroom', title='Theirs')
+        self.message('walnut headboard', user=self.other, project=other_project)
+        self.assertEqual(self.search(q='walnut')['results'], [])
+
+    def test_index_follows_edits_and_deletes(self):
+        version = DesignVersion.objects.create(project=self.project, notes='terracotta tiles')
+        self.assertEqual(len(self.search(q='terracotta')['results']), 1)
+        version.notes = 'slate tiles'
+        version.save()
+        self.assertEqual(self.search(q='terracotta')['results'], [])
+        self.assertEqual(len(self.search(q='slate')['results']), 1)
+        version.delete()
+        self.assertEqual(self.search(q='slate')['results'], [])
+
+    def test_pagination_and_hostile_input(self):
+        for index in range(5):
+            self.message(f'velvet sofa idea {index}')
+        page = self.search(q='velvet', limit=3)
+        self.assertEqual(len(page['results']), 3)
+        self.assertTrue(page['has_more'])
+        rest = self.search(q='velvet', limit=3, offset=page['next_offset'])
+        self.assertEqual(len(rest['results']), 2)
+        self.assertFalse(rest['has_more'])
+        self.assertEqual(self.search(q='"velvet" OR user_id:* NEAR(')['results'], [])
+        self.assertEqual(self.client.get('/api/search').status_code, 400)
+        self.assertEqual(self.client.get('/api/search', {'q': 'x', 'kind': 'bogus'}).status_code, 400)
+
+    def test_best_match_ranks_first_whatever_its_age(self):
+        # Enough other documents that 'linen' is a rare term.
+        SearchDocument.objects.bulk_create(
+            SearchDocument(kind='version', object_id=index, user=self.user, project=self.project, body='grey rug')
+            for index in range(2000)
+        )
+        best = self.message('linen curtains, linen cushions')
+        for index in range(300):
+            self.message(f'a long note about the hallway that mentions linen once, take {index}')
+        results = self.search(q='linen', limit=1)['results']
+        self.assertEqual(results[0]['object_id'], best.id)
+        self.assertGreater(results[0]['score'], 0)
+
+    def test_ids_past_32_bits_still_index(self):
+        user = User.objects.create_user(id=2**30, username='large', password='pass1234')
+        project = Project.objects.create(user=user, room_type='office', title='Large')
+        message = ChatMessage.objects.create(id=2**33, user=user, project=project, role='user', content='cork board')
+        self.assertEqual(
+            SearchDocument.objects.get(kind='message', object_id=message.id).user_id,
+            user.id,
+        )
+        results, _ = search_documents(user.id, 'cork')
+        self.assertEqual([result['object_id'] for result in results], [message.id])
+
+    def test_rebuild_command_indexes_bulk_rows(self):
+        ChatMessage.objects.bulk_create(
+            [ChatMessage(user=self.user, project=self.project, role='user', content='rattan chair')]
+        )
+        self.assertEqual(self.search(q='rattan')['results'], [])
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(len(self.search(q='rattan')['results']), 1)
+        self.assertEqual(SearchDocument.objects.filter(kind='message').count(), 1)
+
+
+class FastReadPathGoldenTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='golden', email='g@example.com', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='kitchen', title='Café \u2028 “Küche”')
+        Project.objects.create(user=self.user, room_type='other', title='Plain')
+        root = DesignVersion.objects.create(project=self.project, notes='Root\nnotes')
+        self.child = DesignVersion.objects.create(
+            project=self.project,
+            parent_version=root,
+            notes='',
+            created_at=timezone.now().replace(microsecond=0),
+        )
+        GeneratedImage.objects.create(
+            design_version=self.child,
+            prompt='walnut “table” 😀',
+            params_json={'option_index': 1, 'weights': [0.25, 1.5], 'nested': {'k': None}},
+            image_url='https://example.com/a.png',
+        )
+        FeedbackEvent.objects.create(
+            user=self.user,
+            project=self.project,
+            design_version=None,
+            event_type='modify',
+            payload_json={'text': 'warmer\tplease', 'score': 0.1},
+        )
+        FeedbackEvent.objects.create(
+            user=self.user,
+            project=self.project,
+            design_version=self.child,
+            event_type='select',
+            payload_json={'selected_option_index': 2},
+        )
+        Preference.objects.create(user=self.user, key='tone', value='warm', confidence=0.3, source='explicit')
+        Preference.objects.create(user=self.user, key='plants', value='true', confidence=1.0, source='implicit')
+        self.client = APIClient()
+        token, _ = Token.objects.get_or_create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def assertGolden(self, url, serializer_class, queryset):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        expected = JSONRenderer().render(serializer_class(queryset, many=True).data)
+        self.assertEqual(response.content, expected)
+
+    def test_listings_match_model_serializers(self):
+        for serializer_class in (
+            ProjectSerializer,
+            DesignVersionSerializer,
+            GeneratedImageSerializer,
+            FeedbackEventSerializer,
+            PreferenceSerializer,
+        ):
+            self.assertIsNotNone(_plan(serializer_class), serializer_class)
+        self.assertGolden('/api/projects/', ProjectSerializer, Project.objects.filter(user=self.user))
+        self.assertGolden(
+            f'/api/projects/{self.project.id}/versions/',
+            DesignVersionSerializer,
+            DesignVersion.objects.filter(project=self.project).order_by('version_number', 'created_at'),
+        )
+        self.assertGolden('/api/versions/', DesignVersionSerializer, DesignVersion.objects.all())
+        self.assertGolden(
+            f'/api/versions/{self.child.id}/images/',
+            GeneratedImageSerializer,
+            GeneratedImage.objects.filter(design_version=self.child).order_by('-created_at'),
+        )
+        self.assertGolden(
+            '/api/feedback/',
+            FeedbackEventSerializer,
+            FeedbackEvent.objects.order_by('-created_at'),
+        )
+        self.assertGolden('/api/preferences/', PreferenceSerializer, Preference.objects.all())
+
+    def test_floats_render_like_drf(self):
+        floats = [0.0, -0.0, 0.1, 1.5, 1e-4, 9.999e-05, 1e-05, -2.5e-300, 5e-324, 123456.789, 1e15, 1e16, 1e22]
+        payloads = [
+            {'values': floats},
+            [{'score': value, 'nested': {'weights': (value, 2**70)}} for value in floats],
+            {'big': 2**70},
+        ]
+        for payload in payloads:
+            self.assertEqual(FastJSONRenderer().render(payload), JSONRenderer().render(payload), payload)
+        FeedbackEvent.objects.update(payload_json={'score': 1e-05})
+        self.assertGolden('/api/feedback/', FeedbackEventSerializer, FeedbackEvent.objects.order_by('-created_at'))
+
+    def test_non_finite_floats_raise_like_drf(self):
+        for value in (float('nan'), float('inf'), float('-inf')):
+            payload = [{'score': 1.0}, {'score': value}]
+            with self.assertRaises(ValueError):
+                JSONRenderer().render(payload)
+            with self.assertRaises(ValueError):
+                FastJSONRenderer().render(payload)
+
+    def test_stdlib_renderer_without_orjson(self):
+        with mock.patch('memory.readpath.orjson', None):
+            self.assertGolden('/api/preferences/', PreferenceSerializer, Preference.objects.all())
+
+    def test_datetimes_follow_current_timezone(self):
+        value = timezone.now()
+        with timezone.override('America/New_York'):
+            self.assertEqual(
+                datetime_formatter()(value),
+                drf_serializers.DateTimeField().to_representation(value),
+            )
+
+
+class VersionNumberAllocationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='counter', email='c@example.com')
+        self.project = Project.objects.create(user=self.user, room_type='office', title='Desk')
+
+    def test_numbers_follow_explicit_versions(self):
+        DesignVersion.objects.create(project=self.project, version_number=4)
+        self.assertEqual(DesignVersion.objects.create(project=self.project).version_number, 5)
+        DesignVersion.objects.create(project=self.project, version_number=2)
+        self.assertEqual(DesignVersion.objects.create(project=self.project).version_number, 6)
+
+    def test_allocation_cost_does_not_grow_with_versions(self):
+        for _ in range(50):
+            DesignVersion.objects.create(project=self.project)
+        # Allocate, savepoint, insert, release, search index insert.
+        with self.assertNumQueries(5):
+            version = DesignVersion.objects.create(project=self.project, notes='n')
+        self.assertEqual(version.version_number, 51)
+
+    def test_collision_resyncs_counter(self):
+        DesignVersion.objects.create(project=self.project)
+        Project.objects.filter(id=self.project.id).update(next_version_number=1)
+        self.assertEqual(DesignVersion.objects.create(project=self.project).version_number, 2)
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.next_version_number, 3)
+
+    def test_counter_without_update_returning(self):
+        with mock.patch.object(connections['default'].features, 'can_return_columns_from_insert', False):
+            numbers = [DesignVersion.objects.create(project=self.project).version_number for _ in range(3)]
+            self.assertEqual(numbers, [1, 2, 3])
+            with self.assertRaises(Project.DoesNotExist):
+                Project.allocate_version_number(self.project.id + 1000)
+
+    def test_other_integrity_errors_are_not_retried(self):
+        allocate = mock.patch.object(Project, 'allocate_version_number', wraps=Project.allocate_version_number)
+        with allocate as allocated, self.assertRaises(IntegrityError):
+            DesignVersion.objects.create(project=self.project, notes=None)
+        self.assertEqual(allocated.call_count, 1)
+        self.assertEqual(DesignVersion.objects.create(project=self.project).version_number, 2)
+
+
+# Runs in a child process on a file database: the in-memory test database
+# uses SQLite shared cache, which fails concurrent writers immediately
+# instead of letting them wait for the lock.
+VERSION_HAMMER_SCRIPT = """
+import json, sys, threading
+import django
+django.setup()
+from django.core.management import call_command
+from django.db import connections
+from django.contrib.auth import get_user_model
+from memory.models import DesignVersion, Project
+
+threads, per_thread = int(sys.argv[1]), int(sys.argv[2])
+call_command('migrate', verbosity=0)
+user = get_user_model().objects.create(username='hammer', email='h@example.com')
+project = Project.objects.create(user=user, room_type='office', title='Race')
+errors = []
+start = threading.Barrier(threads)
+
+def worker():
+    try:
+        start.wait()
+        for _ in range(per_thread):
+            DesignVersion.objects.create(project_id=project.id)
+    except Exception as exc:
+        errors.append(repr(exc))
+    finally:
+        connections.close_all()
+
+# Anything escaping worker() counts too, not just a traceback on stderr.
+threading.excepthook = lambda args: errors.append(repr(args.exc_value))
+workers = [threading.Thread(target=worker) for _ in range(threads)]
+for thread in workers:
+    thread.start()
+for thread in workers:
+    thread.join()
+project.refresh_from_db()
+numbers = sorted(DesignVersion.objects.filter(project=project).values_list('version_number', flat=True))
+print(json.dumps({'errors': errors, 'numbers': numbers, 'counter': project.next_version_number}))
+"""
+
+
+class ConcurrentVersionAllocationTests(SimpleTestCase):
+    THREADS = 8
+    PER_THREAD = 25
+
+    def test_threads_get_distinct_numbers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            result = subprocess.run(
+                [sys.executable, '-c', VERSION_HAMMER_SCRIPT, str(self.THREADS), str(self.PER_THREAD)],
+                cwd=settings.BASE_DIR,
+                env={
+                    **os.environ,
+                    'DJANGO_SETTINGS_MODULE': 'backend.settings',
+                    'DJANGO_SQLITE_PATH': os.path.join(directory, 'race.sqlite3'),
+                },
+                capture_output=True,
+                text=True,
+                timeout=120,
+            )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stderr, '')
+        report = json.loads(result.stdout.splitlines()[-1])
+        total = self.THREADS * self.PER_THREAD
+        self.assertEqual(report['errors'], [])
+        self.assertEqual(report['numbers'], list(range(1, total + 1)))
+        self.assertEqual(report['counter'], total + 1)
+
+
+class ImageJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='renders', email='r@example.com', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='kitchen', title='Kitchen')
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+        self.version = DesignVersion.objects.create(project=self.project)
+        self.image = GeneratedImage.objects.create(
+            design_version=self.version,
+            prompt='sage green cabinets',
+            params_json={'option_index': 1},
+            image_url=f'https://picsum.photos/seed/{self.version.id}-1/600/400',
+        )
+        self.job = ImageJob.objects.create(image=self.image)
+
+    def _chat(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        with mock.patch.dict(os.environ, {'MOCK_LLM': 'true'}):
+            response = client.post(
+                '/api/agent/chat',
+                {'project_id': self.project.id, 'message': 'Design a bright kitchen'},
+                format='json',
+            )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_chat_returns_pending_slots_rendered_later(self):
+        with override_settings(IMAGE_JOB_WORKERS=0):
+            payload = self._chat()
+        slots = payload['created_images']
+        self.assertGreater(len(slots), 0)
+        self.assertTrue(all(slot['status'] == 'queued' for slot in slots))
+        self.assertEqual(
+            [option['image_id'] for option in payload['design_options']],
+            [slot['id'] for slot in slots],
+        )
+        call_command('run_image_jobs', stdout=io.StringIO())
+        statuses = ImageJob.objects.filter(id__in=[slot['job_id'] for slot in slots]).values_list(
+            'status', flat=True
+        )
+        self.assertEqual(set(statuses), {'succeeded'})
+
+    def test_jobs_dispatch_to_pool_after_commit(self):
+        with mock.patch('memory.imaging.get_pool') as get_pool:
+            with self.captureOnCommitCallbacks(execute=True):
+                payload = self._chat()
+                get_pool.return_value.submit.assert_not_called()
+        get_pool.return_value.submit.assert_called_once()
+        job_ids = get_pool.return_value.submit.call_args.args[0]
+        self.assertEqual(job_ids, [slot['job_id'] for slot in payload['created_images']])
+
+    def test_local_renderer_writes_png(self):
+        with tempfile.TemporaryDirectory() as media_root:
+            with override_settings(MEDIA_ROOT=media_root):
+                self.job.renderer = 'local'
+                self.job.save()
+                job = run_job(self.job.id)
+                path = os.path.join(media_root, 'renders', f'{self.version.id}-1.png')
+                with open(path, 'rb') as handle:
+                    self.assertEqual(handle.read(8), b'\x89PNG\r\n\x1a\n')
+                expected_url = LocalPNGRenderer().url_for(self.version.id, 1)
+        self.assertEqual(job.status, 'succeeded')
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.image_url, expected_url)
+
+    def test_renderer_errors_retry_then_fail(self):
+        with mock.patch('memory.imaging.PlaceholderRenderer.render', side_effect=OSError('disk full')):
+            with self.assertLogs('memory.imaging', 'WARNING'):
+                job = run_job(self.job.id)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, settings.IMAGE_JOB_ATTEMPTS)
+        self.assertIn('disk full', job.error)
+        self.assertIsNone(run_job(self.job.id))
+
+    async def test_completion_is_pushed_to_project_socket(self):
+        from backend.asgi import application
+
+        client = WebsocketClient(
+            application,
+            '/ws/chat/',
+            {'token': self.token.key, 'project_id': self.project.id},
+        )
+        self.assertTrue(await client.connect())
+        await client.receive_until('connected')
+        await sync_to_async(run_job)(self.job.id)
+        frame = await client.receive_until('image_job')
+        await client.disconnect()
+        self.assertEqual(frame['job_id'], self.job.id)
+        self.assertEqual(frame['image_id'], self.image.id)
+        self.assertEqual(frame['status'], 'succeeded')
+
+
+class BenchmarkCompareTests(SimpleTestCase):
+    baseline = {
+        'search': {'p95_ms': 10.0, 'queries': 2, 'peak_kb': 100.0},
+        'previews': {'p95_ms': 4.0, 'queries': 1, 'peak_kb': 50.0},
+    }
+
+    def result(self, p95_ms=10.0, queries=2, peak_kb=100.0):
+        return {'p95_ms': p95_ms, 'queries': queries, 'peak_kb': peak_kb}
+
+    def test_within_threshold_and_improvements_pass(self):
+        current = {
+            'search': self.result(p95_ms=12.5, peak_kb=100.0 * 1.25 + MEMORY_NOISE_KB),
+            'previews': self.result(p95_ms=1.0, queries=0, peak_kb=10.0),
+        }
+        self.assertEqual(compare(current, self.baseline, threshold=0.25), [])
+
+    def test_regressions_past_threshold_are_reported(self):
+        current = {'search': self.result(p95_ms=12.6, queries=3, peak_kb=300.0)}
+        regressions = compare(current, self.baseline, threshold=0.25)
+        self.assertEqual(len(regressions), 3)
+        self.assertTrue(regressions[0].startswith('search: p95 12.60ms > 12.50ms'), regressions)
+        self.assertIn('3 queries > baseline 2', regressions[1])
+        self.assertIn('peak 300KB', regressions[2])
+
+    def test_cases_missing_from_either_side_are_skipped(self):
+        current = {'new_case': self.result(p95_ms=1000.0, queries=50)}
+        self.assertEqual(compare(current, self.baseline, threshold=0.25), [])
+        self.assertEqual(compare({}, self.baseline, threshold=0.25), [])
+
+    def test_warns_when_the_baseline_is_from_another_setup(self):
+        meta = {'scale': 'small', 'host': 'ci', 'python': '3.11.7', 'database': 'sqlite'}
+        self.assertEqual(baseline_warnings(meta, {**meta, 'created_at': 'then'}), [])
+        self.assertEqual(baseline_warnings(meta, {'scale': 'small'}), [])
+        warnings = baseline_warnings(meta, {**meta, 'host': 'laptop', 'scale': 'medium'})
+        self.assertEqual(len(warnings), 2)
+        self.assertIn('host=laptop', ' '.join(warnings))
+
+    def test_regressions_only_fail_the_run_with_check(self):
+        from benchmarks.__main__ import gate, main
+
+        report = {'meta': {'scale': 'small'}, 'cases': {'search': self.result(p95_ms=20.0)}}
+        baseline = {'meta': {'scale': 'small'}, 'cases': self.baseline}
+        with mock.patch('sys.stdout', io.StringIO()) as output:
+            self.assertEqual(gate(report, baseline, threshold=0.25, check=False), 0)
+            self.assertEqual(gate(report, baseline, threshold=0.25, check=True), 1)
+            self.assertEqual(gate(report, baseline, threshold=1.0, check=True), 0)
+        self.assertIn('Regressions:', output.getvalue())
+        with self.assertRaises(SystemExit), mock.patch('sys.stderr', io.StringIO()):
+            main(['--check'])
+
+
+class ClaudeClientTests(SimpleTestCase):
+    def respond(self, body):
+        response = mock.MagicMock()
+        response.__enter__.return_value.read.return_value = body
+        return mock.patch('urllib.request.urlopen', return_value=response)
+
+    async def test_agenerate_returns_text_from_a_worker_thread(self):
+        client = ClaudeClient(api_key='key')
+        threads = []
+
+        def urlopen(request, timeout):
+            threads.append(threading.get_ident())
+            response = mock.MagicMock()
+            response.__enter__.return_value.read.return_value = b'{"content": [{"text": "hi"}]}'
+            return response
+
+        with mock.patch('urllib.request.urlopen', urlopen):
+            self.assertEqual(await client.agenerate('prompt'), 'hi')
+        self.assertNotEqual(threads, [threading.get_ident()])
+
+    def test_every_failure_is_a_runtime_error(self):
+        client = ClaudeClient(api_key='key')
+        for body in (b'<html>', b'\xff', b'[]', b'{"content": ["x"]}'):
+            with self.respond(body), self.assertRaises(RuntimeError, msg=body):
+                client.generate('prompt')
+        for error in (
+            TimeoutError('read timed out'),
+            http.client.IncompleteRead(b''),
+            http.client.BadStatusLine('garbage'),
+            urllib.error.URLError('refused'),
+        ):
+            with mock.patch('urllib.request.urlopen', side_effect=error), self.assertRaises(RuntimeError, msg=error):
+                client.generate('prompt')
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def _controller(self, store=None, **overrides):
+        options = {
+            'rate': 0,
+            'burst': 1,
+            'user_concurrency': 1,
+            'global_concurrency': 2,
+            'queue_size': 8,
+            'user_queue_size': 4,
+            'poll_interval': 0.01,
+        }
+        options.update(overrides)
+        return AdmissionController(store or LocalStore(), **options)
+
+    def test_token_bucket_allows_burst_then_retry_after(self):
+        controller = self._controller(rate=1, burst=2, user_concurrency=5)
+        controller.try_admit(1).release()
+        controller.try_admit(1).release()
+        with self.assertRaises(Rejected) as raised:
+            controller.try_admit(1)
+        self.assertEqual(raised.exception.reason, 'rate_limited')
+        self.assertAlmostEqual(raised.exception.retry_after, 1, delta=0.1)
+        controller.try_admit(2).release()
+
+    def test_user_and_global_caps(self):
+        controller = self._controller()
+        first = controller.try_admit(1)
+        with self.assertRaises(Rejected) as raised:
+            controller.try_admit(1)
+        self.assertEqual(raised.exception.reason, 'busy')
+        second = controller.try_admit(2)
+        with self.assertRaises(Rejected):
+            controller.try_admit(3)
+        first.release()
+        second.release()
+        controller.try_admit(3).release()
+
+    async def test_queue_serves_users_round_robin(self):
+        controller = self._controller(user_concurrency=5, global_concurrency=1)
+        holder = await controller.admit('holder')
+        served = []
+        positions = {}
+
+        async def turn(user, name):
+            async def queued(position):
+                positions[name] = position
+
+            async with await controller.admit(user, on_queued=queued):
+                served.append(name)
+                await asyncio.sleep(0)
+
+        tasks = []
+        for user, name in [('a', 'a1'), ('a', 'a2'), ('a', 'a3'), ('b', 'b1')]:
+            tasks.append(asyncio.create_task(turn(user, name)))
+            await asyncio.sleep(0)
+        holder.release()
+        await asyncio.wait_for(asyncio.gather(*tasks), 2)
+        self.assertEqual(served, ['a1', 'b1', 'a2', 'a3'])
+        self.assertEqual(positions, {'a1': 1, 'a2': 2, 'a3': 3, 'b1': 2})
+
+    async def test_full_queue_rejects_and_cancel_frees_place(self):
+        controller = self._controller(global_concurrency=1, user_queue_size=1)
+        holder = await controller.admit(1)
+        waiting = asyncio.create_task(controller.admit(2))
+        await asyncio.sleep(0.02)
+        with self.assertRaises(Rejected) as raised:
+            await controller.admit(2)
+        self.assertEqual(raised.exception.reason, 'queue_full')
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        holder.release()
+        (await asyncio.wait_for(controller.admit(2), 1)).release()
+
+    async def test_queue_full_does_not_spend_a_rate_token(self):
+        for store in (LocalStore(), CacheStore()):
+            # rate=0.01 with burst=1: a spent token is not back for 100 s.
+            controller = self._controller(store=store, rate=0.01, global_concurrency=1, queue_size=1)
+            holder = await controller.admit(f'holder-{id(store)}')
+            waiting = asyncio.create_task(controller.admit(f'waiter-{id(store)}'))
+            await asyncio.sleep(0.02)
+            with self.assertRaises(Rejected) as raised:
+                await controller.admit(f'late-{id(store)}')
+            self.assertEqual(raised.exception.reason, 'queue_full')
+            holder.release()
+            await (await asyncio.wait_for(waiting, 1)).arelease()
+
+            # Charged, then turned away by a cap with nobody waiting.
+            no_queue = self._controller(store=store, rate=0.01, global_concurrency=1, queue_size=0)
+            holder = await no_queue.admit(f'holder-{id(store)}-2')
+            for attempt in range(2):
+                with self.assertRaises(Rejected) as raised:
+                    await no_queue.admit(f'late-{id(store)}')
+                self.assertEqual(raised.exception.reason, 'queue_full')
+            holder.release()
+            (await no_queue.admit(f'late-{id(store)}')).release()
+            with self.assertRaises(Rejected) as raised:
+                await no_queue.admit(f'late-{id(store)}')
+            self.assertEqual(raised.exception.reason, 'rate_limited')
+
+    async def test_release_wakes_waiter_without_polling(self):
+        controller = self._controller(global_concurrency=1, poll_interval=60)
+        self.assertIsNone(controller.poll_interval)
+        holder = await controller.admit(1)
+        waiting = asyncio.create_task(controller.admit(2))
+        await asyncio.sleep(0.01)
+        with mock.patch.object(controller, '_dispatch', wraps=controller._dispatch) as dispatch:
+            await asyncio.sleep(0.05)
+            self.assertFalse(dispatch.called)
+            await holder.arelease()
+            (await asyncio.wait_for(waiting, 1)).release()
+        self.assertEqual(dispatch.call_count, 1)
+
+    async def test_cache_store_calls_run_off_the_event_loop(self):
+        store = CacheStore()
+        store.cache.clear()
+        loop_thread = threading.get_ident()
+        threads = []
+        for name in ('take_token', 'acquire', 'release'):
+            method = getattr(store, name)
+
+            def record(*args, method=method):
+                threads.append(threading.get_ident())
+                return method(*args)
+
+            setattr(store, name, record)
+        controller = self._controller(store=store, rate=100, burst=10)
+        async with await controller.admit(1):
+            pass
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(loop_thread, threads)
+
+    def test_settings_reject_zero_concurrency(self):
+        path = os.path.join(settings.BASE_DIR, 'backend', 'settings.py')
+        with mock.patch.dict(os.environ, {'ADMISSION_GLOBAL_CONCURRENCY': '0'}):
+            with self.assertRaises(ImproperlyConfigured):
+                runpy.run_path(path)
+
+    def test_cache_store_caps_are_shared(self):
+        store = CacheStore()
+        store.cache.clear()
+        # Two controllers stand in for two processes sharing one cache.
+        first = self._controller(store=store, global_concurrency=1)
+        second = self._controller(store=CacheStore(), global_concurrency=1)
+        slot = first.try_admit(1)
+        with self.assertRaises(Rejected):
+            second.try_admit(2)
+        slot.release()
+        second.try_admit(2).release()
+
+
+class AdmissionEndpointTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='spammer', email='s@example.com', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='office', title='Spam')
+        self.client = APIClient()
+        token, _ = Token.objects.get_or_create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    @override_settings(ADMISSION_RATE=0.01, ADMISSION_BURST=1)
+    def test_chat_and_suggest_return_retry_after_when_rate_limited(self):
+        with mock.patch.dict(os.environ, {'MOCK_LLM': 'true'}):
+            body = {'project_id': self.project.id, 'message': 'hello'}
+            self.assertEqual(self.client.post('/api/agent/chat', body, format='json').status_code, 200)
+            chat = self.client.post('/api/agent/chat', body, format='json')
+            suggest = self.client.post(
+                '/api/assistant/suggest',
+                {'user_id': self.user.id, 'project_id': self.project.id, 'message': 'hi'},
+                format='json',
+            )
+        self.assertEqual(chat.status_code, 429)
+        self.assertEqual(chat.json()['reason'], 'rate_limited')
+        self.assertGreater(int(chat['Retry-After']), 1)
+        self.assertEqual(suggest.status_code, 429)
+        self.assertIn('Retry-After', suggest)
+        self.assertEqual(ChatMessage.objects.filter(project=self.project).count(), 2)
+
+
+class ChatSessionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='sessions', email='ss@example.com', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='bedroom', title='Loft')
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+
+    def _add_preference(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Preference.objects.create(user=self.user, key='tone', value='warm', confidence=0.9, source='explicit')
+        return callbacks
+
+    async def _turn(self, client, text):
+        await client.send_json({'type': 'user_message', 'message': text})
+        return await client.receive_until('assistant_message', timeout=5)
+
+    async def test_steady_state_turns_only_write(self):
+        from backend.asgi import application
+
+        # Queries run on the main thread's connection; record them there.
+        database = await sync_to_async(lambda: connections['default'])()
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        client = WebsocketClient(
+            application,
+            '/ws/chat/',
+            {'token': self.token.key, 'project_id': self.project.id},
+        )
+        self.assertTrue(await client.connect())
+        await client.receive_until('connected')
+        with mock.patch.dict(os.environ, {'MOCK_LLM': 'true'}):
+            await self._turn(client, 'first')
+            with database.execute_wrapper(record):
+                frame = await self._turn(client, 'second')
+            self.assertEqual(frame['metadata_json']['resolved_context']['preferences'], [])
+            self.assertEqual([sql for sql in statements if sql.startswith('SELECT')], [])
+            self.assertTrue(any(sql.startswith('INSERT') for sql in statements))
+
+            callbacks = await sync_to_async(self._add_preference)()
+            # The session invalidation and the change event.
+            self.assertEqual(len(callbacks), 2)
+            statements.clear()
+            with database.execute_wrapper(record):
+                frame = await self._turn(client, 'third')
+        await client.disconnect()
+        preferences = frame['metadata_json']['resolved_context']['preferences']
+        self.assertEqual([pref['key'] for pref in preferences], ['tone'])
+        selects = [sql for sql in statements if sql.startswith('SELECT')]
+        self.assertEqual(len(selects), 1)
+        self.assertIn('memory_preference', selects[0])
+
+    def test_bulk_feedback_invalidates_sessions(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        with mock.patch('memory.events._send_invalidations') as send:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.post(
+                    '/api/feedback/batch/',
+                    {'events': [{'project': self.project.id, 'event_type': 'modify', 'payload_json': {'text': 'warmer'}}]},
+                    format='json',
+                )
+        self.assertEqual(response.status_code, 201)
+        sent = {(tuple(call.args[0]), tuple(call.args[1])) for call in send.call_args_list}
+        self.assertEqual(
+            sent,
+            {
+                ((f'user_{self.user.id}',), ('preferences',)),
+                ((f'project_{self.project.id}',), ('events', 'canonical')),
+            },
+        )
+
+
+class ChatTurnCancellationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='canceller', email='cx@example.com', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='office', title='Den')
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+        self.aborted = []
+
+    async def _llm(self, context, message):
+        if message.startswith('slow'):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                self.aborted.append(message)
+                raise
+        return _mock_agent_response(message)
+
+    async def _connect(self):
+        from backend.asgi import application
+
+        client = WebsocketClient(
+            application,
+            '/ws/chat/',
+            {'token': self.token.key, 'project_id': self.project.id},
+        )
+        self.assertTrue(await client.connect())
+        await client.receive_until('connected')
+        return client
+
+    async def test_newer_message_supersedes_running_turn(self):
+        with mock.patch('memory.pipeline.agenerate_agent_response', self._llm):
+            client = await self._connect()
+            await client.send_json({'type': 'user_message', 'message': 'slow plan'})
+            self.assertEqual((await client.receive_until('thinking'))['turn_id'], 1)
+            await asyncio.sleep(0.05)
+            await client.send_json({'type': 'user_message', 'message': 'actually this'})
+            self.assertEqual((await client.receive_json())['type'], 'busy')
+            await client.send_json({'type': 'user_message', 'message': 'actually this', 'supersede': True})
+            cancelled = await client.receive_until('cancelled')
+            reply = await client.receive_until('assistant_message')
+            await client.disconnect()
+        self.assertEqual((cancelled['turn_id'], cancelled['reason']), (1, 'superseded'))
+        self.assertGreater(cancelled['wasted_llm_seconds'], 0)
+        self.assertEqual(reply['turn_id'], 2)
+        self.assertEqual(self.aborted, ['slow plan'])
+
+    async def test_client_cancel_and_disconnect_stop_llm_calls(self):
+        with mock.patch('memory.pipeline.agenerate_agent_response', self._llm):
+            client = await self._connect()
+            await client.send_json({'type': 'user_message', 'message': 'slow one'})
+            turn = await client.receive_until('thinking')
+            await asyncio.sleep(0.05)
+            await client.send_json({'type': 'cancel', 'turn_id': turn['turn_id']})
+            self.assertEqual((await client.receive_until('cancelled'))['reason'], 'client')
+
+            await client.send_json({'type': 'user_message', 'message': 'slow two'})
+            await client.receive_until('thinking')
+            await asyncio.sleep(0.05)
+            with self.assertLogs('memory.consumers', 'INFO') as logs:
+                await client.disconnect()
+        self.assertEqual(self.aborted, ['slow one', 'slow two'])
+        self.assertIn('cancelled_turns=2', logs.output[0])
+        self.assertEqual(
+            await ChatMessage.objects.filter(project=self.project, role='assistant').acount(),
+            0,
+        )
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='office', title='Desk')
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+
+    def _reply(self, content='Here you go', **fields):
+        return ChatMessage(
+            user=self.user,
+            project=self.project,
+            role='assistant',
+            content=content,
+            metadata_json={'resolved_context': {'note': content}},
+            client_id=fields.pop('client_id', None) or uuid.uuid4(),
+            **fields,
+        )
+
+    async def test_reply_is_sent_before_its_insert(self):
+        from backend.asgi import application
+
+        writer = ReplyWriter(10, 10, start=False)
+        client = WebsocketClient(
+            application,
+            '/ws/chat/',
+            {'token': self.token.key, 'project_id': self.project.id},
+        )
+        self.assertTrue(await client.connect())
+        await client.receive_until('connected')
+        with mock.patch('memory.consumers.get_writer', return_value=writer), mock.patch.dict(
+            os.environ, {'MOCK_LLM': 'true'}
+        ):
+            client_id = str(uuid.uuid4())
+            await client.send_json({'type': 'user_message', 'message': 'desk lamp', 'client_id': client_id})
+            frame = await client.receive_until('assistant_message', timeout=5)
+            self.assertEqual(frame['client_id'], client_id)
+            self.assertIsNone(frame['message_id'])
+            self.assertFalse(await ChatMessage.objects.filter(role='assistant').aexists())
+            await sync_to_async(writer.drain)()
+            saved = await client.receive_until('message_saved')
+        await client.disconnect()
+        self.assertEqual(saved['client_id'], frame['client_id'])
+        message = await ChatMessage.objects.select_related('context_snapshot').aget(client_id=frame['client_id'])
+        self.assertEqual(message.id, saved['message_id'])
+        self.assertEqual(message.full_metadata, frame['metadata_json'])
+        self.assertNotIn('resolved_context', message.metadata_json)
+        project = await Project.objects.aget(id=self.project.id)
+        self.assertEqual(project.last_message_id, message.id)
+        self.assertTrue(await SearchDocument.objects.filter(kind='message', object_id=message.id).aexists())
+
+    def test_failed_reply_is_reported_and_others_saved(self):
+        taken = self._reply('first')
+        taken.save()
+        writer = ReplyWriter(10, 10, start=False)
+        good, duplicate = self._reply('second'), self._reply('third', client_id=taken.client_id)
+        loop = mock.Mock(**{'is_running.return_value': True})
+        for message in (good, duplicate):
+            self.assertTrue(writer.submit(message, loop))
+        with mock.patch('memory.writebehind.publish') as publish, self.assertLogs('memory.writebehind', 'ERROR'):
+            writer.drain()
+        frames = {call.args[1]['type']: call.args[1] for call in publish.call_args_list}
+        self.assertEqual(frames['message_saved']['message_id'], good.id)
+        self.assertEqual(frames['message_failed']['client_id'], str(taken.client_id))
+        self.assertEqual(ChatMessage.objects.filter(role='assistant').count(), 2)
+
+    def test_batches_have_the_side_effects_of_save(self):
+        single, batched = self._reply('alone'), self._reply('batched')
+        with mock.patch('memory.signals.record_change') as record_change, self.captureOnCommitCallbacks(
+            execute=True
+        ):
+            single.save()
+            write_replies([batched])
+        events = [(call.args[1]['id'], call.args[1]['op']) for call in record_change.call_args_list]
+        self.assertEqual(events, [(single.id, 'created'), (batched.id, 'created')])
+        self.assertEqual(
+            set(SearchDocument.objects.filter(kind='message').values_list('object_id', flat=True)),
+            {single.id, batched.id},
+        )
+        saved = ChatMessage.objects.select_related('context_snapshot').get(id=batched.id)
+        self.assertNotIn('resolved_context', saved.metadata_json)
+        self.assertEqual(saved.full_metadata['resolved_context'], {'note': 'batched'})
+        self.assertEqual(Project.objects.get(id=self.project.id).last_message_id, batched.id)
+
+    def test_full_or_closed_writer_refuses_replies(self):
+        writer = ReplyWriter(1, 10, start=False)
+        self.assertTrue(writer.submit(self._reply()))
+        self.assertFalse(writer.submit(self._reply()))
+        with mock.patch('memory.writebehind.publish'):
+            writer.close()
+        self.assertEqual(ChatMessage.objects.count(), 1)
+        self.assertFalse(writer.submit(self._reply()))
+
+
+class ChatReplayTests(TestCase):
+    def setUp(self):
+        # A fresh buffer: rolled-back tests reuse message ids.
+        self.enterContext(override_settings(CHAT_REPLAY_BUFFER=50))
+        self.user = User.objects.create_user(username='replay', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='bedroom', title='Nook')
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+
+    def _messages(self, count, buffered=True):
+        with self.captureOnCommitCallbacks(execute=buffered):
+            return [
+                ChatMessage.objects.create(
+                    user=self.user,
+                    project=self.project,
+                    role='user' if index % 2 == 0 else 'assistant',
+                    content=f'message {index}',
+                )
+                for index in range(count)
+            ]
+
+    async def _connect(self, last_message_id):
+        from backend.asgi import application
+
+        database = await sync_to_async(lambda: connections['default'])()
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        client = WebsocketClient(
+            application,
+            '/ws/chat/',
+            {'token': self.token.key, 'project_id': self.project.id, 'last_message_id': last_message_id},
+        )
+        with database.execute_wrapper(record):
+            self.assertTrue(await client.connect())
+            await client.receive_until('connected')
+            frames = [await client.receive_until('replay')]
+            while frames[-1]['has_more']:
+                frames.append(await client.receive_until('replay'))
+        await client.disconnect()
+        return frames, [sql for sql in statements if 'memory_chatmessage' in sql]
+
+    async def test_reconnect_replays_only_the_gap_from_memory(self):
+        messages = await sync_to_async(self._messages)(5)
+        frames, message_queries = await self._connect(messages[2].id)
+        self.assertEqual([frame['source'] for frame in frames], ['buffer'])
+        self.assertEqual(
+            [message['id'] for message in frames[0]['messages']],
+            [message.id for message in messages[3:]],
+        )
+        self.assertEqual(frames[0]['messages'][0]['content'], 'message 3')
+        self.assertEqual(message_queries, [])
+
+    @mock.patch('memory.replay.REPLAY_PAGE', 2)
+    async def test_unbuffered_gap_pages_through_keyset_query(self):
+        messages = await sync_to_async(self._messages)(5, buffered=False)
+        frames, message_queries = await self._connect(messages[1].id)
+        self.assertEqual([frame['source'] for frame in frames], ['database', 'database'])
+        self.assertEqual([frame['has_more'] for frame in frames], [True, False])
+        replayed = [message['id'] for frame in frames for message in frame['messages']]
+        self.assertEqual(replayed, [message.id for message in messages[2:]])
+        self.assertEqual(len(message_queries), 3)
+
+    async def test_unknown_message_asks_for_a_reload(self):
+        other = await Project.objects.acreate(user=self.user, room_type='office', title='Elsewhere')
+        foreign = await ChatMessage.objects.acreate(user=self.user, project=other, role='user', content='hi')
+        frames, _ = await self._connect(foreign.id)
+        self.assertTrue(frames[0]['reset'])
+        self.assertEqual(frames[0]['messages'], [])
+
+    def test_buffer_keeps_listing_order_and_trusts_only_a_current_head(self):
+        buffer = RecentMessages(size=3, projects=1)
+        now = timezone.now()
+        rows = [
+            ChatMessage(id=index, project_id=self.project.id, created_at=now + timedelta(seconds=index))
+            for index in range(1, 6)
+        ]
+        for row in (rows[0], rows[2], rows[1], rows[4], rows[3]):
+            buffer.record(row)
+        self.assertEqual([row.id for row in buffer.after(self.project.id, 3, 5)], [4, 5])
+        self.assertIsNone(buffer.after(self.project.id, 2, 5))
+        self.assertIsNone(buffer.after(self.project.id, 3, 6))
+        buffer.record(ChatMessage(id=6, project_id=self.project.id + 1, created_at=now))
+        self.assertIsNone(buffer.after(self.project.id, 3, 5))
+
+
+
+class ChangeFeedTests(TestCase):
+    def setUp(self):
+        # A long window, so only flush() sends.
+        self.enterContext(override_settings(CHAT_CHANGE_WINDOW=60))
+        self.user = User.objects.create_user(username='changes', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='office', title='Study')
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+
+    def test_window_keeps_one_event_per_row(self):
+        feed = ChangeFeed(window=60, max_events=3)
+        sent = []
+        with mock.patch.object(feed, '_send', sent.append):
+            feed.add(1, {'entity': 'project', 'id': 5, 'op': 'created', 'version': 10})
+            feed.add(1, {'entity': 'project', 'id': 5, 'op': 'updated', 'version': 12})
+            feed.add(1, {'entity': 'message', 'id': 8, 'op': 'created', 'version': 11, 'project_id': 6})
+            feed.add(1, {'entity': 'project', 'id': 6, 'op': 'deleted', 'version': 13})
+            feed.add(2, {'entity': 'preference', 'id': 3, 'op': 'updated', 'version': 9})
+            feed.flush()
+            for index in range(4):
+                feed.add(1, {'entity': 'message', 'id': index, 'op': 'created', 'version': index})
+            feed.flush()
+        self.assertEqual(
+            sent[0][1]['events'],
+            [
+                {'entity': 'project', 'id': 5, 'op': 'created', 'version': 12},
+                {'entity': 'project', 'id': 6, 'op': 'deleted', 'version': 13},
+            ],
+        )
+        self.assertEqual(sent[0][2]['events'][0]['entity'], 'preference')
+        self.assertEqual(sent[1], {1: {'type': 'user.changes', 'reset': True}})
+
+    async def test_writes_reach_the_owners_socket_as_one_frame(self):
+        from backend.asgi import application
+
+        client = WebsocketClient(application, '/ws/chat/', {'token': self.token.key, 'project_id': self.project.id})
+        self.assertTrue(await client.connect())
+        await client.receive_until('connected')
+
+        def write():
+            with self.captureOnCommitCallbacks(execute=True):
+                preference = Preference.objects.create(user=self.user, key='style', value='warm', source='explicit')
+                preference.value = 'cool'
+                preference.save()
+                version = DesignVersion.objects.create(project=self.project)
+                self.project.title = 'Den'
+                self.project.save()
+            return preference, version
+
+        preference, version = await sync_to_async(write)()
+        await sync_to_async(change_feed().flush)()
+        frame = await client.receive_until('changes')
+        await client.disconnect()
+        events = {(event['entity'], event['id']): event for event in frame['events']}
+        self.assertEqual(
+            set(events),
+            {('preference', preference.id), ('version', version.id), ('project', self.project.id)},
+        )
+        self.assertEqual(events['preference', preference.id]['op'], 'created')
+        self.assertEqual(events['version', version.id]['project_id'], self.project.id)
+        self.assertEqual(events['project', self.project.id]['op'], 'updated')
+
+
+
+class FramingTests(TestCase):
+    def test_cbor_matches_rfc_vectors_and_round_trips(self):
+        vectors = {
+            0: '00',
+            23: '17',
+            1000000: '1a000f4240',
+            -1000: '3903e7',
+            1.1: 'fb3ff199999999999a',
+            0.5: 'fa3f000000',
+            'IETF': '6449455446',
+            '\u00fc': '62c3bc',
+            b'\x01\x02': '420102',
+            None: 'f6',
+            True: 'f5',
+        }
+        for value, encoded in vectors.items():
+            self.assertEqual(cbor_dumps(value).hex(), encoded, value)
+        self.assertEqual(cbor_loads(bytes.fromhex('f93c00')), 1.0)
+        frame = {'type': 'replay', 'messages': [{'id': 2**40, 'score': -0.25, 'tags': ['a', None]}], 'reset': False}
+        self.assertEqual(cbor_loads(cbor_dumps(frame)), frame)
+        with self.assertRaises(TypeError):
+            cbor_dumps({'when': timezone.now()})
+
+    def test_malformed_client_frames_raise_decode_errors(self):
+        deflate = CODECS['json-deflate']
+        largest = {'text': 'x' * (MAX_FRAME - len('{"text":""}'))}
+        self.assertEqual(deflate.decode(deflate.encode(largest)), largest)
+        bomb = zlib.compress(b' ' * (64 * MAX_FRAME))
+        self.assertLess(len(bomb), MAX_FRAME // 8)
+        frames = [
+            (deflate, bomb),
+            (deflate, deflate.encode({'type': 'cancel'})[:-4]),
+            (deflate, b'not deflate'),
+            (CODECS['cbor'], bytes.fromhex('fb00')),
+            (CODECS['cbor'], bytes.fromhex('a18001')),
+            (CODECS['cbor'], bytes.fromhex('81') * 100000),
+            (CODECS['json'], '{"type": '),
+        ]
+        for codec, frame in frames:
+            with self.assertRaises(DECODE_ERRORS, msg=(codec.name, frame[:8])):
+                codec.decode(frame)
+
+    def test_negotiation_falls_back_to_json(self):
+        self.assertEqual(negotiate('brotli, json-deflate').name, 'json-deflate')
+        self.assertEqual(negotiate('brotli').name, 'json')
+        self.assertEqual(negotiate(None).name, 'json')
+
+    async def test_cbor_socket_sends_binary_frames_without_context(self):
+        from backend.asgi import application
+
+        user = await User.objects.acreate(username='framing')
+        project = await Project.objects.acreate(user=user, room_type='office', title='Desk')
+        token = await Token.objects.acreate(user=user)
+        client = WebsocketClient(
+            application,
+            '/ws/chat/',
+            {'token': token.key, 'project_id': project.id, 'encoding': 'cbor'},
+        )
+        self.assertTrue(await client.connect())
+
+        async def receive_until(frame_type):
+            while True:
+                frame = await client.receive_frame(timeout=5)
+                self.assertIsInstance(frame, bytes)
+                data = cbor_loads(frame)
+                if data['type'] == frame_type:
+                    return data
+
+        connected = await receive_until('connected')
+        self.assertEqual((connected['encoding'], connected['include_context']), ('cbor', False))
+        with mock.patch.dict(os.environ, {'MOCK_LLM': 'true'}):
+            await client.send_bytes(cbor_dumps({'type': 'user_message', 'message': 'warm office'}))
+            reply = await receive_until('assistant_message')
+        await client.disconnect()
+        self.assertTrue(reply['content'])
+        self.assertIn('design_options', reply['metadata_json'])
+        self.assertNotIn('resolved_context', reply['metadata_json'])
+
+
+
+class SocketLifecycleTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='sockets', password='pass1234')
+        self.project = Project.objects.create(user=self.user, room_type='bedroom', title='Attic')
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+
+    async def _connect(self):
+        from backend.asgi import application
+
+        client = WebsocketClient(application, '/ws/chat/', {'token': self.token.key, 'project_id': self.project.id})
+        self.assertTrue(await client.connect())
+        await client.receive_until('connected')
+        return client
+
+    @override_settings(CHAT_HEARTBEAT_SECONDS=0.05, CHAT_HEARTBEAT_TIMEOUT=0.3)
+    async def test_silent_socket_is_reaped(self):
+        client = await self._connect()
+        for _ in range(3):
+            await client.receive_until('ping')
+            await client.send_json({'type': 'pong'})
+        self.assertEqual(len(sockets().report()['connections']), 1)
+        # Stop answering: pings keep coming until the timeout, then a close.
+        while True:
+            frame = await client.receive_frame(timeout=2)
+            if isinstance(frame, dict):
+                break
+        self.assertEqual(frame, {'type': 'websocket.close', 'code': HEARTBEAT_CLOSE_CODE})
+        self.assertEqual(sockets().report()['connections'], [])
+        await client.disconnect()
+
+    @override_settings(CHAT_IDLE_CONNECTIONS_PER_USER=1)
+    async def test_idle_cap_closes_the_least_recently_used_socket(self):
+        first = await self._connect()
+        second = await self._connect()
+        frame = await first.receive_frame()
+        self.assertEqual(frame['code'], IDLE_CLOSE_CODE)
+        await second.send_json({'type': 'pong'})
+        report = sockets().report()
+        self.assertEqual(len(report['connections']), 1)
+        await second.disconnect()
+        await first.disconnect()
+        self.assertEqual(sockets().report()['connections'], [])
+
+    async def test_admin_endpoint_reports_live_connections(self):
+        client = await self._connect()
+        admin = await sync_to_async(User.objects.create_superuser)('ops', 'ops@example.com', 'pass1234')
+        api = APIClient()
+
+        def get(user):
+            api.force_authenticate(user)
+            return api.get('/api/admin/connections')
+
+        forbidden = await sync_to_async(get)(self.user)
+        response = await sync_to_async(get)(admin)
+        await client.disconnect()
+        self.assertEqual(forbidden.status_code, 403)
+        self.assertEqual(response.status_code, 200)
+        (connection,) = response.json()['connections']
+        self.assertEqual((connection['user_id'], connection['project_id']), (self.user.id, self.project.id))
+        self.assertGreater(connection['bytes_sent'], 0)
+        self.assertGreater(connection['memory_bytes'], 0)
+        self.assertEqual(response.json()['totals']['connections'], 1)
+
+
+CHANNEL_LAYER_SCRIPT = """
+import asyncio, json, time
+import django
+django.setup()
+from channels.exceptions import ChannelFull
+from django.core.management import call_command
+from memory.channel_layer import DatabaseChannelLayer, encode
+
+call_command('migrate', verbosity=0)
+
+async def main():
+    layer = DatabaseChannelLayer(capacity=2, expiry=1, poll_interval=0.01)
+    report = {}
+    first, second = await layer.new_channel(), await layer.new_channel()
+    await layer.group_add('room', first)
+    await layer.group_add('room', second)
+    await layer.group_send('room', {'type': 'hello', 'data': b'raw'})
+    received = [await layer.receive(first), await layer.receive(second)]
+    report['fan_out'] = [message['data'] == b'raw' for message in received]
+    await layer.group_discard('room', second)
+    await layer.group_send('room', {'type': 'again'})
+    report['member'] = (await layer.receive(first))['type']
+    try:
+        await asyncio.wait_for(layer.receive(second), 0.3)
+        report['discarded'] = 'received'
+    except asyncio.TimeoutError:
+        report['discarded'] = 'nothing'
+    await layer.send('jobs', {'type': 'job', 'n': 1})
+    await layer.send('jobs', {'type': 'job', 'n': 2})
+    try:
+        await layer.send('jobs', {'type': 'job', 'n': 3})
+        report['full'] = False
+    except ChannelFull:
+        report['full'] = True
+    report['plain'] = [(await layer.receive('jobs'))['n'] for _ in range(2)]
+    await layer.send('late', {'type': 'stale'})
+    await asyncio.sleep(1.1)
+    await layer.send('late', {'type': 'fresh'})
+    report['after_expiry'] = (await layer.receive('late'))['type']
+
+    # A full local queue leaves the channel's rows in the table.
+    idle = asyncio.ensure_future(layer.receive(await layer.new_channel()))
+    backlog = await layer.new_channel()
+    for n in range(4):
+        await layer.send(backlog, {'type': 'item', 'n': n})
+        await asyncio.sleep(0.1)
+    received = []
+    for _ in range(4):
+        received.append((await asyncio.wait_for(layer.receive(backlog), 2))['n'])
+    report['backlog'] = received
+    idle.cancel()
+
+    now = time.time()
+    layer._deliver('gone', now + 5, encode({'type': 'x'}))
+    layer._drop_idle_queues(now)
+    report['idle_kept'] = 'gone' in layer._queues
+    layer._drop_idle_queues(now + 6)
+    report['idle_dropped'] = 'gone' not in layer._queues
+    await layer.close()
+    return report
+
+print(json.dumps(asyncio.run(main())))
+"""
+
+
+class DatabaseChannelLayerTests(SimpleTestCase):
+    def _run(self, directory, *args):
+        return subprocess.run(
+            [sys.executable, *args],
+            cwd=settings.BASE_DIR,
+            env={
+                **os.environ,
+                'DJANGO_SETTINGS_MODULE': 'backend.settings',
+                'DJANGO_SQLITE_PATH': os.path.join(directory, 'layer.sqlite3'),
+            },
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+
+    def test_groups_capacity_and_expiry(self):
+        with tempfile.TemporaryDirectory() as directory:
+            result = self._run(directory, '-c', CHANNEL_LAYER_SCRIPT)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        report = json.loads(result.stdout.splitlines()[-1])
+        self.assertEqual(report['fan_out'], [True, True])
+        self.assertEqual(report['member'], 'again')
+        self.assertEqual(report['discarded'], 'nothing')
+        self.assertTrue(report['full'])
+        self.assertEqual(report['plain'], [1, 2])
+        self.assertEqual(report['after_expiry'], 'fresh')
+        self.assertEqual(report['backlog'], [0, 1, 2, 3])
+        self.assertTrue(report['idle_kept'])
+        self.assertTrue(report['idle_dropped'])
+
+    def test_group_send_fans_out_across_worker_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            migrate = self._run(directory, 'manage.py', 'migrate', '-v0')
+            self.assertEqual(migrate.returncode, 0, migrate.stderr)
+            result = self._run(
+                directory, 'manage.py', 'channel_layer_fanout', '--workers', '4', '--messages', '50', '--json'
+            )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        report = json.loads(result.stdout.splitlines()[-1])
+        self.assertEqual(report['delivered'], 200)
+        self.assertTrue(report['in_order'])
+        self.assertLess(report['p95_ms'], 1000)
+
+
+class StorageProfileTests(SimpleTestCase):
+    pragmas = {'journal_mode': 'wal', 'synchronous': 'normal', 'busy_timeout': 5000, 'cache_size': -2048}
+
+    def _connect(self, directory):
+        default = connections['default']
+        connection = default.__class__({**default.settings_dict, 'NAME': os.path.join(directory, 'profile.sqlite3')})
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_sqlite_wal_profile_tunes_every_new_connection(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(SQLITE_PRAGMAS=self.pragmas):
+            for _ in range(2):
+                connection = self._connect(directory)
+                self.assertEqual(
+                    sqlite_pragmas(connection),
+                    {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000, 'cache_size': -2048},
+                )
+                connection.close()
+
+    def test_unknown_profile_is_rejected(self):
+        path = os.path.join(settings.BASE_DIR, 'backend', 'settings.py')
+        with mock.patch.dict(os.environ, {'DATABASE_PROFILE': 'postgresql'}):
+            with self.assertRaisesMessage(ImproperlyConfigured, "Unknown DATABASE_PROFILE 'postgresql'"):
+                runpy.run_path(path)
+
+    def test_plain_sqlite_profile_keeps_sqlite_defaults(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(SQLITE_PRAGMAS={}):
+            connection = self._connect(directory)
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                self.assertEqual(cursor.fetchone()[0], 'delete')
+                cursor.execute('PRAGMA synchronous')
+                self.assertEqual(cursor.fetchone()[0], 2)
+
+
+@override_settings(READ_REPLICA_DATABASE='replica')
+class ReadReplicaRouterTests(SimpleTestCase):
+    router = ReadReplicaRouter()
+
+    def test_scoped_reads_use_the_replica_until_a_write(self):
+        self.assertEqual(self.router.db_for_read(Project), 'default')
+        with read_scope():
+            self.assertEqual(self.router.db_for_read(Project), 'replica')
+            self.assertIsNone(self.router.db_for_read(User))
+            with read_scope():
+                self.assertEqual(self.router.db_for_write(ChatMessage), 'default')
+            self.assertEqual(self.router.db_for_read(Project), 'default')
+        with read_scope():
+            self.assertEqual(self.router.db_for_read(Project), 'replica')
+
+    async def test_a_write_on_another_thread_pins_the_scope(self):
+        with read_scope():
+            await sync_to_async(self.router.db_for_write)(ChatMessage)
+            self.assertEqual(self.router.db_for_read(Project), 'default')
+
+    @override_settings(READ_REPLICA_DATABASE=None)
+    def test_without_a_replica_reads_use_the_default_routing(self):
+        with read_scope():
+            self.assertIsNone(self.router.db_for_read(Project))
+
+
+READ_REPLICA_SCRIPT = """
+import json, os, sqlite3
+import django
+django.setup()
+from django.core.management import call_command
+from django.db import connections
+from django.test.utils import setup_test_environment
+from django.contrib.auth import get_user_model
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from memory.models import Project
+from memory.routers import read_scope
+
+
+def sync():
+    # Replication, as far as this test goes: copy the primary over the replica.
+    connections['replica'].close()
+    source = sqlite3.connect(os.environ['DJANGO_SQLITE_PATH'])
+    target = sqlite3.connect(os.environ['DJANGO_SQLITE_REPLICA_PATH'])
+    source.backup(target)
+    target.close()
+    source.close()
+
+
+def title():
+    return Project.objects.get(id=project.id).title
+
+
+setup_test_environment()
+call_command('migrate', verbosity=0)
+user = get_user_model().objects.create(username='replica', email='r@example.com')
+project = Project.objects.create(user=user, room_type='office', title='Synced')
+client = APIClient()
+client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=user).key}')
+sync()
+
+Project.objects.filter(id=project.id).update(title='Primary only')
+report = {'unscoped': title()}
+with read_scope():
+    report['scoped'] = title()
+    Project.objects.filter(id=project.id).update(title='Written')
+    report['after_write'] = title()
+with read_scope():
+    report['next_scope'] = title()
+report['request'] = client.get(f'/api/projects/{project.id}/').json()['title']
+chat = client.post('/api/agent/chat', {'project_id': project.id, 'message': 'oak shelves'}, format='json')
+report['chat'] = chat.status_code
+report['search_before_sync'] = len(client.get('/api/search', {'q': 'oak'}).json()['results'])
+sync()
+report['search_after_sync'] = len(client.get('/api/search', {'q': 'oak'}).json()['results'])
+report['request_after_sync'] = client.get(f'/api/projects/{project.id}/').json()['title']
+print(json.dumps(report))
+"""
+
+
+class ReadReplicaTests(SimpleTestCase):
+    def test_two_sqlite_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            result = subprocess.run(
+                [sys.executable, '-c', READ_REPLICA_SCRIPT],
+                cwd=settings.BASE_DIR,
+                env={
+                    **os.environ,
+                    'DJANGO_SETTINGS_MODULE': 'backend.settings',
+                    'DJANGO_SQLITE_PATH': os.path.join(directory, 'primary.sqlite3'),
+                    'DJANGO_SQLITE_REPLICA_PATH': os.path.join(directory, 'replica.sqlite3'),
+                    'MOCK_LLM': 'true',
+                    'IMAGE_JOB_WORKERS': '0',
+                },
+                capture_output=True,
+                text=True,
+                timeout=120,
+            )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        report = json.loads(result.stdout.splitlines()[-1])
+        self.assertEqual(report['unscoped'], 'Primary only')
+        self.assertEqual(report['scoped'], 'Synced')
+        self.assertEqual(report['after_write'], 'Written')
+        self.assertEqual(report['next_scope'], 'Synced')
+        self.assertEqual(report['request'], 'Synced')
+        self.assertEqual(report['chat'], 200)
+        self.assertEqual(report['search_before_sync'], 0)
+        self.assertGreater(report['search_after_sync'], 0)
+        self.assertEqual(report['request_after_sync'], 'Written')
@@ -17,7 +17,9 @@ from .views import (
     demo_seed_story,
     demo_seed,
     health,
+    live_connections,
     resolve_context_view,
+    search,
 )
 
 router = DefaultRouter()
@@ -29,8 +31,10 @@ router.register(r'preferences', PreferenceViewSet, basename='preferences')
 
 urlpatterns = [
     path('health', health, name='health'),
+    path('admin/connections', live_connections, name='admin-connections'),
     path('context/resolve', resolve_context_view, name='context-resolve'),
     path('agent/chat', agent_chat, name='agent-chat'),
+    path('search', search, name='search'),
     path('assistant/suggest', assistant_suggest, name='assistant-suggest'),
     path('demo/seed', demo_seed, name='demo-seed'),
     path('demo/run_step', demo_run_step, name='demo-run-step'),
@@ -1,7 +1,18 @@
+import json
+from functools import partial
+
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, Max, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from rest_framework import status, viewsets
+from rest_framework.authtoken.models import Token
 from rest_framework.decorators import action, api_view, permission_classes
-from rest_framework.permissions import AllowAny
+from rest_framework.exceptions import Throttled
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.response import Response
 
 from .models import (
@@ -12,13 +23,27 @@ from .models import (
     Preference,
     Project,
     ProjectLink,
+    SearchDocument,
     UserProfile,
 )
-from .learning import process_feedback_event
-from .llm import generate_agent_response, generate_design_suggestions
-from .retrieval import get_canonical_version, resolve_context
+from .admission import Rejected, get_controller
+from .conditional import conditional_response, make_etag
+from .events import invalidate_sessions
+from .learning import process_feedback_event, process_feedback_events
+from .llm import generate_design_suggestions
+from .pipeline import arun_turn
+from .retrieval import (
+    get_canonical_version,
+    get_message_page,
+    get_version_tree,
+    resolve_context,
+)
+from .readpath import FastListMixin, serialize_rows
+from .search import SEARCH_PAGE_DEFAULT, SEARCH_PAGE_MAX, search_documents
+from .sockets import sockets
 from .serializers import (
     ChatMessageSerializer,
+    ChatMessageSummarySerializer,
     DesignVersionSerializer,
     FeedbackEventSerializer,
     GeneratedImageSerializer,
@@ -28,6 +53,10 @@ from .serializers import (
     UserProfileSerializer,
 )
 
+MESSAGE_PAGE_DEFAULT = 50
+MESSAGE_PAGE_MAX = 200
+FEEDBACK_BATCH_MAX = 10000
+
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
@@ -35,6 +64,13 @@ def health(request):
     return Response({'status': 'ok'})
 
 
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def live_connections(request):
+    # Chat sockets of the process that answers; each ASGI worker has its own.
+    return Response(sockets().report())
+
+
 @api_view(['POST'])
 def resolve_context_view(request):
     user_id = request.data.get('user_id')
@@ -46,6 +82,49 @@ def resolve_context_view(request):
     return Response(payload)
 
 
+@api_view(['GET'])
+def search(request):
+    params = request.query_params
+    query = params.get('q', '').strip()
+    if not query:
+        return Response({'detail': 'q is required'}, status=status.HTTP_400_BAD_REQUEST)
+    kinds = [kind for kind in params.get('kind', '').split(',') if kind]
+    valid_kinds = {kind for kind, _ in SearchDocument.KINDS}
+    if not set(kinds) <= valid_kinds:
+        return Response(
+            {'detail': f'kind must be one of {", ".join(sorted(valid_kinds))}'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    try:
+        limit = int(params.get('limit', SEARCH_PAGE_DEFAULT))
+        offset = int(params.get('offset', 0))
+        project_id = int(params['project']) if params.get('project') else None
+    except ValueError:
+        return Response(
+            {'detail': 'limit, offset and project must be integers'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+    offset = max(0, offset)
+
+    results, has_more = search_documents(
+        request.user.id,
+        query,
+        kinds=kinds,
+        project_id=project_id,
+        limit=limit,
+        offset=offset,
+    )
+    return Response(
+        {
+            'query': query,
+            'results': results,
+            'has_more': has_more,
+            'next_offset': offset + limit if has_more else None,
+        }
+    )
+
+
 @api_view(['POST'])
 def assistant_suggest(request):
     user_id = request.data.get('user_id')
@@ -56,8 +135,13 @@ def assistant_suggest(request):
             {'detail': 'user_id and project_id are required'},
             status=status.HTTP_400_BAD_REQUEST,
         )
-    context = resolve_context(user_id=user_id, message=message, project_id=project_id)
-    suggestions = generate_design_suggestions(context, message)
+    try:
+        slot = get_controller().try_admit(request.user.id)
+    except Rejected as exc:
+        raise Throttled(wait=exc.retry_after_seconds, detail=_rejected_detail(exc))
+    with slot:
+        context = resolve_context(user_id=user_id, message=message, project_id=project_id)
+        suggestions = generate_design_suggestions(context, message)
     return Response(
         {
             'context': context,
@@ -67,133 +151,84 @@ def assistant_suggest(request):
     )
 
 
-@api_view(['POST'])
-def agent_chat(request):
-    project_id = request.data.get('project_id')
-    message = request.data.get('message', '')
+def _rejected_detail(exc):
+    if exc.reason == 'rate_limited':
+        return 'Too many requests; slow down.'
+    return 'The assistant is busy; try again shortly.'
+
+
+def _rejected_response(exc):
+    response = JsonResponse(
+        {
+            'detail': _rejected_detail(exc),
+            'reason': exc.reason,
+            'retry_after': exc.retry_after_seconds,
+        },
+        status=status.HTTP_429_TOO_MANY_REQUESTS,
+    )
+    response['Retry-After'] = str(exc.retry_after_seconds)
+    return response
+
+
+async def _authenticate_token(request):
+    parts = request.headers.get('Authorization', '').split()
+    if len(parts) != 2 or parts[0].lower() != 'token':
+        return None
+    token = await Token.objects.select_related('user').filter(key=parts[1]).afirst()
+    if not token or not token.user.is_active:
+        return None
+    return token.user
+
+
+def _request_json(request):
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return request.POST
+
+
+@csrf_exempt
+@require_POST
+async def agent_chat(request):
+    # Plain async Django view rather than DRF: DRF views are sync-only, and
+    # this endpoint spends most of its life waiting on the LLM.
+    user = await _authenticate_token(request)
+    if user is None:
+        return JsonResponse(
+            {'detail': 'Authentication credentials were not provided.'},
+            status=status.HTTP_401_UNAUTHORIZED,
+        )
+    data = _request_json(request)
+    if data is None:
+        return JsonResponse({'detail': 'Malformed JSON body'}, status=status.HTTP_400_BAD_REQUEST)
+    project_id = data.get('project_id')
+    message = data.get('message', '')
     if not project_id or not message:
-        return Response(
+        return JsonResponse(
             {'detail': 'project_id and message are required'},
             status=status.HTTP_400_BAD_REQUEST,
         )
-    project = Project.objects.filter(id=project_id, user=request.user).first()
+    project = await Project.objects.filter(id=project_id, user=user).afirst()
     if not project:
-        return Response({'detail': 'Project not found'}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse({'detail': 'Project not found'}, status=status.HTTP_404_NOT_FOUND)
 
-    user_message = ChatMessage.objects.create(
-        user=request.user,
-        project=project,
-        role='user',
-        content=message,
-    )
-
-    context = resolve_context(user_id=request.user.id, message=message, project_id=project.id)
     try:
-        llm_payload = generate_agent_response(context, message)
-    except Exception:
-        llm_payload = {
-            'reply': 'I hit a snag generating a full response, but I can still help.',
-            'design_options': [],
-            'version_action': {'type': 'none'},
-            'preference_hints': [],
-        }
-
-    created_version_id = None
-    created_images = []
-    version_action = llm_payload.get('version_action', {})
-    action_type = version_action.get('type', 'none')
-    enriched_options = []
-
-    if action_type in ('create_version', 'revise_version'):
-        parent_version = None
-        parent_id = version_action.get('parent_version_id')
-        if parent_id:
-            parent_version = DesignVersion.objects.filter(
-                id=parent_id,
-                project=project,
-            ).first()
-        if parent_version is None:
-            parent_version = get_canonical_version(project.id)
-        version_notes = version_action.get('notes') or 'Assistant suggested update'
-        version = DesignVersion.objects.create(
-            project=project,
-            parent_version=parent_version,
-            notes=version_notes,
-        )
-        created_version_id = version.id
-        for index, option in enumerate(llm_payload.get('design_options', []), start=1):
-            prompt = option.get('image_prompt') or option.get('description') or 'Design option'
-            image = GeneratedImage.objects.create(
-                design_version=version,
-                prompt=prompt,
-                params_json={'option_index': index},
-                image_url=f'https://picsum.photos/seed/{version.id}-{index}/600/400',
-            )
-            created_images.append(
-                {'id': image.id, 'image_url': image.image_url, 'prompt': image.prompt}
-            )
-            enriched_options.append(
-                {
-                    'id': f'opt_{index}',
-                    'title': option.get('title') or f'Option {index}',
-                    'description': option.get('description') or '',
-                    'image_prompt': prompt,
-                    'image_url': image.image_url,
-                }
-            )
-    else:
-        for index, option in enumerate(llm_payload.get('design_options', []), start=1):
-            prompt = option.get('image_prompt') or option.get('description') or 'Design option'
-            enriched_options.append(
-                {
-                    'id': f'opt_{index}',
-                    'title': option.get('title') or f'Option {index}',
-                    'description': option.get('description') or '',
-                    'image_prompt': prompt,
-                    'image_url': f'https://picsum.photos/seed/{project.id}-{index}/600/400',
-                }
-            )
-
-    saved_flag = False
-    if action_type == 'save_final' or 'save' in message.lower():
-        canonical_version = get_canonical_version(project.id)
-        if canonical_version is None and created_version_id:
-            canonical_version = DesignVersion.objects.filter(
-                id=created_version_id,
-                project=project,
-            ).first()
-        FeedbackEvent.objects.create(
-            user=request.user,
-            project=project,
-            design_version=canonical_version,
-            event_type='save',
-            payload_json={'note': 'saved via chat'},
-        )
-        saved_flag = True
-
-    assistant_content = llm_payload.get('reply', '')
-    assistant_message = ChatMessage.objects.create(
-        user=request.user,
-        project=project,
-        role='assistant',
-        content=assistant_content,
-        metadata_json={
-            'resolved_context': context,
-            'version_id': created_version_id,
-            'created_images': created_images,
-            'design_options': enriched_options,
-            'saved': saved_flag,
-            'action_type': action_type,
-        },
-    )
-
-    return Response(
+        slot = await get_controller().admit(user.id)
+    except Rejected as exc:
+        return _rejected_response(exc)
+    async with slot:
+        assistant = await arun_turn(user, project, message)
+    metadata = assistant.full_metadata
+    return JsonResponse(
         {
-            'assistant_message': assistant_message.content,
-            'resolved_context': context,
-            'design_options': enriched_options,
-            'created_version_id': created_version_id,
-            'created_images': created_images,
+            'assistant_message': assistant.content,
+            'resolved_context': metadata['resolved_context'],
+            'design_options': metadata['design_options'],
+            'created_version_id': metadata['version_id'],
+            'created_images': metadata['created_images'],
         }
     )
 
@@ -512,7 +547,7 @@ class UserProfileViewSet(viewsets.ModelViewSet):
     serializer_class = UserProfileSerializer
 
 
-class ProjectViewSet(viewsets.ModelViewSet):
+class ProjectViewSet(FastListMixin, viewsets.ModelViewSet):
     queryset = Project.objects.select_related('user').all()
     serializer_class = ProjectSerializer
 
@@ -536,55 +571,197 @@ class ProjectViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(user_id=user_id)
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        state = self.filter_queryset(self.get_queryset()).aggregate(
+            count=Count('id'),
+            last_id=Max('id'),
+            last_updated=Max('updated_at'),
+        )
+        etag = make_etag('projects', request.user.id, request.get_full_path(), *state.values())
+        return conditional_response(
+            request,
+            'projects',
+            etag,
+            partial(super().list, request, *args, **kwargs),
+            last_modified=state['last_updated'],
+        )
+
     @action(detail=True, methods=['get', 'post'], url_path='versions')
     def versions(self, request, pk=None):
         project = self.get_object()
         if request.method == 'GET':
-            versions = (
-                DesignVersion.objects.filter(project=project)
-                .order_by('version_number', 'created_at')
-            )
-            serializer = DesignVersionSerializer(versions, many=True)
-            return Response(serializer.data)
+            versions = DesignVersion.objects.filter(project=project)
+            state = versions.aggregate(count=Count('id'), last_id=Max('id'))
+            etag = make_etag('versions', project.id, *state.values())
+
+            def render():
+                return Response(
+                    serialize_rows(
+                        versions.order_by('version_number', 'created_at'),
+                        DesignVersionSerializer,
+                    )
+                )
+
+            return conditional_response(request, 'versions', etag, render)
 
         serializer = DesignVersionSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         serializer.save(project=project)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @action(detail=True, methods=['get'], url_path='versions/tree')
+    def version_tree(self, request, pk=None):
+        project = self.get_object()
+        canonical = get_canonical_version(project.id)
+        canonical_id = canonical.id if canonical else None
+        versions = DesignVersion.objects.filter(project=project)
+
+        root_id = request.query_params.get('root')
+        ancestors_of = request.query_params.get('ancestors_of')
+        if root_id or ancestors_of:
+            if ancestors_of == 'canonical':
+                anchor_id = canonical_id
+            else:
+                try:
+                    anchor_id = int(ancestors_of or root_id)
+                except ValueError:
+                    detail = 'ancestors_of must be a version id or canonical' if ancestors_of else 'root must be a version id'
+                    return Response({'detail': detail}, status=status.HTTP_400_BAD_REQUEST)
+            anchor = DesignVersion.objects.filter(project=project, id=anchor_id).first()
+            if anchor is None:
+                return Response({'detail': 'Version not found'}, status=status.HTTP_404_NOT_FOUND)
+            lineage = anchor.ancestors() if ancestors_of else anchor.descendants()
+            versions = versions.filter(Q(id=anchor.id) | Q(id__in=lineage.values('id')))
+
+        return Response(
+            {
+                'canonical_version_id': canonical_id,
+                'nodes': get_version_tree(versions, canonical_id=canonical_id),
+            }
+        )
+
     @action(detail=True, methods=['get', 'post'], url_path='messages')
     def messages(self, request, pk=None):
         project = self.get_object()
         if request.method == 'GET':
-            messages = ChatMessage.objects.filter(project=project).order_by('created_at')
-            serializer = ChatMessageSerializer(messages, many=True)
-            return Response(serializer.data)
+            # Every message write bumps messages_version, so the project row
+            # we already loaded is enough to validate the listing.
+            etag = make_etag('messages', project.id, project.messages_version, request.get_full_path())
+            return conditional_response(
+                request,
+                'messages',
+                etag,
+                partial(self._list_messages, request, project),
+            )
 
         serializer = ChatMessageSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         serializer.save(project=project, user=request.user)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    def _list_messages(self, request, project):
+        params = request.query_params
+        include_metadata = params.get('include_metadata', 'true').lower() != 'false'
+        serializer_class = (
+            ChatMessageSerializer if include_metadata else ChatMessageSummarySerializer
+        )
+        messages = ChatMessage.objects.filter(project=project)
+        if include_metadata:
+            # full_metadata reads the snapshot; join it rather than fetch it per message.
+            messages = messages.select_related('context_snapshot')
+        else:
+            messages = messages.defer('metadata_json')
+
+        paginated = any(key in params for key in ('limit', 'before', 'after'))
+        if not paginated:
+            # Legacy shape: the full history as a bare list.
+            messages = messages.order_by('created_at', 'id')
+            return Response(serializer_class(messages, many=True).data)
+
+        try:
+            limit = int(params.get('limit', MESSAGE_PAGE_DEFAULT))
+        except ValueError:
+            return Response({'detail': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, MESSAGE_PAGE_MAX))
+
+        cursors = {}
+        for key in ('before', 'after'):
+            if params.get(key):
+                try:
+                    cursor_id = int(params[key])
+                except ValueError:
+                    return Response(
+                        {'detail': f'{key} must be an integer'},
+                        status=status.HTTP_400_BAD_REQUEST,
+                    )
+                cursors[key] = (
+                    ChatMessage.objects.filter(project=project, id=cursor_id)
+                    .only('id', 'created_at')
+                    .first()
+                )
+                if cursors[key] is None:
+                    return Response(
+                        {'detail': f'{key} must be a message id in this project'},
+                        status=status.HTTP_400_BAD_REQUEST,
+                    )
+        if 'before' in cursors and 'after' in cursors:
+            return Response(
+                {'detail': 'Use either before or after, not both'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        page, has_more = get_message_page(messages, limit, **cursors)
+        return Response(
+            {
+                'results': serializer_class(page, many=True).data,
+                'has_more': has_more,
+                'before': page[0].id if page else None,
+                'after': page[-1].id if page else getattr(cursors.get('after'), 'id', None),
+            }
+        )
+
     @action(detail=False, methods=['get'], url_path='previews')
     def previews(self, request):
-        projects = Project.objects.filter(user=request.user).order_by('-updated_at')
+        state = Project.objects.filter(user=request.user).aggregate(
+            count=Count('id'),
+            pointers=Count('last_message'),
+            messages=Sum('messages_version'),
+            last_updated=Max('updated_at'),
+        )
+        etag = make_etag('previews', request.user.id, *state.values())
+        return conditional_response(
+            request,
+            'previews',
+            etag,
+            partial(self._render_previews, request),
+        )
+
+    def _render_previews(self, request):
+        # One row per project: the denormalized pointer when it is set, else a
+        # correlated lookup on the (project, created_at, id) index.
+        latest_message_id = Subquery(
+            ChatMessage.objects.filter(project=OuterRef('pk'))
+            .order_by('-created_at', '-id')
+            .values('id')[:1]
+        )
+        preview_ids = (
+            Project.objects.filter(user=request.user)
+            .annotate(preview_id=Coalesce('last_message_id', latest_message_id))
+            .exclude(preview_id=None)
+            .values_list('preview_id', flat=True)
+        )
         latest_messages = (
-            ChatMessage.objects.filter(project__in=projects)
-            .order_by('project_id', '-created_at')
+            ChatMessage.objects.filter(id__in=preview_ids)
+            .order_by('project_id')
+            .values('id', 'project_id', 'role', 'content', 'created_at')
         )
         previews = {}
         for message in latest_messages:
-            if message.project_id not in previews:
-                previews[message.project_id] = {
-                    'id': message.id,
-                    'role': message.role,
-                    'content': message.content,
-                    'created_at': message.created_at,
-                }
+            previews[message.pop('project_id')] = message
         return Response(previews)
 
 
-class DesignVersionViewSet(viewsets.ReadOnlyModelViewSet):
+class DesignVersionViewSet(FastListMixin, viewsets.ReadOnlyModelViewSet):
     queryset = DesignVersion.objects.select_related('project').all()
     serializer_class = DesignVersionSerializer
 
@@ -593,8 +770,7 @@ class DesignVersionViewSet(viewsets.ReadOnlyModelViewSet):
         version = self.get_object()
         if request.method == 'GET':
             images = GeneratedImage.objects.filter(design_version=version).order_by('-created_at')
-            serializer = GeneratedImageSerializer(images, many=True)
-            return Response(serializer.data)
+            return Response(serialize_rows(images, GeneratedImageSerializer))
 
         serializer = GeneratedImageSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -602,7 +778,7 @@ class DesignVersionViewSet(viewsets.ReadOnlyModelViewSet):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
-class FeedbackEventViewSet(viewsets.ModelViewSet):
+class FeedbackEventViewSet(FastListMixin, viewsets.ModelViewSet):
     queryset = FeedbackEvent.objects.select_related('user', 'project', 'design_version').all()
     serializer_class = FeedbackEventSerializer
 
@@ -617,8 +793,69 @@ class FeedbackEventViewSet(viewsets.ModelViewSet):
         instance = serializer.save()
         process_feedback_event(instance)
 
+    @action(detail=False, methods=['post'], url_path='batch')
+    def batch(self, request):
+        items = request.data.get('events') if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list) or not items:
+            return Response(
+                {'detail': 'Expected a non-empty list of events'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(items) > FEEDBACK_BATCH_MAX:
+            return Response(
+                {'detail': f'At most {FEEDBACK_BATCH_MAX} events per batch'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        serializer = self._batch_serializer(request, items)
+        if not serializer.is_valid():
+            errors = [
+                {'index': index, 'errors': item_errors}
+                for index, item_errors in enumerate(serializer.errors)
+                if item_errors
+            ]
+            return Response(
+                {'detail': 'Invalid feedback events; nothing was saved', 'errors': errors},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        events = [FeedbackEvent(**validated) for validated in serializer.validated_data]
+        with transaction.atomic():
+            events = FeedbackEvent.objects.bulk_create(events)
+            preferences = process_feedback_events(events)
+            invalidate_sessions(
+                ['events', 'canonical'],
+                project_ids=[event.project_id for event in events],
+            )
+        return Response(
+            {
+                'created': len(events),
+                'ids': [event.id for event in events],
+                'preferences': PreferenceSerializer(preferences, many=True).data,
+            },
+            status=status.HTTP_201_CREATED,
+        )
+
+    def _batch_serializer(self, request, items):
+        # The related rows the batch names, loaded once per table instead of
+        # once per item by the serializer's related fields.
+        def ids(key):
+            values = {item.get(key) for item in items if isinstance(item, dict)}
+            return {value for value in values if isinstance(value, (int, str)) and str(value).isdigit()}
+
+        user = request.user
+        prefetched = {
+            get_user_model(): {user.pk: user},
+            Project: Project.objects.filter(user=user).in_bulk(ids('project')),
+            DesignVersion: DesignVersion.objects.filter(project__user=user).in_bulk(ids('design_version')),
+        }
+        return FeedbackEventSerializer(
+            data=items,
+            many=True,
+            context={'request': request, 'prefetched': prefetched},
+        )
+
 
-class PreferenceViewSet(viewsets.ModelViewSet):
+class PreferenceViewSet(FastListMixin, viewsets.ModelViewSet):
     queryset = Preference.objects.select_related('user').all()
     serializer_class = PreferenceSerializer
 
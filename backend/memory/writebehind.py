@@ -0,0 +1,173 @@
+import atexit
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .events import publish
+from .models import ChatMessage, ContextSnapshot, Project
+from .signals import messages_created
+
+logger = logging.getLogger(__name__)
+
+# Assistant replies the websocket has already sent, waiting to be written.
+# With CHAT_WRITE_BEHIND on, ChatConsumer sends the reply frame with the
+# message's client_id and hands the unsaved ChatMessage to the process's
+# ReplyWriter. Its thread drains the bounded queue in batches of up to
+# CHAT_WRITE_BEHIND_BATCH replies from any connection, one transaction per
+# batch, and tells the project's sockets how each one went: 'message_saved'
+# with the new id, or 'message_failed' if a reply could not be written even
+# on its own. close() runs at exit, so a graceful shutdown writes everything
+# already accepted.
+
+POLL_SECONDS = 0.1
+
+
+def write_replies(messages):
+    """Insert unsaved ChatMessages in one transaction; what save() does, in bulk.
+
+    The messages themselves are left untouched apart from their ids, so a
+    failed batch can be retried one message at a time with save().
+    """
+    rows = [
+        ChatMessage(
+            user_id=message.user_id,
+            project_id=message.project_id,
+            role=message.role,
+            content=message.content,
+            metadata_json=message.metadata_json,
+            client_id=message.client_id,
+            created_at=message.created_at,
+        )
+        for message in messages
+    ]
+    snapshots = {}
+    for row in rows:
+        snapshot = row.detach_context()
+        if snapshot is not None:
+            snapshots.setdefault(snapshot.digest, snapshot)
+    with transaction.atomic():
+        ContextSnapshot.objects.bulk_create(snapshots.values(), ignore_conflicts=True)
+        ChatMessage.objects.bulk_create(rows)
+        Project.messages_changed({row.project_id for row in rows})
+        # bulk_create sends no post_save.
+        messages_created(rows)
+    for message, row in zip(messages, rows):
+        message.id = row.id
+
+
+class ReplyWriter:
+    def __init__(self, maxsize, batch_size, start=True):
+        self.queue = queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.closed = False
+        self._thread = None
+        if start:
+            self._thread = threading.Thread(target=self._run, name='reply-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, message, loop=None):
+        """Queue an unsaved ChatMessage. False means write it yourself."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait((message, loop))
+        except queue.Full:
+            return False
+        return True
+
+    def _run(self):
+        while not (self.closed and self.queue.empty()):
+            try:
+                first = self.queue.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+            self._write(self._batch(first))
+
+    def _batch(self, first):
+        # Whatever queued up during the previous write joins this one.
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def drain(self):
+        """Write everything queued so far from the calling thread."""
+        while True:
+            try:
+                first = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self._write(self._batch(first))
+
+    def _write(self, batch):
+        try:
+            close_old_connections()
+            messages = [message for message, _ in batch]
+            try:
+                write_replies(messages)
+                failed = {}
+            except Exception:
+                logger.exception('reply batch of %s failed; retrying one by one', len(batch))
+                failed = self._write_singly(messages)
+            for message, loop in batch:
+                self._reconcile(message, failed.get(message.client_id), loop)
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def _write_singly(self, messages):
+        failed = {}
+        for message in messages:
+            try:
+                message.save()
+            except Exception as exc:
+                logger.exception('reply %s was not saved', message.client_id)
+                failed[message.client_id] = exc
+        return failed
+
+    def _reconcile(self, message, error, loop):
+        if loop is None or not loop.is_running():
+            # Flushing at shutdown: the sockets that would hear it are gone.
+            return
+        if error is None:
+            frame = {'type': 'message_saved', 'client_id': str(message.client_id), 'message_id': message.id}
+        else:
+            frame = {
+                'type': 'message_failed',
+                'client_id': str(message.client_id),
+                'detail': 'The reply could not be saved.',
+            }
+        try:
+            publish(message.project_id, frame, loop)
+        except Exception:
+            logger.exception('could not send %s for reply %s', frame['type'], message.client_id)
+
+    def close(self, timeout=None):
+        # Stop taking replies, then wait until every queued one is written.
+        self.closed = True
+        if self._thread is None:
+            self.drain()
+        else:
+            self._thread.join(timeout)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    # None unless CHAT_WRITE_BEHIND is on.
+    global _writer
+    if not settings.CHAT_WRITE_BEHIND:
+        return None
+    with _writer_lock:
+        if _writer is None:
+            _writer = ReplyWriter(settings.CHAT_WRITE_BEHIND_QUEUE, settings.CHAT_WRITE_BEHIND_BATCH)
+            atexit.register(_writer.close)
+        return _writer
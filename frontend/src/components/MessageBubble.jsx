@@ -36,6 +36,11 @@ export default function MessageBubble({ message, onSelectOption, onRetry }) {
             Retry
           </button>
         )}
+        {message.notSaved && (
+          <div className="status-row">
+            <span className="status-pill">Not saved to history</span>
+          </div>
+        )}
         {message.role === 'assistant' && (versionId || saved) && (
           <div className="status-row">
             {versionId && <span className="status-pill">Revision created (v{versionId})</span>}
@@ -47,7 +52,7 @@ export default function MessageBubble({ message, onSelectOption, onRetry }) {
             <h3>Design options</h3>
             <div className="options-grid">
               {options.map((option, index) => (
-                <div key={index} className="option-card">
+                <div key={`${index}-${option.image_status || ''}`} className="option-card">
                   {option.image_url && (
                     <img
                       src={option.image_url}
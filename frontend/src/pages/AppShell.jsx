@@ -30,12 +30,18 @@ export default function AppShell() {
   const [isLoadingMessages, setIsLoadingMessages] = useState(false)
   const [isSending, setIsSending] = useState(false)
   const [socket, setSocket] = useState(null)
+  const [socketEpoch, setSocketEpoch] = useState(0)
   const chatEndRef = useRef(null)
   const messagesLoadRef = useRef({ projectId: null, inFlight: false })
   const lastLoadedProjectRef = useRef(null)
   const initialProjectResolvedRef = useRef(false)
   const pendingAssistantIdRef = useRef(null)
   const wsFallbackTimerRef = useRef(null)
+  // Newest server message id seen per project, sent as last_message_id on
+  // reconnect so the socket replays only the gap.
+  const lastMessageIdRef = useRef({ projectId: null, id: null })
+  // Newest change-event version applied per `${entity}:${id}`.
+  const changeVersionsRef = useRef({})
 
   const selectedProject = useMemo(
     () => projects.find((project) => `${project.id}` === `${selectedProjectId}`),
@@ -140,24 +146,37 @@ export default function AppShell() {
     const token = localStorage.getItem('auth_token')
     const wsProtocol = window.location.protocol === 'https:' ? 'wss' : 'ws'
     const wsHost = window.location.host
+    const lastSeen = lastMessageIdRef.current
+    const resume =
+      lastSeen.projectId === selectedProjectId && lastSeen.id ? `&last_message_id=${lastSeen.id}` : ''
+    // The UI never shows resolved_context, so leave it out of the frames.
     const ws = new WebSocket(
-      `${wsProtocol}://${wsHost}/ws/chat/?project_id=${selectedProjectId}&token=${token}`
+      `${wsProtocol}://${wsHost}/ws/chat/?project_id=${selectedProjectId}&token=${token}` +
+        `&include_context=false${resume}`
     )
+    let closedHere = false
     ws.onopen = () => {
       setSocket(ws)
     }
-    ws.onclose = () => {
+    ws.onclose = (event) => {
       setSocket(null)
       setIsSending(false)
       if (wsFallbackTimerRef.current) {
         clearTimeout(wsFallbackTimerRef.current)
         wsFallbackTimerRef.current = null
       }
+      // 4009: closed for this user's idle socket cap; reconnecting would
+      // only evict another tab.
+      if (!closedHere && event.code !== 4009) {
+        setTimeout(() => setSocketEpoch((epoch) => epoch + 1), 1000)
+      }
     }
     ws.onmessage = (event) => {
       try {
         const data = JSON.parse(event.data)
-        if (data.type === 'assistant_message') {
+        if (data.type === 'ping') {
+          ws.send(JSON.stringify({ type: 'pong' }))
+        } else if (data.type === 'assistant_message') {
           const metadata = data.metadata_json || {}
           const assistantId =
             pendingAssistantIdRef.current || `ws-assistant-${data.message_id}`
@@ -166,12 +185,15 @@ export default function AppShell() {
             content: data.content,
             isPending: false,
             metadata_json: metadata,
+            clientId: data.client_id,
+            serverId: data.message_id,
           }))
           if (wsFallbackTimerRef.current) {
             clearTimeout(wsFallbackTimerRef.current)
             wsFallbackTimerRef.current = null
           }
           pendingAssistantIdRef.current = null
+          noteMessageId(selectedProjectId, data.message_id)
           revealAssistantText(assistantId, data.content)
           setProjectPreviews((prev) => ({
             ...prev,
@@ -182,6 +204,55 @@ export default function AppShell() {
             },
           }))
           setIsSending(false)
+        } else if (data.type === 'queued') {
+          // Admission queue: the turn will run, so skip the REST fallback.
+          if (wsFallbackTimerRef.current) {
+            clearTimeout(wsFallbackTimerRef.current)
+            wsFallbackTimerRef.current = null
+          }
+          if (pendingAssistantIdRef.current) {
+            updateMessageById(pendingAssistantIdRef.current, (message) => ({
+              ...message,
+              content: `Queued (position ${data.position})...`,
+            }))
+          }
+        } else if (data.type === 'throttled') {
+          if (wsFallbackTimerRef.current) {
+            clearTimeout(wsFallbackTimerRef.current)
+            wsFallbackTimerRef.current = null
+          }
+          if (pendingAssistantIdRef.current) {
+            updateMessageById(pendingAssistantIdRef.current, (message) => ({
+              ...message,
+              content: `Too many requests. Try again in ${data.retry_after}s.`,
+              isPending: false,
+              isError: true,
+            }))
+          }
+          pendingAssistantIdRef.current = null
+          setIsSending(false)
+        } else if (data.type === 'image_job') {
+          applyImageJob(data)
+        } else if (data.type === 'changes') {
+          applyChanges(data)
+        } else if (data.type === 'replay') {
+          if (data.reset) {
+            loadMessages(selectedProjectId, { force: true })
+          } else {
+            mergeReplay(data.messages)
+            data.messages.forEach((message) => noteMessageId(selectedProjectId, message.id))
+          }
+        } else if (data.type === 'message_saved') {
+          noteMessageId(selectedProjectId, data.message_id)
+          updateMessageByClientId(data.client_id, (message) => ({
+            ...message,
+            serverId: data.message_id,
+          }))
+        } else if (data.type === 'message_failed') {
+          updateMessageByClientId(data.client_id, (message) => ({
+            ...message,
+            notSaved: true,
+          }))
         }
       } catch (e) {
         console.warn('WS parse error', e)
@@ -196,10 +267,11 @@ export default function AppShell() {
       setIsSending(false)
     }
     return () => {
+      closedHere = true
       ws.close()
     }
     // eslint-disable-next-line react-hooks/exhaustive-deps
-  }, [selectedProjectId, currentUser])
+  }, [selectedProjectId, currentUser, socketEpoch])
 
   useEffect(() => {
     if (!currentUser) {
@@ -293,6 +365,7 @@ export default function AppShell() {
       setMessages(data)
       lastLoadedProjectRef.current = projectId
       const lastMessage = data[data.length - 1]
+      lastMessageIdRef.current = { projectId, id: lastMessage ? lastMessage.id : null }
       if (lastMessage) {
         setProjectPreviews((prev) => ({
           ...prev,
@@ -317,6 +390,143 @@ export default function AppShell() {
     )
   }
 
+  const noteMessageId = (projectId, id) => {
+    const lastSeen = lastMessageIdRef.current
+    if (!id || lastSeen.projectId !== projectId || id <= (lastSeen.id || 0)) {
+      return
+    }
+    lastMessageIdRef.current = { projectId, id }
+  }
+
+  const mergeReplay = (replayed) => {
+    setMessages((prev) => {
+      const known = new Set(prev.flatMap((message) => [message.id, message.serverId]))
+      const fresh = replayed.filter((message) => !known.has(message.id))
+      // Local copies that never learned their ids (the user's own messages,
+      // write-behind replies not saved yet) are replaced by the server rows.
+      const replayedTexts = new Set(fresh.map((message) => `${message.role}:${message.content}`))
+      const kept = prev.filter(
+        (message) =>
+          typeof message.id === 'number' ||
+          message.serverId ||
+          !replayedTexts.has(`${message.role}:${message.content}`)
+      )
+      return [...kept, ...fresh]
+    })
+  }
+
+  const refreshProject = async (projectId) => {
+    try {
+      const data = await fetchJson(`${API_BASE}/projects/${projectId}/`)
+      setProjects((prev) =>
+        prev.some((project) => project.id === data.id)
+          ? prev.map((project) => (project.id === data.id ? data : project))
+          : [data, ...prev]
+      )
+    } catch (err) {
+      handleError(err)
+    }
+  }
+
+  const catchUpMessages = async (projectId) => {
+    const lastSeen = lastMessageIdRef.current
+    if (lastSeen.projectId !== projectId || !lastSeen.id) {
+      loadMessages(projectId, { force: true })
+      return
+    }
+    try {
+      const data = await fetchJson(
+        `${API_BASE}/projects/${projectId}/messages/?after=${lastSeen.id}&limit=100`
+      )
+      mergeReplay(data.results)
+      data.results.forEach((message) => noteMessageId(projectId, message.id))
+      if (data.has_more) {
+        catchUpMessages(projectId)
+      }
+    } catch (err) {
+      handleError(err)
+    }
+  }
+
+  // Change events pushed on the socket, coalesced per user by the server:
+  // patch what is already loaded instead of refetching the lists.
+  const applyChanges = (data) => {
+    if (data.reset) {
+      loadProjects()
+      loadMessages(selectedProjectId, { force: true })
+      return
+    }
+    let previewsStale = false
+    let messagesStale = false
+    data.events.forEach((event) => {
+      const key = `${event.entity}:${event.id}`
+      if ((changeVersionsRef.current[key] || 0) >= event.version) {
+        return
+      }
+      changeVersionsRef.current[key] = event.version
+      if (event.entity === 'project') {
+        if (event.op !== 'deleted') {
+          refreshProject(event.id)
+          return
+        }
+        setProjects((prev) => prev.filter((project) => project.id !== event.id))
+        if (`${event.id}` === `${selectedProjectId}`) {
+          setSelectedProjectId('')
+          setMessages([])
+        }
+      } else if (event.entity === 'message') {
+        if (`${event.project_id}` !== `${selectedProjectId}`) {
+          previewsStale = true
+        } else if (event.op === 'deleted') {
+          setMessages((prev) =>
+            prev.filter((message) => message.id !== event.id && message.serverId !== event.id)
+          )
+        } else if (
+          !pendingAssistantIdRef.current &&
+          event.id > (lastMessageIdRef.current.id || 0)
+        ) {
+          // Written elsewhere (another tab, the REST fallback); a turn in
+          // flight on this socket brings its own messages.
+          messagesStale = true
+        }
+      }
+    })
+    if (previewsStale) {
+      loadPreviews()
+    }
+    if (messagesStale) {
+      catchUpMessages(selectedProjectId)
+    }
+  }
+
+  const updateMessageByClientId = (clientId, updater) => {
+    setMessages((prev) =>
+      prev.map((message) => (message.clientId === clientId ? updater(message) : message))
+    )
+  }
+
+  const applyImageJob = (job) => {
+    setMessages((prev) =>
+      prev.map((message) => {
+        const options = message.metadata_json?.design_options
+        if (!options?.some((option) => option.image_id === job.image_id)) {
+          return message
+        }
+        return {
+          ...message,
+          metadata_json: {
+            ...message.metadata_json,
+            design_options: options.map((option) =>
+              option.image_id === job.image_id
+                ? { ...option, image_url: job.image_url, image_status: job.status }
+                : option
+            ),
+          },
+        }
+      })
+    )
+  }
+
   const revealAssistantText = (id, fullText) => {
     const words = fullText.split(' ')
     let index = 0
@@ -410,16 +620,21 @@ export default function AppShell() {
     }
 
     if (socket && socket.readyState === WebSocket.OPEN) {
+      // Names the reply up front; without crypto.randomUUID (insecure
+      // origins) the server picks one and the frame carries it back.
+      const clientId = window.crypto?.randomUUID?.()
       socket.send(
         JSON.stringify({
           type: 'user_message',
           message: textToSend,
           project_id: Number(selectedProjectId),
+          client_id: clientId,
         })
       )
       updateMessageById(tempAssistantId, (message) => ({
         ...message,
         id: tempAssistantId, // keep until ws response replaces
+        clientId,
       }))
       if (wsFallbackTimerRef.current) {
         clearTimeout(wsFallbackTimerRef.current)
@@ -451,7 +666,7 @@ export default function AppShell() {
           payload_json: { selected_option_index: optionIndex },
         }),
       })
-      await fetchJson(`${API_BASE}/projects/${selectedProjectId}/messages/`, {
+      const userMessage = await fetchJson(`${API_BASE}/projects/${selectedProjectId}/messages/`, {
         method: 'POST',
         headers: jsonHeaders,
         body: JSON.stringify({
@@ -459,7 +674,7 @@ export default function AppShell() {
           content: `I choose option ${optionIndex}.`,
         }),
       })
-      await fetchJson(`${API_BASE}/projects/${selectedProjectId}/messages/`, {
+      const assistantMessage = await fetchJson(`${API_BASE}/projects/${selectedProjectId}/messages/`, {
         method: 'POST',
         headers: jsonHeaders,
         body: JSON.stringify({
@@ -467,7 +682,9 @@ export default function AppShell() {
           content: `Noted. Option ${optionIndex} is selected. I'll use it as the base for further tweaks.`,
         }),
       })
-      await loadMessages(selectedProjectId, { force: true })
+      appendMessage(userMessage)
+      appendMessage(assistantMessage)
+      noteMessageId(selectedProjectId, assistantMessage.id)
     } catch (err) {
       handleError(err)
     }
@@ -539,7 +756,7 @@ export default function AppShell() {
           payload_json: { note: 'saved via chat UI' },
         }),
       })
-      await fetchJson(`${API_BASE}/projects/${selectedProjectId}/messages/`, {
+      const userMessage = await fetchJson(`${API_BASE}/projects/${selectedProjectId}/messages/`, {
         method: 'POST',
         headers: jsonHeaders,
         body: JSON.stringify({
@@ -547,7 +764,7 @@ export default function AppShell() {
           content: 'Save this design.',
         }),
       })
-      await fetchJson(`${API_BASE}/projects/${selectedProjectId}/messages/`, {
+      const assistantMessage = await fetchJson(`${API_BASE}/projects/${selectedProjectId}/messages/`, {
         method: 'POST',
         headers: jsonHeaders,
         body: JSON.stringify({
@@ -555,7 +772,9 @@ export default function AppShell() {
           content: 'Saved. I will treat this as the canonical version for this project.',
         }),
       })
-      await loadMessages(selectedProjectId, { force: true })
+      appendMessage(userMessage)
+      appendMessage(assistantMessage)
+      noteMessageId(selectedProjectId, assistantMessage.id)
     } catch (err) {
       handleError(err)
     }